@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the setup operations of esp8266-setup
+#
+# Runs start-project, add-library, show-libraries, update-library and
+# remove-library against local fixture git repositories and generated library
+# definitions, for a growing number of libraries. Every operation runs as its
+# own esp8266-setup process like it does on CI.
+#
+#   python benchmarks/bench_cli.py --scales 1,10,100
+#   python benchmarks/bench_cli.py --compare benchmarks/results/<old>.json
+#
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from esp8266_setup.cmdline import __version__
+
+SCALES = [1, 10, 50, 200]
+
+# source files of every fixture library
+SOURCE_FILES = 4
+
+# external commands that are counted, through shims on the PATH
+COUNTED_COMMANDS = ['git', 'esp8266-setup']
+
+GIT = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', '-c', 'init.defaultBranch=master']
+
+
+def git(args, cwd):
+    subprocess.check_call(GIT + args, cwd=cwd, stdout=open(os.devnull, 'w'))
+
+def make_repo(directory, files):
+    """Commit files, a dict of path to content, as a new repository"""
+    for path, content in files.items():
+        path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+    git(['init', '-q'], directory)
+    git(['add', '-A'], directory)
+    git(['commit', '-q', '-m', 'Initial'], directory)
+
+def make_library(root, name):
+    """Repository of a foreign library and a definition to import it"""
+    repo = os.path.join(root, 'repos', name)
+    files = {
+        'README.md': '# {}\n'.format(name),
+        'LICENSE.txt': 'BSD-2-Clause\n',
+        'include/{}.h'.format(name): 'int {}_init(void);\n'.format(name),
+    }
+    for i in range(SOURCE_FILES):
+        files['src/{}_{}.c'.format(name, i)] = '#include "{0}.h"\nint {0}_{1}(void) {{ return {1}; }}\n'.format(name, i)
+    make_repo(repo, files)
+
+    definition = {
+        'name': name,
+        'author': 'bench',
+        'version': '1.0',
+        'license': 'BSD-2-Clause',
+        'url': 'git+file://{}@master'.format(repo),
+        'dependencies': [],
+        'sdk_dependencies': [],
+        'extra_cflags': '',
+        'extra_ldflags': '',
+        'extra_includes': '',
+        'source': sorted(f for f in files if f.startswith('src/')),
+        'include': ['include/{}.h'.format(name)],
+    }
+    filename = os.path.join(root, 'defs', name + '.json')
+    with open(filename, 'w') as fp:
+        json.dump(definition, fp, indent=4)
+    return filename
+
+def make_shims(root, counter):
+    """Count invocations of external commands, the real ones do the work"""
+    shim_dir = os.path.join(root, 'shims')
+    os.mkdir(shim_dir)
+    real_git = subprocess.check_output(['sh', '-c', 'command -v git']).decode('utf-8').strip()
+    commands = {
+        'git': 'exec "{}" "$@"'.format(real_git),
+        'esp8266-setup': 'PYTHONPATH="{}" exec "{}" "{}" "$@"'.format(REPO, sys.executable, os.path.join(REPO, 'bin', 'esp8266-setup')),
+    }
+    for name, command in commands.items():
+        path = os.path.join(shim_dir, name)
+        with open(path, 'w') as fp:
+            fp.write('#!/bin/sh\necho {} >> "{}"\n{}\n'.format(name, counter, command))
+        os.chmod(path, 0o755)
+    return shim_dir
+
+def make_fixtures(root, count):
+    for directory in ('repos', 'defs', 'work'):
+        os.mkdir(os.path.join(root, directory))
+    definitions = [make_library(root, 'benchlib{:03d}'.format(i)) for i in range(count)]
+
+    # start-project adds minic from github, serve it locally
+    minic = os.path.join(root, 'repos', 'minic')
+    make_repo(minic, {'library.json': json.dumps({'name': 'minic', 'url': '', 'version': '1.0'}), 'src/minic.c': '\n'})
+    return definitions, minic
+
+
+def parse_strace(filename):
+    """Total syscalls and successful execve calls from `strace -c` output"""
+    calls = execs = 0
+    with open(filename, 'r') as fp:
+        for line in fp:
+            words = line.split()
+            if len(words) < 5 or words[-1] == 'total':
+                continue
+            try:
+                float(words[0])
+                count = int(words[3])
+            except ValueError:
+                continue
+            calls += count
+            if words[-1] == 'execve':
+                execs += count
+    return calls, execs
+
+class Runner(object):
+
+    def __init__(self, root, minic, strace=False):
+        self.root = root
+        self.strace = strace
+        self.counter = os.path.join(root, 'commands.log')
+        self.env = os.environ.copy()
+        self.env['PATH'] = make_shims(root, self.counter) + os.pathsep + self.env.get('PATH', '')
+        self.env['PYTHONPATH'] = REPO
+        self.env['ESP8266_SETUP_CACHE'] = os.path.join(root, 'cache')
+        self.env['GIT_CONFIG_COUNT'] = '1'
+        self.env['GIT_CONFIG_KEY_0'] = 'url.file://{}.insteadOf'.format(minic)
+        self.env['GIT_CONFIG_VALUE_0'] = 'https://github.com/esp8266-setup/minic.git'
+
+    def run(self, operation, scale, args, cwd):
+        """Run one esp8266-setup operation, returns its measurements"""
+        open(self.counter, 'w').close()
+        log = os.path.join(self.root, 'output.log')
+        command = [sys.executable, os.path.join(REPO, 'bin', 'esp8266-setup')] + args
+        trace = os.path.join(self.root, 'strace.log')
+        if self.strace:
+            command = ['strace', '-f', '-c', '-o', trace] + command
+
+        start = time.time()
+        with open(log, 'w') as output:
+            process = subprocess.Popen(command, cwd=cwd, env=self.env, stdout=output, stderr=subprocess.STDOUT)
+            _, status, usage = os.wait4(process.pid, 0)
+        wall = time.time() - start
+        if status != 0:
+            with open(log, 'r') as fp:
+                print(fp.read())
+            print('ERROR: {} failed'.format(' '.join(args)))
+            exit(1)
+
+        with open(self.counter, 'r') as fp:
+            invoked = [line.strip() for line in fp]
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+        result = {
+            'operation': operation,
+            'libraries': scale,
+            'wall': wall,
+            'max_rss_kb': max_rss,
+            'commands': dict((c, invoked.count(c)) for c in COUNTED_COMMANDS),
+        }
+        if self.strace:
+            result['syscalls'], result['execs'] = parse_strace(trace)
+        print('{:<20} {:>5} libs {:>8.2f}s {:>8} KB  {}'.format(
+            operation, scale, wall, max_rss,
+            ' '.join('{}={}'.format(c, n) for c, n in sorted(result['commands'].items()))))
+        return result
+
+
+def bench_scale(scale, strace=False):
+    root = tempfile.mkdtemp(prefix='esp8266-setup-bench')
+    try:
+        definitions, minic = make_fixtures(root, scale)
+        runner = Runner(root, minic, strace=strace)
+        work = os.path.join(root, 'work')
+        library_list = os.path.join(root, 'libraries.txt')
+        with open(library_list, 'w') as fp:
+            fp.write('\n'.join(definitions) + '\n')
+        first = os.path.basename(definitions[0])[:-5]
+
+        results = []
+        results.append(runner.run('start-project', scale, ['start-project', 'bench'], work))
+        project = os.path.join(work, 'bench')
+        results.append(runner.run('add-library', scale, ['add-library', '--file', library_list], project))
+        results.append(runner.run('show-libraries', scale, ['show-libraries'], project))
+        results.append(runner.run('update-library', scale, ['update-library', first], project))
+        results.append(runner.run('remove-library', scale, ['remove-library', first], project))
+
+        # the git mirrors of the first project are in the cache now
+        shutil.rmtree(project)
+        runner.run('start-project', scale, ['start-project', 'bench'], work)
+        results.append(runner.run('add-library-warm', scale, ['add-library', '--file', library_list], project))
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results, baseline, threshold):
+    """Print the change against a baseline, returns the number of regressions"""
+    before = dict(((r['operation'], r['libraries']), r) for r in baseline['results'])
+    regressions = 0
+    print('')
+    print('Compared to {} ({}):'.format(baseline['revision'], baseline['version']))
+    for r in results:
+        old = before.get((r['operation'], r['libraries']))
+        if old is None or old['wall'] <= 0:
+            continue
+        change = (r['wall'] - old['wall']) / old['wall'] * 100.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{:<20} {:>5} libs {:>8.2f}s -> {:>8.2f}s ({:+.0f}%){}'.format(
+            r['operation'], r['libraries'], old['wall'], r['wall'], change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the esp8266-setup setup operations')
+    parser.add_argument('--scales', default=','.join(str(s) for s in SCALES), help='Comma separated numbers of libraries to benchmark with')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scale, the fastest one counts')
+    parser.add_argument('--strace', action='store_true', help='Count syscalls and processes with strace')
+    parser.add_argument('--output', default=None, help='Result file, defaults to benchmarks/results/<revision>.json')
+    parser.add_argument('--compare', default=None, help='Result file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=20.0, help='Slowdown in percent that counts as a regression')
+    args = parser.parse_args()
+
+    rev = revision()
+    results = []
+    for scale in [int(s) for s in args.scales.split(',')]:
+        runs = [bench_scale(scale, strace=args.strace) for _ in range(args.repeat)]
+        results.extend(min(r, key=lambda r: r['wall']) for r in zip(*runs))
+
+    output = args.output or os.path.join(REPO, 'benchmarks', 'results', rev + '.json')
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as fp:
+        json.dump({
+            'version': __version__,
+            'revision': rev,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }, fp, indent=4)
+    print('')
+    print('Results written to {}'.format(output))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        if compare(results, baseline, args.threshold) > 0:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Startup time of esp8266-setup
+#
+# Runs `esp8266-setup version` and `esp8266-setup -h` in fresh interpreters and
+# reports the median time, fails if it is above the budget. With --imports the
+# slowest module imports of `version` are listed (Python 3.7+).
+#
+#   python benchmarks/bench_startup.py --budget 150
+#
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO, 'bin', 'esp8266-setup')
+
+COMMANDS = [['version'], ['-h']]
+
+
+def environment():
+    env = os.environ.copy()
+    env['PYTHONPATH'] = REPO
+    return env
+
+def run(args, env):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, SCRIPT] + args, env=env, stdout=devnull)
+    return time.time() - start
+
+def baseline(env, runs):
+    """Time of a bare interpreter start, to tell it apart from our own cost"""
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'pass'], env=env)
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+def slowest_imports(env, count):
+    """(cumulative microseconds, module) of the slowest imports of `version`"""
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', SCRIPT, 'version'], env=env, stderr=subprocess.STDOUT)
+    imports = []
+    for line in output.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = [part.strip() for part in line[len('import time:'):].split('|')]
+        imports.append((int(cumulative), module))
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of esp8266-setup')
+    parser.add_argument('--runs', type=int, default=20, help='Runs per command, the median counts')
+    parser.add_argument('--budget', type=float, default=None, help='Fail if `version` takes longer than this many milliseconds')
+    parser.add_argument('--imports', action='store_true', help='Show the slowest imports')
+    args = parser.parse_args()
+
+    env = environment()
+    # warm up the file system cache
+    run(['version'], env)
+
+    interpreter = baseline(env, args.runs)
+    print('{:<20} {:>8.1f} ms'.format('python -c pass', interpreter * 1000))
+    medians = {}
+    for command in COMMANDS:
+        times = sorted(run(command, env) for _ in range(args.runs))
+        median = times[len(times) // 2]
+        medians[' '.join(command)] = median
+        print('{:<20} {:>8.1f} ms (min {:.1f} ms, {:.1f} ms above the interpreter)'.format(
+            'esp8266-setup ' + ' '.join(command), median * 1000, times[0] * 1000, (median - interpreter) * 1000))
+
+    if args.imports:
+        print('')
+        print('Slowest imports of `version`:')
+        for cumulative, module in slowest_imports(env, 15):
+            print('{:>10.1f} ms  {}'.format(cumulative / 1000.0, module))
+
+    if args.budget is not None and medians['version'] * 1000 > args.budget:
+        print('')
+        print('ERROR: `esp8266-setup version` took {:.1f} ms, the budget is {:.1f} ms'.format(medians['version'] * 1000, args.budget))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+
+from esp8266_setup.cache import cache_dir, cache_limit, directory_size, locked, prune, touch
+
+# kinds of entries in the user level cache
+CACHE_KINDS = ['git', 'downloads', 'archives']
+
+# stands in for the project specific build directory in cached dependency files
+BUILD_DIR_TOKEN = '@BUILD_DIR@'
+
+
+def _which(program):
+    if os.path.isabs(program):
+        return program
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path):
+            return path
+    return program
+
+def _hash_contents(h, directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            h.update(os.path.relpath(path, directory).encode('utf-8'))
+            with open(path, 'rb') as fp:
+                h.update(hashlib.sha256(fp.read()).digest())
+
+def _hash_stats(h, directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            st = os.stat(path)
+            h.update('{} {} {}\n'.format(path, st.st_size, st.st_mtime).encode('utf-8'))
+
+def archive_key(source, flags_file):
+    """Cache key of a library archive: the library sources, the effective
+    compiler flags as recorded by the Makefile, the compiler binary and the
+    SDK headers the flags point to"""
+    with open(flags_file, 'r') as fp:
+        flags = fp.read()
+    h = hashlib.sha256(flags.encode('utf-8'))
+
+    words = flags.split()
+    compiler = os.path.realpath(_which(words[0]))
+    if os.path.isfile(compiler):
+        st = os.stat(compiler)
+        h.update('{} {} {}\n'.format(compiler, st.st_size, st.st_mtime).encode('utf-8'))
+
+    # SDK headers only change with the SDK, a stat signature is enough
+    sdk_dirs = sorted(set(w[2:] for w in words if w.startswith('-I') and os.path.isabs(w[2:])))
+    walked = []
+    for directory in sdk_dirs:
+        if any(directory.startswith(w + os.sep) for w in walked) or not os.path.isdir(directory):
+            continue
+        _hash_stats(h, directory)
+        walked.append(directory)
+
+    for sub in ('src', 'include'):
+        if os.path.isdir(os.path.join(source, sub)):
+            _hash_contents(h, os.path.join(source, sub))
+    return h.hexdigest()
+
+def _entry(key):
+    return os.path.join(cache_dir('archives'), key)
+
+def _record(event):
+    """Count cache hits and misses for `cache stats`"""
+    filename = os.path.join(cache_dir(), 'stats.json')
+    with locked(filename):
+        try:
+            with open(filename, 'r') as fp:
+                stats = json.load(fp)
+        except (IOError, OSError, ValueError):
+            stats = {}
+        stats[event] = stats.get(event, 0) + 1
+        with open(filename, 'w') as fp:
+            json.dump(stats, fp)
+
+def _copy(source, destination, build_from=None, build_to=None):
+    directory = os.path.dirname(destination)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if build_from is None:
+        shutil.copyfile(source, destination)
+        return
+    # dependency files contain the absolute build directory
+    with open(source, 'r') as fp:
+        content = fp.read().replace(build_from, build_to)
+    with open(destination, 'w') as fp:
+        fp.write(content)
+
+def restore_archive(source, build_dir, archive, flags_file):
+    """Copy a prebuilt archive together with its objects and dependency files
+    from the cache into the build directory, returns False on a cache miss"""
+    entry = _entry(archive_key(source, flags_file))
+    build_dir = os.path.abspath(build_dir)
+    with locked(entry):
+        if not os.path.isfile(os.path.join(entry, 'meta.json')):
+            _record('misses')
+            return False
+        objects = os.path.join(entry, 'objects')
+        for root, dirs, files in os.walk(objects):
+            for f in files:
+                path = os.path.join(root, f)
+                destination = os.path.join(build_dir, os.path.relpath(path, objects))
+                if f.endswith('.d'):
+                    _copy(path, destination, BUILD_DIR_TOKEN, build_dir)
+                else:
+                    _copy(path, destination)
+        # copied last so it is newer than the objects
+        _copy(os.path.join(entry, 'lib.a'), archive)
+        touch(entry)
+    _record('hits')
+    return True
+
+def store_archive(source, build_dir, archive, flags_file):
+    """Put a freshly built archive with its objects into the cache"""
+    entry = _entry(archive_key(source, flags_file))
+    build_dir = os.path.abspath(build_dir)
+    with locked(entry):
+        if os.path.isfile(os.path.join(entry, 'meta.json')):
+            touch(entry)
+            return
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        objects = os.path.join(entry, 'objects')
+        for root, dirs, files in os.walk(build_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                destination = os.path.join(objects, os.path.relpath(path, build_dir))
+                if f.endswith('.d'):
+                    _copy(path, destination, build_dir, BUILD_DIR_TOKEN)
+                elif f.endswith('.o'):
+                    _copy(path, destination)
+        _copy(archive, os.path.join(entry, 'lib.a'))
+        # written last, marks the entry as complete
+        with open(os.path.join(entry, 'meta.json'), 'w') as fp:
+            json.dump({'archive': os.path.basename(archive), 'created': time.time()}, fp)
+    prune(cache_dir('archives'), cache_limit(), keep=(entry,))
+
+
+def _size(value):
+    return '{:.1f} MB'.format(value / (1024.0 * 1024.0))
+
+def _entries(kind):
+    directory = cache_dir(kind)
+    return [os.path.join(directory, e) for e in os.listdir(directory) if not e.endswith('.lock')]
+
+def cache_stats():
+    total = 0
+    for kind in CACHE_KINDS:
+        entries = _entries(kind)
+        size = sum(directory_size(e) for e in entries)
+        total += size
+        print('{:<10} {:>5} entries {:>10}'.format(kind, len(entries), _size(size)))
+    print('{:<10} {:>13} {:>10} (limit {} per kind)'.format('total', '', _size(total), _size(cache_limit())))
+    try:
+        with open(os.path.join(cache_dir(), 'stats.json'), 'r') as fp:
+            stats = json.load(fp)
+        print('archive cache: {} hits, {} misses'.format(stats.get('hits', 0), stats.get('misses', 0)))
+    except (IOError, OSError, ValueError):
+        pass
+
+def cache_prune(limit):
+    for kind in CACHE_KINDS:
+        directory = cache_dir(kind)
+        before = sum(directory_size(e) for e in _entries(kind))
+        removed = prune(directory, limit)
+        if len(removed) > 0:
+            after = sum(directory_size(e) for e in _entries(kind))
+            print('{}: removed {} entries, freed {}'.format(kind, len(removed), _size(before - after)))
+
+
+def cache(args):
+    if args.cache_operation == 'stats':
+        cache_stats()
+    elif args.cache_operation == 'prune':
+        limit = cache_limit() if args.size is None else args.size * 1024 * 1024
+        cache_prune(limit)
+    elif args.cache_operation == 'restore':
+        if restore_archive(args.source, args.build_dir, args.archive, args.flags):
+            sys.stderr.write('CACHE {}\n'.format(os.path.basename(args.archive)))
+    elif args.cache_operation == 'store':
+        store_archive(args.source, args.build_dir, args.archive, args.flags)
+    else:
+        print('ERROR: Missing cache operation, run esp8266-setup cache -h for help')
+        exit(1)
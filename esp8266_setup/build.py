@@ -0,0 +1,110 @@
+from __future__ import print_function
+
+import os
+
+from esp8266_setup.tools import BASE_DIR, write_if_changed
+from esp8266_setup.makefile import Makefile
+from esp8266_setup.library import make_library_makefile, definition_args
+from esp8266_setup.dependencies import link_order
+from esp8266_setup.index import installed_libraries
+
+# flat build graph of all libraries, included by the project Makefile
+BUILD_FILE = 'build.mk'
+
+HEADER = """# generated by `esp8266-setup generate-build`, do not edit
+#
+# all libraries are compiled by the project make instead of one sub-make per
+# library, so `make -j` schedules every translation unit together
+
+# signature of the effective flags of a build step, rewritten only when they
+# change so everything that depends on it is rebuilt exactly then
+update-flags = $(shell mkdir -p $(dir $1) && printf '%s\\n' '$(subst ','\\'',$2)' | cmp -s - $1 || printf '%s\\n' '$(subst ','\\'',$2)' > $1)
+
+# prebuilt archives come from the user level cache if available, set
+# LIB_CACHE to an empty value to always compile
+ifndef LIB_CACHE
+LIB_CACHE := $(shell command -v esp8266-setup)
+endif
+"""
+
+RULES = """
+# {name}
+LIB_{name}_SRC    := $(wildcard {path}/src/*.c)
+LIB_{name}_OBJ    := $(patsubst %.c,$(BUILD_BASE)/%.o,$(LIB_{name}_SRC))
+LIB_{name}_INCDIR := {incdir}
+LIB_{name}_SDK    := $(addprefix -I$(SDK_PATH)/,{sdk_incdir})
+LIB_{name}_CFLAGS := {cflags}
+LIB_{name}_AR     := $(BUILD_BASE)/$(SRC_LIBDIR)/lib{name}.a
+LIB_{name}_FLAGS  := $(BUILD_BASE)/{path}/lib.flags
+
+ifneq ($(MAKECMDGOALS),clean)
+$(call update-flags,$(LIB_{name}_FLAGS),$(CC) $(LIB_{name}_INCDIR) $(LIB_{name}_SDK) $(SDK_INCDIR) $(CFLAGS) $(LIB_{name}_CFLAGS))
+ifneq ($(LIB_CACHE),)
+ifeq ($(wildcard $(LIB_{name}_AR)),)
+LIB_{name}_CACHED := $(shell $(LIB_CACHE) cache restore {path} $(BUILD_BASE)/{path} $(LIB_{name}_AR) $(LIB_{name}_FLAGS))
+endif
+endif
+endif
+
+$(LIB_{name}_OBJ): $(BUILD_BASE)/%.o: %.c $(LIB_{name}_FLAGS)
+	$(vecho) "CC $<"
+	$(Q) mkdir -p $(dir $@)
+	$(Q) $(CC) $(LIB_{name}_INCDIR) $(LIB_{name}_SDK) $(SDK_INCDIR) $(CFLAGS) $(LIB_{name}_CFLAGS) -MMD -MP -c $< -o $@
+
+$(LIB_{name}_AR): $(LIB_{name}_OBJ)
+	$(vecho) "AR $@"
+	$(Q) $(AR) cru $@ $^
+ifneq ($(LIB_CACHE),)
+	$(Q) $(LIB_CACHE) cache store {path} $(BUILD_BASE)/{path} $@ $(LIB_{name}_FLAGS) > /dev/null
+endif
+
+FLAT_LIB_ARCHIVES += $(LIB_{name}_AR)
+-include $(LIB_{name}_OBJ:.o=.d)
+"""
+
+
+def _relative_include(flag, path):
+    """Include flags of a library Makefile are relative to the library"""
+    if not flag.startswith('-I'):
+        return flag
+    directory = flag[2:]
+    if directory.startswith('/') or directory.startswith('$'):
+        return flag
+    return '-I' + os.path.normpath(os.path.join(path, directory))
+
+def library_rules(name, library_info):
+    """Build rules of one library, flags are generated from its library.json
+    the same way its own Makefile is"""
+    with open(os.path.join(BASE_DIR, "makefiles", "library.mk"), 'r') as fp:
+        mk = make_library_makefile(Makefile(fp.read()), definition_args(library_info))
+    path = os.path.join('lib', name)
+    includes = (mk.get('INCDIR', op=':=') + ' ' + mk.get('INCDIR', op='+=')).split(' ')
+    incdir = " ".join(_relative_include(i, path) for i in includes if len(i) > 0)
+    return RULES.format(
+        name=name,
+        path=path,
+        incdir=incdir,
+        sdk_incdir=mk.get('LIB_SDK_INCDIR', op='?='),
+        cflags=mk.get('CFLAGS', op='+='),
+    )
+
+def write_build_file(libs=None):
+    """Generate the flat build graph for the installed libraries, returns True
+    if the file changed"""
+    if libs is None:
+        libs = installed_libraries()
+    content = HEADER + "\nFLAT_LIB_ARCHIVES :=\n"
+    for lib in link_order(libs):
+        content += library_rules(lib.name, lib.library_info)
+    return write_if_changed(BUILD_FILE, content)
+
+
+def generate_build(args):
+    if not os.path.exists('Makefile'):
+        print('ERROR: Not a project directory, enter the project directory first!')
+        exit(1)
+    write_build_file()
+    with open('Makefile', 'r') as fp:
+        mk = Makefile(fp.read())
+    if not mk.has('LIB_BUILD') or mk.get('LIB_BUILD') != 'flat':
+        print('Generated {}, switch the project to it with `esp8266-setup modify-settings --lib-build flat`'.format(BUILD_FILE))
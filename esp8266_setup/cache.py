@@ -0,0 +1,104 @@
+from __future__ import print_function
+
+import os
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# default cache size limit in MB, override with ESP8266_SETUP_CACHE_SIZE
+DEFAULT_CACHE_SIZE = 2048
+
+
+def cache_dir(*parts):
+    """User level cache directory, ESP8266_SETUP_CACHE overrides the default
+    location in the XDG cache dir"""
+    base = os.environ.get('ESP8266_SETUP_CACHE')
+    if not base:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        base = os.path.join(xdg, 'esp8266-setup')
+    path = os.path.join(base, *parts)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
+
+def cache_limit():
+    """Cache size limit in bytes"""
+    return int(os.environ.get('ESP8266_SETUP_CACHE_SIZE', DEFAULT_CACHE_SIZE)) * 1024 * 1024
+
+def cache_key(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+def directory_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+def touch(path):
+    """Mark a cache entry as recently used"""
+    os.utime(path, None)
+
+@contextmanager
+def locked(path, blocking=True):
+    """Exclusive lock on `path.lock`, yields False if not blocking and the
+    lock is held by somebody else"""
+    if fcntl is None:
+        yield True
+        return
+    with open(path + '.lock', 'a') as fp:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp, flags)
+        except (IOError, OSError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def prune(directory, limit, keep=()):
+    """Evict least recently used entries in directory until it is smaller than
+    limit bytes, entries in keep and entries in use are never evicted.
+    Returns the list of evicted entries."""
+    entries = []
+    for entry in os.listdir(directory):
+        if entry.endswith('.lock'):
+            continue
+        path = os.path.join(directory, entry)
+        entries.append((os.path.getmtime(path), directory_size(path), path))
+    total = sum(e[1] for e in entries)
+
+    removed = []
+    for mtime, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if path in keep:
+            continue
+        with locked(path, blocking=False) as ok:
+            if not ok:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        if os.path.exists(path + '.lock'):
+            os.remove(path + '.lock')
+        total -= size
+        removed.append(path)
+    return removed
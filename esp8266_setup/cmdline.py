@@ -1,15 +1,40 @@
 from __future__ import print_function
 import argparse
+import shlex
 import os
+from importlib import import_module
 
-from esp8266_setup.tools import current_user, BASE_DIR
-from esp8266_setup.library import start_library, modify_library
-from esp8266_setup.project import start_project, modify_settings
-from esp8266_setup.package import add_library, remove_library, update_library, show_libraries
-from esp8266_setup.toolchain import install_toolchain
+from esp8266_setup.tools import current_user
 
 __version__ = "1.0"
 
+# module implementing each operation, the function is named like the operation,
+# modules are only imported when their operation runs to keep startup fast
+OPERATIONS = {
+    'start-project': 'project',
+    'modify-settings': 'project',
+    'start-library': 'library',
+    'modify-library': 'library',
+    'add-library': 'package',
+    'remove-library': 'package',
+    'update-library': 'package',
+    'sync': 'package',
+    'show-libraries': 'package',
+    'generate-build': 'build',
+    'build': 'profile',
+    'analyze-size': 'size',
+    'analyze-includes': 'includes',
+    'flash': 'flash',
+    'make-delta': 'ota',
+    'apply-delta': 'ota',
+    'cache': 'artifacts',
+    'install-toolchain': 'toolchain',
+    'search': 'registry',
+    'info': 'registry',
+    'batch': None,
+    'version': None,
+}
+
 #
 # Callables
 #
@@ -17,7 +42,62 @@ __version__ = "1.0"
 def version(args):
     print(__version__)
 
-def parse():
+def run_operation(args):
+    module = OPERATIONS[args.operation]
+    name = args.operation.replace('-', '_')
+    if module is None:
+        operation_func = globals()[name]
+    else:
+        operation_func = getattr(import_module('esp8266_setup.' + module), name)
+    operation_func(args)
+
+def batch(args):
+    operations = list(args.operations)
+    if args.file is not None:
+        with open(args.file, 'r') as fp:
+            for line in fp:
+                line = line.split('#', 1)[0].strip()
+                if len(line) > 0:
+                    operations.append(line)
+
+    # parse everything before touching anything
+    parser = make_parser()
+    parsed = []
+    for op in operations:
+        op_args = parser.parse_args(shlex.split(op))
+        if op_args.operation in (None, 'batch'):
+            print('ERROR: Invalid operation in batch: {}'.format(op))
+            exit(1)
+        parsed.append(op_args)
+
+    if not os.path.isfile('Makefile'):
+        for op_args in parsed:
+            run_operation(op_args)
+        return
+
+    # libraries that are installed can not be taken back, so fail before that
+    from esp8266_setup.package import check_batch, installed_names, remove_new_libraries
+    unknown = check_batch(parsed)
+    if len(unknown) > 0:
+        print('ERROR: Can not find library with name {}'.format(', '.join(unknown)))
+        exit(1)
+
+    # all operations share one Makefile transaction, lockfile and install
+    # state are only written together with the Makefile and removed libraries
+    # are only deleted after that
+    from esp8266_setup.index import deferred_removal
+    from esp8266_setup.lockfile import deferred
+    from esp8266_setup.makefile import edit_makefile
+    before = installed_names()
+    try:
+        with deferred_removal(), deferred(), edit_makefile():
+            for op_args in parsed:
+                run_operation(op_args)
+    except BaseException:
+        remove_new_libraries(before)
+        raise
+
+def make_parser():
     parser = argparse.ArgumentParser(description='esp8266.py v%s - ESP8266 Project Setup Utility' % __version__, prog='esp8266')
 
     subparsers = parser.add_subparsers(
@@ -31,6 +111,7 @@ def parse():
     parser_project.add_argument('name', help='Project name')
     parser_project.add_argument('--flash-size', choices=['512', '1024', '2048', '4096'], default='4096', help='Flash size (512 KB can not do OTA updates!)')
     parser_project.add_argument('--sdk-libs', default='', help='Link with these libs from the SDK')
+    parser_project.add_argument('--lib-build', choices=['recursive', 'flat'], default=None, help='Build libraries with one make per library or in one flat build graph')
 
     # create library templates
     parser_start_library = subparsers.add_parser(
@@ -52,7 +133,10 @@ def parse():
     parser_add_library = subparsers.add_parser(
         'add-library',
         help='Add a library to a project')
-    parser_add_library.add_argument('library', help='Library name or git URL in the form of git+<URL>')
+    parser_add_library.add_argument('library', nargs='*', help='Library names or git URLs in the form of git+<URL>')
+    parser_add_library.add_argument('--file', default=None, help='File with a list of libraries to add, one per line')
+    parser_add_library.add_argument('--jobs', '-j', type=int, default=8, help='Number of libraries to fetch and convert concurrently')
+    parser_add_library.add_argument('--shallow', action='store_true', help='Only fetch the referenced commit and the files the library definition needs')
 
     # remove a library from a project
     parser_remove_library = subparsers.add_parser(
@@ -66,16 +150,37 @@ def parse():
         help='Update a library in a project')
     parser_update_library.add_argument('library', help='Library name')
 
+    # bring libraries in line with the lockfile
+    parser_sync = subparsers.add_parser(
+        'sync',
+        help='Install the library versions recorded in the lockfile')
+    parser_sync.add_argument('--jobs', '-j', type=int, default=8, help='Number of libraries to sync concurrently')
+
     # show libraries
     parser_update_library = subparsers.add_parser(
         'show-libraries',
         help='Show installed libraries')
 
+    # library registry
+    parser_search = subparsers.add_parser(
+        'search',
+        help='Search the library definitions of the registry')
+    parser_search.add_argument('query', nargs='?', default=None, help='Part of the library name')
+    parser_search.add_argument('--sdk-dependency', default=None, help='Only libraries that depend on this SDK library')
+    parser_search.add_argument('--license', default=None, help='Only libraries with this license (SPDX short identifier)')
+
+    parser_info = subparsers.add_parser(
+        'info',
+        help='Show the registry definition of a library')
+    parser_info.add_argument('library', help='Library name')
+
     # install toolchain
-    # parser_toolchain = subparsers.add_parser(
-    #     'install-toolchain',
-    #     help='Download and install toolchain')
-    # parser_toolchain.add_argument('destination', help='Destination directory for toolchain')
+    parser_toolchain = subparsers.add_parser(
+        'install-toolchain',
+        help='Download and install toolchain and SDK into the user level cache and use them for the project')
+    parser_toolchain.add_argument('--manifest', default=None, help='JSON file listing the toolchain and SDK archives to install')
+    parser_toolchain.add_argument('--platform', choices=['linux64', 'linux32', 'macos', 'win32'], default=None, help='Install archives for this platform instead of the current one')
+    parser_toolchain.add_argument('--jobs', type=int, default=4, help='Parallel connections per download')
 
     # change settings for project
     parser_modify_settings = subparsers.add_parser(
@@ -83,6 +188,7 @@ def parse():
         help='Modify settings of an existing project')
     parser_modify_settings.add_argument('--flash-size', choices=['512', '1024', '2048', '4096'], default=None, help='Flash size')
     parser_modify_settings.add_argument('--sdk-libs', default=None, help='Link with these libs from the SDK')
+    parser_modify_settings.add_argument('--lib-build', choices=['recursive', 'flat'], default=None, help='Build libraries with one make per library or in one flat build graph')
 
     parser_modify_lib_settings = subparsers.add_parser(
         'modify-library',
@@ -97,23 +203,112 @@ def parse():
     parser_modify_lib_settings.add_argument('--include', default=None, help='Extra include paths')
     parser_modify_lib_settings.add_argument('--version', default=None, help='Version')
 
+    # generate the flat library build graph
+    subparsers.add_parser(
+        'generate-build',
+        help='Generate build.mk, a single build graph for all libraries')
+
+    # build the project
+    parser_build = subparsers.add_parser(
+        'build',
+        help='Build the project, optionally with a timing profile of every build step')
+    parser_build.add_argument('--jobs', '-j', type=int, default=None, help='Number of parallel make jobs, defaults to the number of CPUs')
+    parser_build.add_argument('--profile', action='store_true', help='Time every compile, archive, link and elf2image step')
+    parser_build.add_argument('--trace', default=os.path.join('build', 'trace.json'), help='Where to write the Chrome trace of a profiled build')
+    parser_build.add_argument('make_args', nargs=argparse.REMAINDER, help='Targets and variables passed on to make')
+
+    # memory usage of the firmware
+    parser_analyze_size = subparsers.add_parser(
+        'analyze-size',
+        help='Show IRAM, DRAM and flash usage per section, library and object')
+    parser_analyze_size.add_argument('elf', nargs='?', default=None, help='Firmware ELF file, defaults to the one in build/')
+    parser_analyze_size.add_argument('--objects', type=int, default=10, help='Number of objects to list')
+    parser_analyze_size.add_argument('--save-baseline', default=None, help='Save the usage to this file to compare later builds with')
+    parser_analyze_size.add_argument('--baseline', default=None, help='Compare with a saved baseline')
+    parser_analyze_size.add_argument('--max-ram-growth', type=int, default=None, help='Fail if RAM usage grew by more bytes than this compared to the baseline')
+
+    # include path analysis
+    parser_analyze_includes = subparsers.add_parser(
+        'analyze-includes',
+        help='Find the include directories the app and the libraries actually need')
+    parser_analyze_includes.add_argument('--sdk-path', default=None, help='SDK location, defaults to SDK_PATH or the one of install-toolchain')
+    parser_analyze_includes.add_argument('--write', action='store_true', help='Remove the unused SDK and library include directories from the Makefiles and library.json, update-library and sync restore them, rerun afterwards')
+
+    # write only what changed to the flash
+    parser_flash = subparsers.add_parser(
+        'flash',
+        help='Write firmware images, skipping flash sectors that did not change since the last flash')
+    parser_flash.add_argument('images', nargs='+', help='Pairs of flash offset and image file, like esptool write_flash')
+    parser_flash.add_argument('--port', default='/dev/ttyUSB0', help='Serial port of the chip')
+    parser_flash.add_argument('--esptool', default='esptool.py', help='esptool command')
+    parser_flash.add_argument('--full', action='store_true', help='Write every sector')
+    parser_flash.add_argument('--dry-run', action='store_true', help='Only show which sectors would be written')
+    parser_flash.add_argument('--simulate', default=None, help='Write to this file instead of a chip')
+
+    # OTA updates as a delta to the deployed firmware
+    parser_make_delta = subparsers.add_parser(
+        'make-delta',
+        help='Create a compressed OTA delta between a deployed firmware image and a new one')
+    parser_make_delta.add_argument('old', help='Firmware image running on the devices')
+    parser_make_delta.add_argument('new', help='New firmware image')
+    parser_make_delta.add_argument('--output', '-o', required=True, help='Delta file to write')
+    parser_make_delta.add_argument('--window', type=int, choices=range(9, 16), default=15, help='zlib window bits, the device needs 2^window bytes of RAM for it')
+
+    parser_apply_delta = subparsers.add_parser(
+        'apply-delta',
+        help='Apply an OTA delta to a firmware image and verify the result')
+    parser_apply_delta.add_argument('old', help='Firmware image the delta was made for')
+    parser_apply_delta.add_argument('delta', help='Delta file')
+    parser_apply_delta.add_argument('--output', '-o', default=None, help='Where to write the new firmware image')
+    parser_apply_delta.add_argument('--verify', default=None, help='Compare the result with this firmware image')
+
+    # user level cache
+    parser_cache = subparsers.add_parser(
+        'cache',
+        help='Show or prune the user level cache of git mirrors, downloads and library archives')
+    cache_subparsers = parser_cache.add_subparsers(dest='cache_operation')
+    cache_subparsers.add_parser('stats', help='Show size of the cache and archive cache hits')
+    parser_cache_prune = cache_subparsers.add_parser('prune', help='Evict least recently used entries')
+    parser_cache_prune.add_argument('--size', type=int, default=None, help='Size to prune each kind of entry to in MB, defaults to ESP8266_SETUP_CACHE_SIZE')
+    for operation in ('restore', 'store'):
+        parser_cache_archive = cache_subparsers.add_parser(operation, help='{} a library archive, used by the generated Makefiles'.format(operation.capitalize()))
+        parser_cache_archive.add_argument('source', help='Library directory')
+        parser_cache_archive.add_argument('build_dir', help='Build directory of the library')
+        parser_cache_archive.add_argument('archive', help='Library archive')
+        parser_cache_archive.add_argument('flags', help='Flag signature file of the library')
+
+    # run multiple operations at once
+    parser_batch = subparsers.add_parser(
+        'batch',
+        help='Run multiple operations with a single Makefile rewrite')
+    parser_batch.add_argument('operations', nargs='*', help='Operations with their arguments, e.g. "add-library mdns"')
+    parser_batch.add_argument('--file', default=None, help='File with one operation per line')
+
     # display version
     subparsers.add_parser(
         'version', help='Print esp8266.py version')
 
-    # internal sanity check - every operation matches a module function of the same name
-    for operation in subparsers.choices.keys():
-        op = operation.replace('-', '_')
-        assert op in globals(), "%s should be a module function" % op
+    # internal sanity check - every operation knows where it is implemented
+    assert set(subparsers.choices.keys()) == set(OPERATIONS.keys()), "every operation needs an OPERATIONS entry"
+
+    return parser
 
+def parse():
+    parser = make_parser()
     args = parser.parse_args()
 
     print('esp8266-setup v%s' % __version__)
 
     # operation function can take 1 arg (args)
     if args.operation:
-        operation_func = globals()[args.operation.replace('-', '_')]
-        operation_func(args)
+        try:
+            run_operation(args)
+        except KeyboardInterrupt:
+            # do not leave git or make running in the background
+            from esp8266_setup.runner import cancel
+            cancel()
+            print('ERROR: Interrupted')
+            exit(130)
     else:
         parser.print_usage()
 
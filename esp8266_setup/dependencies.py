@@ -0,0 +1,243 @@
+from __future__ import print_function
+
+import os
+import json
+
+from esp8266_setup.tools import parallel_map
+from esp8266_setup.registry import find_definition
+
+
+class DependencyError(Exception):
+    pass
+
+
+def is_url(spec):
+    return spec.startswith('git+') or spec.startswith('http://') or spec.startswith('https://')
+
+def spec_name(spec):
+    """Library name a spec refers to without fetching anything"""
+    if spec.startswith('git+'):
+        url = spec[4:].rsplit('@', 1)[0]
+        name = url.rstrip('/').rsplit('/', 1)[-1]
+        if name.endswith('.git'):
+            name = name[:-4]
+        return name
+    if is_url(spec):
+        name = spec.rsplit('/', 1)[-1]
+        for ext in ('.tar.gz', '.tgz', '.tar.bz2', '.zip'):
+            if name.endswith(ext):
+                return name[:-len(ext)]
+        return os.path.splitext(name)[0]
+    if spec.endswith('.json'):
+        definition = read_definition(spec)
+        if definition is not None:
+            return definition['name']
+        return os.path.splitext(os.path.basename(spec))[0]
+    return spec
+
+def read_definition(spec):
+    """Load the definition for a spec if it is available locally, returns
+    None if the library has to be fetched to know about its definition"""
+    if spec.startswith('git+'):
+        filename = os.path.join('.libs', spec_name(spec), 'library.json')
+    elif is_url(spec):
+        filename = os.path.join('.libs', spec_name(spec), 'library.json')
+    elif spec.endswith('.json'):
+        filename = spec
+    elif os.path.isfile(os.path.join('lib', spec, 'library.json')):
+        filename = os.path.join('lib', spec, 'library.json')
+    else:
+        found = find_definition(spec)
+        return found[0] if found is not None else None
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+def spec_source(spec, definition):
+    """The URL (including the ref) a spec pins, None if any source is fine"""
+    if is_url(spec):
+        return spec
+    if spec.endswith('.json') and definition is not None:
+        return definition.get('url')
+    return None
+
+
+class Node(object):
+
+    def __init__(self, name, spec, definition):
+        self.name = name
+        self.spec = spec
+        self.definition = definition
+        self.library = None
+        self.dependencies = []
+        self.required_by = []
+
+    @property
+    def source(self):
+        return spec_source(self.spec, self.definition)
+
+
+class DependencyGraph(object):
+
+    def __init__(self):
+        self.nodes = {}
+        self.order = []
+
+    def add(self, spec, definition, parent=None):
+        name = definition['name'] if definition is not None else spec_name(spec)
+        node = self.nodes.get(name)
+        if node is None:
+            node = Node(name, spec, definition)
+            self.nodes[name] = node
+            self.order.append(name)
+            created = True
+        else:
+            created = False
+            source = spec_source(spec, definition)
+            if source is not None:
+                if node.source is None:
+                    # more specific than a plain name, use this one
+                    node.spec = spec
+                    if definition is not None:
+                        node.definition = definition
+                elif node.source != source:
+                    raise DependencyError('Version conflict for {}: {} (required by {}) vs. {} (required by {})'.format(
+                        name,
+                        node.source, ", ".join(node.required_by) or 'project',
+                        source, parent or 'project'
+                    ))
+        if parent is not None:
+            if parent not in node.required_by:
+                node.required_by.append(parent)
+            if name not in self.nodes[parent].dependencies:
+                self.nodes[parent].dependencies.append(name)
+        return node, created
+
+    def find_cycle(self):
+        state = {}
+        path = []
+
+        def visit(name):
+            state[name] = 'visiting'
+            path.append(name)
+            for dep in self.nodes[name].dependencies:
+                if state.get(dep) == 'visiting':
+                    return path[path.index(dep):] + [dep]
+                if dep not in state:
+                    cycle = visit(dep)
+                    if cycle:
+                        return cycle
+            path.pop()
+            state[name] = 'done'
+            return None
+
+        for name in self.order:
+            if name not in state:
+                cycle = visit(name)
+                if cycle:
+                    return cycle
+        return None
+
+    def levels(self):
+        """Topological order, dependencies first, grouped in levels of
+        libraries that do not depend on each other"""
+        cycle = self.find_cycle()
+        if cycle:
+            raise DependencyError('Dependency cycle: {}'.format(' -> '.join(cycle)))
+
+        remaining = list(self.order)
+        done = set()
+        result = []
+        while len(remaining) > 0:
+            level = [n for n in remaining if all(d in done for d in self.nodes[n].dependencies)]
+            result.append([self.nodes[n] for n in level])
+            done.update(level)
+            remaining = [n for n in remaining if n not in done]
+        return result
+
+
+def _fetch(fetch, node):
+    try:
+        return fetch(node.spec)
+    except SystemExit:
+        raise DependencyError('Could not fetch {}'.format(node.spec))
+
+def resolve(specs, fetch, jobs=1):
+    """Build the full dependency graph for the specs
+
+    fetch is called for every spec whose definition is only available after
+    fetching it, it has to return the installed `Library`. Fetches of one
+    dependency level run in parallel.
+    """
+    graph = DependencyGraph()
+    wave = [(spec, None, None) for spec in specs]
+    while len(wave) > 0:
+        new_nodes = []
+        for spec, parent, location in wave:
+            if spec.endswith('.json') and not is_url(spec) and location and not os.path.isabs(spec):
+                # relative definition files are relative to the definition that mentions them
+                candidate = os.path.join(location, spec)
+                if os.path.isfile(candidate):
+                    spec = candidate
+            definition = read_definition(spec)
+            if definition is None and not is_url(spec):
+                raise DependencyError('Unable to find library with name {}{}'.format(
+                    spec,
+                    ' (required by {})'.format(parent) if parent else ''
+                ))
+            node, created = graph.add(spec, definition, parent)
+            if created:
+                new_nodes.append(node)
+
+        # fetch everything we can not know the dependencies of without fetching
+        unknown = [n for n in new_nodes if n.definition is None]
+        for node, lib in zip(unknown, parallel_map(lambda n: _fetch(fetch, n), unknown, jobs)):
+            node.library = lib
+            node.definition = lib.library_info
+            if node.name != lib.name:
+                # the definition knows better than the URL
+                old_name = node.name
+                del graph.nodes[old_name]
+                if lib.name in graph.nodes:
+                    graph.order.remove(old_name)
+                    new_nodes.remove(node)
+                else:
+                    graph.order[graph.order.index(old_name)] = lib.name
+                    node.name = lib.name
+                    graph.nodes[lib.name] = node
+                for other in graph.nodes.values():
+                    other.dependencies = [lib.name if d == old_name else d for d in other.dependencies]
+
+        wave = []
+        for node in new_nodes:
+            location = os.path.dirname(node.spec) if node.spec.endswith('.json') and not is_url(node.spec) else None
+            for dep in node.definition.get('dependencies', []):
+                wave.append((dep, node.name, location))
+
+    return graph
+
+def link_order(libs):
+    """Order libraries so every library comes before the libraries it depends
+    on, which is what a static linker needs. Keeps the original order where
+    possible and warns about dependencies that are not installed."""
+    by_name = dict((l.name, l) for l in libs)
+    deps = {}
+    for l in libs:
+        names = [spec_name(d) for d in l.library_info.get('dependencies', [])]
+        for d in names:
+            if d not in by_name:
+                print('WARNING: {} depends on {} which is not installed!'.format(l.name, d))
+        deps[l.name] = [d for d in names if d in by_name]
+
+    remaining = [l.name for l in libs]
+    result = []
+    while len(remaining) > 0:
+        needed = set(d for n in remaining for d in deps[n])
+        free = [n for n in remaining if n not in needed]
+        if len(free) == 0:
+            # cycle, the linker group sorts that out
+            free = remaining[:1]
+        result.append(free[0])
+        remaining.remove(free[0])
+    return [by_name[n] for n in result]
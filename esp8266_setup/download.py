@@ -0,0 +1,329 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import zipfile
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlparse
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError, URLError
+    from urlparse import urlparse
+
+from esp8266_setup.cache import cache_dir, cache_key, cache_limit, locked, prune, touch
+from esp8266_setup.runner import log_event
+from esp8266_setup.tools import parallel_map
+
+CHUNK_SIZE = 64 * 1024
+
+# size of the pieces a parallel download is split into
+RANGE_SIZE = 4 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+def sha256_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        while True:
+            chunk = fp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def archive_name(url):
+    name = os.path.basename(urlparse(url).path)
+    return name if len(name) > 0 else 'download'
+
+def _load_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _save_meta(directory, meta):
+    with open(os.path.join(directory, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp, indent=4)
+
+def _open(url, headers):
+    try:
+        return urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        if e.code in (304, 416):
+            return e
+        raise DownloadError('Download of {} failed: HTTP {}'.format(url, e.code))
+    except URLError as e:
+        raise DownloadError('Download of {} failed: {}'.format(url, e.reason))
+
+def stream_to_file(url, filename):
+    """Download url into filename in chunks. An existing `filename.part` from an
+    interrupted download is resumed with a range request if the server
+    supports it (and the resource did not change in between). Returns the
+    response headers."""
+    part = filename + '.part'
+    headers = {}
+    offset = 0
+    if os.path.isfile(part):
+        offset = os.path.getsize(part)
+        headers['Range'] = 'bytes={}-'.format(offset)
+        if os.path.isfile(part + '.etag'):
+            with open(part + '.etag', 'r') as fp:
+                headers['If-Range'] = fp.read()
+
+    response = _open(url, headers)
+    status = response.getcode()
+    if status == 416:
+        # our partial file is bogus, start over
+        os.remove(part)
+        return stream_to_file(url, filename)
+    if status == 206 and offset > 0:
+        print('Resuming download of {} at {} bytes'.format(url, offset))
+        return write_response(response, filename, append=True)
+    return write_response(response, filename)
+
+def write_response(response, filename, append=False):
+    """Stream the body of response into filename via `filename.part`"""
+    part = filename + '.part'
+    if not append and response.info().get('ETag'):
+        # remember which version the partial file belongs to
+        with open(part + '.etag', 'w') as fp:
+            fp.write(response.info().get('ETag'))
+    start = time.time()
+    received = 0
+    try:
+        with open(part, 'ab' if append else 'wb') as fp:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(chunk)
+                received += len(chunk)
+        info = response.info()
+    finally:
+        response.close()
+        log_event({'kind': 'download', 'url': response.geturl(), 'duration': time.time() - start, 'bytes': received, 'exit_status': response.getcode()})
+    os.rename(part, filename)
+    if os.path.isfile(part + '.etag'):
+        os.remove(part + '.etag')
+    return info
+
+def _probe(url):
+    """Size of the resource at url and its headers if the server supports
+    range requests, (None, None) otherwise"""
+    response = _open(url, {'Range': 'bytes=0-0'})
+    try:
+        info = response.info()
+        content_range = info.get('Content-Range') or ''
+        if response.getcode() != 206 or '/' not in content_range:
+            return None, None
+        size = content_range.rsplit('/', 1)[1]
+        return (int(size), info) if size.isdigit() else (None, None)
+    finally:
+        response.close()
+
+def _fetch_range(url, filename, start, end, etag):
+    """Download bytes start to end (inclusive) of url into the same place of
+    filename"""
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if etag:
+        headers['If-Range'] = etag
+    begin = time.time()
+    response = _open(url, headers)
+    received = 0
+    try:
+        if response.getcode() != 206:
+            raise DownloadError('Download of {} failed: the file changed on the server while downloading'.format(url))
+        with open(filename, 'r+b') as fp:
+            fp.seek(start)
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(chunk)
+                received += len(chunk)
+    finally:
+        response.close()
+        log_event({'kind': 'download', 'url': url, 'range': [start, end], 'duration': time.time() - begin, 'bytes': received, 'exit_status': response.getcode()})
+    if received != end - start + 1:
+        raise DownloadError('Download of {} failed: expected {} bytes at {}, got {}'.format(url, end - start + 1, start, received))
+
+def parallel_download(url, filename, jobs):
+    """Download url into filename with up to jobs range requests at the same
+    time. Falls back to a plain (resumable) download if the server does not
+    support ranges or the file is small. Returns the response headers."""
+    size, info = _probe(url)
+    if size is None or size <= RANGE_SIZE or jobs <= 1:
+        return stream_to_file(url, filename)
+
+    part = filename + '.part'
+    with open(part, 'wb') as fp:
+        fp.truncate(size)
+    ranges = [(start, min(start + RANGE_SIZE, size) - 1) for start in range(0, size, RANGE_SIZE)]
+    try:
+        parallel_map(lambda r: _fetch_range(url, part, r[0], r[1], info.get('ETag')), ranges, jobs=jobs)
+    except BaseException:
+        # the pieces that arrived can not be resumed, so do not keep them
+        os.remove(part)
+        raise
+    os.rename(part, filename)
+    return info
+
+def cached_download(url, sha256=None, revalidate=False, jobs=1):
+    """Fetch url into the download cache and return a tuple of the archive
+    path and whether it changed. A cached archive is used as is, unless
+    revalidate is set, then the server is asked with a conditional request
+    (ETag/If-Modified-Since) whether there is a newer version. With jobs > 1
+    new downloads are fetched with that many parallel range requests."""
+    directory = cache_dir('downloads', cache_key(url))
+    filename = os.path.join(directory, archive_name(url))
+    changed = False
+    with locked(directory):
+        meta = _load_meta(directory)
+        if os.path.isfile(filename) and sha256 is not None and meta.get('sha256') != sha256:
+            # definition wants a different archive than we have
+            os.remove(filename)
+        if not os.path.isfile(filename):
+            print('Downloading {}...'.format(url))
+            if jobs > 1 and not os.path.isfile(filename + '.part'):
+                info = parallel_download(url, filename, jobs)
+            else:
+                info = stream_to_file(url, filename)
+            changed = True
+        elif revalidate and sha256 is None:
+            headers = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            response = _open(url, headers)
+            if response.getcode() == 304:
+                response.close()
+                info = None
+            else:
+                print('Newer version of {} available, downloading...'.format(url))
+                info = write_response(response, filename)
+                changed = True
+        else:
+            info = None
+
+        if changed:
+            digest = sha256_file(filename)
+            if sha256 is not None and digest != sha256:
+                os.remove(filename)
+                raise DownloadError('Checksum mismatch for {}: expected {}, got {}'.format(url, sha256, digest))
+            meta = {
+                'url': url,
+                'sha256': digest,
+                'etag': info.get('ETag'),
+                'last_modified': info.get('Last-Modified'),
+            }
+            _save_meta(directory, meta)
+        touch(directory)
+    prune(cache_dir('downloads'), cache_limit(), keep=(directory,))
+    return filename, changed
+
+def _member_name(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name
+
+def _strip_prefix(names):
+    """If all members of an archive live in one top level directory return
+    that directory so we can strip it when unpacking"""
+    names = [_member_name(n) for n in names if len(_member_name(n)) > 0]
+    tops = set(n.split('/', 1)[0] for n in names)
+    if len(tops) == 1 and any('/' in n for n in names):
+        return tops.pop() + '/'
+    return ''
+
+def _target(destination, name, prefix):
+    name = _member_name(name)
+    if not name.startswith(prefix):
+        return None
+    name = name[len(prefix):]
+    if len(name) == 0:
+        return None
+    path = os.path.normpath(os.path.join(destination, name))
+    if os.path.isabs(name) or not path.startswith(os.path.abspath(destination) + os.sep):
+        raise DownloadError('Refusing to unpack {} outside of {}'.format(name, destination))
+    return path
+
+def _inside(destination, path):
+    """Whether path stays inside destination once all links are followed"""
+    real = os.path.realpath(path)
+    root = os.path.realpath(destination)
+    return real == root or real.startswith(root + os.sep)
+
+def unpack(archive, destination):
+    """Unpack a tar.gz/tar.bz2/zip archive into destination, a single top level
+    directory in the archive is stripped"""
+    destination = os.path.abspath(destination)
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.makedirs(destination)
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            prefix = _strip_prefix(zf.namelist())
+            for member in zf.infolist():
+                path = _target(destination, member.filename, prefix)
+                if path is None or member.filename.endswith('/'):
+                    continue
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with zf.open(member) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                mode = (member.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(path, mode)
+    elif tarfile.is_tarfile(archive):
+        with tarfile.open(archive, 'r:*') as tf:
+            members = tf.getmembers()
+            prefix = _strip_prefix([m.name for m in members])
+            for member in members:
+                path = _target(destination, member.name, prefix)
+                if path is None:
+                    continue
+                if member.isdir():
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    continue
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if not _inside(destination, directory):
+                    raise DownloadError('Refusing to unpack {} through a link outside of {}'.format(member.name, destination))
+                if os.path.lexists(path):
+                    os.remove(path)
+                if member.isfile():
+                    src = tf.extractfile(member)
+                    with open(path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                    os.chmod(path, member.mode & 0o777)
+                elif member.issym():
+                    if os.path.isabs(member.linkname) or not _inside(destination, os.path.join(directory, member.linkname)):
+                        raise DownloadError('Refusing to unpack link {} -> {} pointing outside of {}'.format(member.name, member.linkname, destination))
+                    os.symlink(member.linkname, path)
+                elif member.islnk():
+                    # hard links point to a member unpacked before
+                    source = _target(destination, member.linkname, prefix)
+                    if source is None or not os.path.isfile(source):
+                        raise DownloadError('Hard link {} points to missing member {}'.format(member.name, member.linkname))
+                    try:
+                        os.link(source, path)
+                    except OSError:
+                        shutil.copy2(source, path)
+                else:
+                    raise DownloadError('Unsupported member {} in {}'.format(member.name, archive))
+    else:
+        raise DownloadError('Unknown archive format: {}'.format(archive))
@@ -0,0 +1,157 @@
+from __future__ import print_function
+
+import struct
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_COMMON = 0xfff2
+STT_SECTION = 3
+STT_FILE = 4
+
+
+class ElfError(Exception):
+    pass
+
+
+class Section(object):
+
+    def __init__(self, index, name, type, flags, addr, size):
+        self.index = index
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.addr = addr
+        self.size = size
+
+    @property
+    def alloc(self):
+        return (self.flags & SHF_ALLOC) != 0
+
+
+class Symbol(object):
+
+    def __init__(self, name, value, size, type, bind, shndx):
+        self.name = name
+        self.value = value
+        self.size = size
+        self.type = type
+        self.bind = bind
+        self.shndx = shndx
+
+    @property
+    def defined(self):
+        return self.shndx != SHN_UNDEF and self.type not in (STT_SECTION, STT_FILE)
+
+
+class Elf(object):
+    """Section headers and symbol table of an ELF file, enough to tell how
+    much memory it takes, no relocations or program headers"""
+
+    def __init__(self, data):
+        if data[:4] != b'\x7fELF':
+            raise ElfError('not an ELF file')
+        elf_class = bytearray(data[4:5])[0]
+        encoding = bytearray(data[5:6])[0]
+        if elf_class not in (1, 2) or encoding not in (1, 2):
+            raise ElfError('unsupported ELF class or encoding')
+        self.is64 = elf_class == 2
+        self.endian = '<' if encoding == 1 else '>'
+        self.data = data
+
+        if self.is64:
+            (self.machine, shoff, shentsize, shnum, shstrndx) = self._unpack('18xH20xQ10xHHH', 0)
+        else:
+            (self.machine, shoff, shentsize, shnum, shstrndx) = self._unpack('18xH12xI10xHHH', 0)
+
+        headers = []
+        for i in range(shnum):
+            offset = shoff + i * shentsize
+            if self.is64:
+                headers.append(self._unpack('IIQQQQII', offset))
+            else:
+                headers.append(self._unpack('IIIIIIII', offset))
+
+        names = headers[shstrndx][4] if shstrndx < len(headers) else 0
+        self.sections = []
+        self._headers = headers
+        for i, (name, type, flags, addr, offset, size, link, info) in enumerate(headers):
+            self.sections.append(Section(i, self._string(names, name), type, flags, addr, size))
+        self.symbols = self._symbols()
+
+    def _unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        end = offset + struct.calcsize(fmt)
+        if end > len(self.data):
+            raise ElfError('truncated ELF file')
+        return struct.unpack(fmt, self.data[offset:end])
+
+    def _string(self, table_offset, offset):
+        start = table_offset + offset
+        end = self.data.find(b'\0', start)
+        return self.data[start:end].decode('utf-8', 'replace')
+
+    def _symbols(self):
+        symbols = []
+        for (name, type, flags, addr, offset, size, link, info) in self._headers:
+            if type != SHT_SYMTAB:
+                continue
+            strtab = self._headers[link][4]
+            entsize = 24 if self.is64 else 16
+            # the first entry is always the null symbol
+            for i in range(1, size // entsize):
+                entry = offset + i * entsize
+                if self.is64:
+                    (st_name, st_info, st_other, st_shndx, st_value, st_size) = self._unpack('IBBHQQ', entry)
+                else:
+                    (st_name, st_value, st_size, st_info, st_other, st_shndx) = self._unpack('IIIBBH', entry)
+                symbols.append(Symbol(self._string(strtab, st_name), st_value, st_size, st_info & 0xf, st_info >> 4, st_shndx))
+        return symbols
+
+    @property
+    def stripped(self):
+        return len(self.symbols) == 0
+
+
+def read_elf(filename):
+    with open(filename, 'rb') as fp:
+        return Elf(fp.read())
+
+
+def read_archive(filename):
+    """Members of an `ar` archive as a list of (name, data), understands GNU
+    and BSD long member names"""
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    if data[:8] != b'!<arch>\n':
+        raise ElfError('{} is not an archive'.format(filename))
+
+    members = []
+    long_names = b''
+    offset = 8
+    while offset + 60 <= len(data):
+        header = data[offset:offset + 60]
+        name = header[:16].rstrip(b' ')
+        size = int(header[48:58].strip() or 0)
+        offset += 60
+        content = data[offset:offset + size]
+        offset += size + (size % 2)
+
+        if name in (b'/', b'/SYM64/', b'__.SYMDEF', b'__.SYMDEF SORTED'):
+            continue
+        if name == b'//':
+            long_names = content
+            continue
+        if name.startswith(b'#1/'):
+            # BSD: the name precedes the content
+            length = int(name[3:])
+            name, content = content[:length].rstrip(b'\0'), content[length:]
+        elif name.startswith(b'/') and name[1:].isdigit():
+            start = int(name[1:])
+            name = long_names[start:long_names.find(b'/\n', start)]
+        elif name.endswith(b'/'):
+            name = name[:-1]
+        members.append((name.decode('utf-8', 'replace'), content))
+    return members
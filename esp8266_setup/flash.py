@@ -0,0 +1,263 @@
+from __future__ import print_function
+
+import os
+import re
+import json
+import shlex
+import shutil
+import hashlib
+import tempfile
+
+from esp8266_setup.cache import cache_dir, cache_key, locked
+from esp8266_setup.runner import run
+
+# the flash chip erases and esptool writes in units of one sector
+SECTOR_SIZE = 0x1000
+
+# erased flash reads as all ones
+ERASED = b'\xff'
+
+
+def sectors(offset, data):
+    """(address, content) of every sector an image covers, the last sector is
+    padded like the erase before the write leaves it"""
+    for start in range(0, len(data), SECTOR_SIZE):
+        chunk = data[start:start + SECTOR_SIZE]
+        yield offset + start, chunk + ERASED * (SECTOR_SIZE - len(chunk))
+
+def sector_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+def join_runs(sector_list):
+    """Runs of consecutive sectors as a list of (address, data) from a list
+    of (address, content) of single sectors or runs"""
+    runs = []
+    for address, content in sorted(sector_list, key=lambda s: s[0]):
+        if len(runs) > 0 and runs[-1][0] + len(runs[-1][1]) == address:
+            runs[-1] = (runs[-1][0], runs[-1][1] + content)
+        else:
+            runs.append((address, content))
+    return runs
+
+def plan(images, written):
+    """Tuple of the runs of consecutive sectors that differ from what was
+    last written and the single sectors that match it, both as lists of
+    (address, data). `images` is a list of (offset, data) and `written` maps
+    sector addresses to their hashes."""
+    end = 0
+    for offset, data in sorted(images, key=lambda image: image[0]):
+        if offset % SECTOR_SIZE != 0:
+            raise ValueError('0x{:x} is not on a sector boundary'.format(offset))
+        # esptool refuses images that share a sector as well
+        if offset < end:
+            raise ValueError('Image at 0x{:x} overlaps the one before it, which ends at 0x{:x}'.format(offset, end))
+        end = offset + (len(data) + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+
+    changed = []
+    unchanged = []
+    for offset, data in images:
+        for address, content in sectors(offset, data):
+            if written.get('{:x}'.format(address)) != sector_hash(content):
+                changed.append((address, content))
+            else:
+                unchanged.append((address, content))
+    return join_runs(changed), unchanged
+
+
+class FlashRecord(object):
+    """What was last written to the chip on a serial port, kept in the user
+    level cache so every project flashing that port shares it"""
+
+    def __init__(self, port):
+        self.filename = os.path.join(cache_dir('flash'), cache_key(port) + '.json')
+        self.port = port
+        self.chip = None
+        self.sectors = {}
+        try:
+            with open(self.filename, 'r') as fp:
+                data = json.load(fp)
+            self.chip = data['chip']
+            self.sectors = data['sectors']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'port': self.port, 'chip': self.chip, 'sectors': self.sectors}, fp)
+        os.rename(tmp, self.filename)
+
+    def forget(self, runs):
+        for address, data in runs:
+            for start in range(0, len(data), SECTOR_SIZE):
+                self.sectors.pop('{:x}'.format(address + start), None)
+
+    def remember(self, runs):
+        for address, data in runs:
+            for sector, content in sectors(address, data):
+                self.sectors['{:x}'.format(sector)] = sector_hash(content)
+
+
+class EsptoolDevice(object):
+    """A chip on a serial port, written through esptool"""
+
+    def __init__(self, port, esptool):
+        self.port = port
+        self.esptool = shlex.split(esptool)
+
+    def identify(self):
+        """MAC address of the chip, None if it can not be read"""
+        try:
+            result = run(self.esptool + ['--port', self.port, 'read_mac'])
+        except OSError:
+            return None
+        match = re.search(r'MAC: ([0-9a-fA-F:]{17})', result.output) if result.ok else None
+        return match.group(1).lower() if match else None
+
+    def _run(self, operation, runs, capture):
+        directory = tempfile.mkdtemp(prefix='esp8266-setup-flash')
+        try:
+            command = self.esptool + ['--port', self.port, operation]
+            for address, data in runs:
+                filename = os.path.join(directory, '0x{:05x}.bin'.format(address))
+                with open(filename, 'wb') as fp:
+                    fp.write(data)
+                command += ['0x{:05x}'.format(address), filename]
+            return run(command, capture=capture)
+        finally:
+            shutil.rmtree(directory)
+
+    def write(self, runs):
+        return self._run('write_flash', runs, False).ok
+
+    def verify(self, runs):
+        """The runs whose content on the chip differs, esptool compares md5
+        sums computed on the chip so nothing is read back. None if the chip
+        could not be checked."""
+        try:
+            result = self._run('verify_flash', runs, True)
+        except OSError:
+            return None
+        matched = set()
+        address = None
+        for line in result.output.splitlines():
+            m = re.search(r'bytes (?:@|at) (0x[0-9a-fA-F]+)', line)
+            if m:
+                address = int(m.group(1), 16)
+            elif 'verify OK' in line and address is not None:
+                matched.add(address)
+        if not any(a in matched for a, _ in runs) and not result.ok and 'verify FAILED' not in result.output:
+            return None
+        return [(a, data) for a, data in runs if a not in matched]
+
+
+class SimulatedFlash(object):
+    """A flash chip backed by a file, for trying out delta flashing without
+    hardware, counts the sectors erased and written"""
+
+    def __init__(self, filename, size=0x400000):
+        self.filename = filename
+        self.size = size
+        self.sectors_written = 0
+        if not os.path.isfile(filename):
+            with open(filename, 'wb') as fp:
+                fp.write(ERASED * size)
+
+    def identify(self):
+        return 'simulated:' + os.path.abspath(self.filename)
+
+    def read(self, address, length):
+        with open(self.filename, 'rb') as fp:
+            fp.seek(address)
+            return fp.read(length)
+
+    def verify(self, runs):
+        return [(a, data) for a, data in runs if self.read(a, len(data)) != data]
+
+    def write(self, runs):
+        with open(self.filename, 'r+b') as fp:
+            for address, data in runs:
+                if address % SECTOR_SIZE != 0 or address + len(data) > self.size:
+                    return False
+                for sector, content in sectors(address, data):
+                    fp.seek(sector)
+                    fp.write(content)
+                    self.sectors_written += 1
+        return True
+
+
+def flash_images(device, record, images, full=False, dry_run=False):
+    """Write the sectors of `images` that changed since the last time, returns
+    the runs written or None if writing failed"""
+    chip = device.identify()
+    if full or chip is None or chip != record.chip:
+        # another chip or an unknown state, nothing can be skipped
+        record.chip = chip
+        record.sectors = {}
+    runs, unchanged = plan(images, record.sectors)
+    if len(unchanged) > 0:
+        # the chip may have been written without us (OTA, another host), so
+        # check every sector the record says can be skipped
+        stale = device.verify(unchanged)
+        if stale is None:
+            print('WARNING: Could not check the flash contents, writing everything')
+            stale = unchanged
+        if len(stale) > 0:
+            record.forget(stale)
+            runs = join_runs(runs + stale)
+    if dry_run or len(runs) == 0:
+        return runs
+
+    # sectors being written are unknown until the write succeeded
+    record.forget(runs)
+    record.save()
+    if not device.write(runs):
+        return None
+    record.remember(runs)
+    record.save()
+    return runs
+
+
+def flash(args):
+    if len(args.images) % 2 != 0:
+        print('ERROR: Expected pairs of flash offset and image file')
+        exit(1)
+    images = []
+    for i in range(0, len(args.images), 2):
+        offset, filename = args.images[i], args.images[i + 1]
+        try:
+            with open(filename, 'rb') as fp:
+                images.append((int(offset, 0), fp.read()))
+        except (IOError, OSError) as e:
+            print('ERROR: Could not read {}: {}'.format(filename, e))
+            exit(1)
+        except ValueError:
+            print('ERROR: Invalid flash offset {}'.format(offset))
+            exit(1)
+    total = sum((len(data) + SECTOR_SIZE - 1) // SECTOR_SIZE for offset, data in images)
+
+    if args.simulate is not None:
+        device = SimulatedFlash(args.simulate)
+        port = device.identify()
+    else:
+        device = EsptoolDevice(args.port, args.esptool)
+        port = args.port
+
+    record = FlashRecord(port)
+    with locked(record.filename):
+        try:
+            runs = flash_images(device, record, images, full=args.full, dry_run=args.dry_run)
+        except ValueError as e:
+            print('ERROR: {}'.format(e))
+            exit(1)
+    if runs is None:
+        print('ERROR: Writing to the flash failed, the next flash writes the affected sectors again')
+        exit(1)
+
+    changed = sum(len(data) // SECTOR_SIZE for address, data in runs)
+    print('{} {} of {} sectors{}'.format(
+        'Would write' if args.dry_run else 'Wrote',
+        changed, total,
+        ', flash is up to date' if changed == 0 else ''))
+    for address, data in runs:
+        print('  0x{:06x} - 0x{:06x} ({} KB)'.format(address, address + len(data), len(data) // 1024))
@@ -0,0 +1,164 @@
+from __future__ import print_function
+
+import os
+import shutil
+
+from esp8266_setup.runner import run
+from esp8266_setup.cache import cache_dir, cache_key, cache_limit, locked, prune, touch
+
+# files that are checked out in sparse checkouts in addition to the files the
+# definition lists
+SPARSE_EXTRA = [
+    '/library.json',
+    '/LICENSE*',
+    '/COPYING*',
+    '/README*',
+]
+
+
+def git(args, cwd=None, quiet=False):
+    """Run git, returns the exit code. Its output is shown if it failed,
+    unless quiet is set"""
+    result = run(['git'] + args, cwd=cwd)
+    if not result.ok and not quiet and len(result.output) > 0:
+        print(result.output.rstrip())
+    return result.returncode
+
+def is_branch(mirror, ref):
+    return git(['rev-parse', '--verify', '--quiet', 'refs/heads/' + ref], cwd=mirror, quiet=True) == 0
+
+def has_commit(mirror, ref):
+    return git(['rev-parse', '--verify', '--quiet', ref + '^{commit}'], cwd=mirror, quiet=True) == 0
+
+def git_mirror(url, ref, update=False):
+    """Make sure the mirror for url in the cache contains ref and return its
+    path. Commits and tags that are already known are served without touching
+    the network, branches are fetched as they move."""
+    directory = cache_dir('git')
+    path = os.path.join(directory, cache_key(url) + '.git')
+    with locked(path):
+        if not os.path.isdir(path):
+            print('Mirroring {} into cache...'.format(url))
+            if git(['clone', '--progress', '--mirror', url, path]) != 0:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                print('ERROR: Could not clone {}'.format(url))
+                exit(1)
+            fetched = True
+        elif update or not has_commit(path, ref) or is_branch(path, ref):
+            if git(['fetch', '--progress', '--prune', 'origin'], cwd=path) != 0:
+                if update:
+                    print('ERROR: Could not fetch {}'.format(url))
+                    exit(1)
+                print('WARNING: Could not update cached mirror of {}'.format(url))
+            fetched = True
+        else:
+            fetched = False
+        if fetched and not has_commit(path, ref):
+            print('ERROR: {} has no branch, tag or commit {}'.format(url, ref))
+            exit(1)
+        touch(path)
+    prune(directory, cache_limit(), keep=(path,))
+    return path
+
+def git_clone_cached(url, ref, destination):
+    """Check out ref of the repository at url into destination, borrowing all
+    objects from the shared mirror cache (hardlinked, so evicting the mirror
+    later on does not break the checkout)"""
+    mirror = git_mirror(url, ref)
+    if git(['clone', '--quiet', '--no-checkout', mirror, destination]) != 0:
+        print('ERROR: Could not clone {} from cache'.format(url))
+        exit(1)
+    git(['remote', 'set-url', 'origin', url], cwd=destination)
+    if git(['checkout', '--quiet', ref], cwd=destination) != 0:
+        print('ERROR: Could not check out {} of {}'.format(ref, url))
+        exit(1)
+
+def git_checkout_existing(url, ref, destination):
+    """Move a checkout that is already there to ref instead of cloning again"""
+    if is_shallow(destination):
+        git_update_shallow(ref, destination)
+        return
+    git_update_cached(url, ref, destination)
+    if git(['checkout', '--quiet', ref], cwd=destination) != 0:
+        print('ERROR: Could not check out {} of {}'.format(ref, url))
+        exit(1)
+
+def git_clone_sparse(url, ref, destination, paths):
+    """Fetch only the commit ref points to at depth 1 and check out only the
+    listed paths (plus license and readme files). Returns False if the server
+    refuses to hand out that commit, nothing is left behind in that case."""
+    os.makedirs(destination)
+    git(['init', '--quiet'], cwd=destination)
+    git(['remote', 'add', 'origin', url], cwd=destination)
+    git(['config', 'core.sparseCheckout', 'true'], cwd=destination)
+    with open(os.path.join(destination, '.git', 'info', 'sparse-checkout'), 'w') as fp:
+        for path in paths:
+            fp.write('/' + path.lstrip('/') + '\n')
+        for path in SPARSE_EXTRA:
+            fp.write(path + '\n')
+
+    if git(['fetch', '--progress', '--depth', '1', 'origin', ref], cwd=destination) != 0:
+        shutil.rmtree(destination)
+        return False
+    if git(['checkout', '--quiet', 'FETCH_HEAD'], cwd=destination) != 0:
+        print('ERROR: Could not check out {} of {}'.format(ref, url))
+        exit(1)
+    return True
+
+def is_shallow(destination):
+    return os.path.isfile(os.path.join(destination, '.git', 'shallow'))
+
+def git_update_shallow(ref, destination):
+    """Move a checkout made by `git_clone_sparse` to the current state of ref"""
+    if git(['fetch', '--progress', '--depth', '1', 'origin', ref], cwd=destination) != 0:
+        print('ERROR: Could not fetch {} into {}'.format(ref, destination))
+        exit(1)
+    if git(['reset', '--quiet', '--hard', 'FETCH_HEAD'], cwd=destination) != 0:
+        print('ERROR: Could not check out {} in {}'.format(ref, destination))
+        exit(1)
+
+def git_update_cached(url, ref, destination):
+    """Bring a checkout made by `git_clone_cached` up to date with its branch"""
+    mirror = git_mirror(url, ref, update=True)
+    if git(['reset', '--quiet', '--hard'], cwd=destination) != 0:
+        print('ERROR: Could not reset {}'.format(destination))
+        exit(1)
+    if git(['fetch', '--quiet', '--prune', mirror, '+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*'], cwd=destination) != 0:
+        print('ERROR: Could not fetch {} from cache'.format(url))
+        exit(1)
+    if git(['symbolic-ref', '--quiet', 'HEAD'], cwd=destination, quiet=True) == 0:
+        if git(['merge', '--quiet', '--ff-only', '@{u}'], cwd=destination) != 0:
+            print('ERROR: {} has diverged from {}, can not fast forward'.format(destination, url))
+            exit(1)
+
+def git_checkout_commit(url, ref, commit, destination, paths=None):
+    """Put the checkout in destination at exactly commit, fetching as little
+    as possible. If paths is given the checkout is a shallow sparse one."""
+    if paths is not None:
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        if git_clone_sparse(url, commit, destination, paths):
+            return
+        print('WARNING: Can not fetch {} of {} directly, falling back to a full clone'.format(commit, url))
+
+    if not os.path.isdir(destination):
+        mirror = git_mirror(url, commit)
+        if git(['clone', '--quiet', '--no-checkout', mirror, destination]) != 0:
+            print('ERROR: Could not clone {} from cache'.format(url))
+            exit(1)
+        git(['remote', 'set-url', 'origin', url], cwd=destination)
+    elif not has_commit(destination, commit):
+        mirror = git_mirror(url, commit)
+        git(['fetch', '--quiet', mirror, '+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*'], cwd=destination)
+
+    git(['reset', '--quiet', '--hard'], cwd=destination, quiet=True)
+    if git(['rev-parse', '--verify', '--quiet', 'refs/remotes/origin/' + ref], cwd=destination, quiet=True) == 0:
+        # keep the branch so updates still work
+        result = git(['checkout', '--quiet', '-B', ref, commit], cwd=destination)
+        git(['branch', '--quiet', '--set-upstream-to', 'origin/' + ref], cwd=destination)
+    else:
+        result = git(['checkout', '--quiet', commit], cwd=destination)
+    if result != 0:
+        print('ERROR: Could not check out {} of {}'.format(commit, url))
+        exit(1)
@@ -0,0 +1,297 @@
+from __future__ import print_function
+
+import os
+import re
+import json
+from glob import glob
+
+from esp8266_setup.makefile import Makefile, edit_makefile, write_atomic
+
+# include directives, `#include MACRO` can not be followed without a preprocessor
+DIRECTIVE = re.compile(r'^[ \t]*#[ \t]*(include|include_next)[ \t]*(?:"([^"]+)"|<([^>]+)>|(\S+))', re.M)
+
+
+class SearchDir(object):
+    """One include directory of a target, `variable` and `entry` tell how it
+    is written in the Makefile"""
+
+    def __init__(self, variable, entry, path):
+        self.variable = variable
+        self.entry = entry
+        self.path = path
+
+    @property
+    def flag(self):
+        return '-I' + self.path
+
+
+class Scanner(object):
+    """Follows the includes of translation units like the preprocessor does
+    (every header counted, conditionals are not evaluated) and counts the
+    file probes of the search"""
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.used = set()
+        self.probes = 0
+        self.computed = set()
+        self._directives = {}
+        self._exists = {}
+
+    def _isfile(self, path):
+        if path not in self._exists:
+            self._exists[path] = os.path.isfile(path)
+        return self._exists[path]
+
+    def directives(self, filename):
+        if filename not in self._directives:
+            try:
+                with open(filename, 'r') as fp:
+                    text = fp.read()
+            except (IOError, OSError, UnicodeDecodeError):
+                text = ''
+            result = []
+            for m in DIRECTIVE.finditer(text):
+                if m.group(4) is not None:
+                    self.computed.add(filename)
+                elif m.group(2) is not None:
+                    result.append((m.group(1), True, m.group(2)))
+                else:
+                    result.append((m.group(1), False, m.group(3)))
+            self._directives[filename] = result
+        return self._directives[filename]
+
+    def resolve(self, name, quoted, includer, start=0):
+        """(path, index of the search dir or None) of a header, path is None
+        for headers of the compiler"""
+        if quoted:
+            self.probes += 1
+            path = os.path.join(os.path.dirname(includer), name)
+            if self._isfile(path):
+                return path, None
+        for i in range(start, len(self.dirs)):
+            self.probes += 1
+            path = os.path.join(self.dirs[i].path, name)
+            if self._isfile(path):
+                self.used.add(i)
+                return path, i
+        return None, None
+
+    def scan(self, source):
+        seen = set()
+        stack = [(source, None)]
+        while len(stack) > 0:
+            filename, index = stack.pop()
+            if filename in seen:
+                continue
+            seen.add(filename)
+            for kind, quoted, name in self.directives(filename):
+                if kind == 'include_next':
+                    start = index + 1 if index is not None else 0
+                    path, i = self.resolve(name, False, filename, start)
+                else:
+                    path, i = self.resolve(name, quoted, filename)
+                if path is not None:
+                    stack.append((path, i))
+
+
+class Target(object):
+    """The app or a library: its sources and the include search path of its
+    compile command, in order"""
+
+    def __init__(self, name, sources, dirs, makefile=None):
+        self.name = name
+        self.sources = sources
+        self.makefile = makefile
+        # the compiler drops missing directories and repeated ones
+        self.dirs = []
+        self.missing = []
+        self.duplicates = []
+        seen = set()
+        for d in dirs:
+            real = os.path.realpath(d.path)
+            if not os.path.isdir(d.path):
+                self.missing.append(d)
+            elif real in seen:
+                self.duplicates.append(d)
+            else:
+                seen.add(real)
+                self.dirs.append(d)
+
+    def analyze(self):
+        scanner = Scanner(self.dirs)
+        for source in self.sources:
+            scanner.scan(source)
+        self.probes = scanner.probes
+        self.computed = sorted(scanner.computed)
+        self.needed = [d for i, d in enumerate(self.dirs) if i in scanner.used]
+
+        minimal = Scanner(self.needed)
+        for source in self.sources:
+            minimal.scan(source)
+        self.minimal_probes = minimal.probes
+
+    @property
+    def unused(self):
+        return [d for d in self.dirs if d not in self.needed] + self.missing + self.duplicates
+
+    @property
+    def minimizable(self):
+        """Headers included through macros may need any directory"""
+        return len(self.computed) == 0
+
+
+def sdk_path(path=None):
+    if path is None:
+        path = os.environ.get('SDK_PATH')
+    if path is None and os.path.isfile('toolchain.mk'):
+        with open('toolchain.mk', 'r') as fp:
+            mk = Makefile(fp.read())
+        if mk.has('SDK_PATH', op='?='):
+            path = mk.get('SDK_PATH', op='?=')
+    return path
+
+def _expand(entry, sdk):
+    return entry.replace('$(SDK_PATH)', sdk)
+
+def _split(value):
+    return [v for v in value.split(' ') if len(v) > 0]
+
+def sdk_dirs(variable, value, sdk):
+    return [SearchDir(variable, e, os.path.join(sdk, e)) for e in _split(value)]
+
+def app_target(mk, sdk):
+    src = mk.get('SRC_DIR')
+    libdir = mk.get('SRC_LIBDIR')
+    dirs = [SearchDir('SRC_DIR', src, src)]
+    for lib in _split(mk.get('SRC_LIBS')):
+        path = os.path.join(libdir, lib, 'include')
+        dirs.append(SearchDir('SRC_LIBS', lib, path))
+    dirs += sdk_dirs('SDK_INCDIR', mk.get('SDK_INCDIR'), sdk)
+    return Target('app', sorted(glob(os.path.join(src, '*.c'))), dirs, makefile='Makefile')
+
+def library_target(name, path, project_mk, sdk):
+    """Search path of a library built with its own Makefile, None if that
+    Makefile does not have the usual variables"""
+    filename = os.path.join(path, 'Makefile')
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as fp:
+        mk = Makefile(fp.read())
+    if not (mk.has('INCDIR', op=':=') and mk.has('LIB_SDK_INCDIR', op='?=')):
+        return None
+    dirs = []
+    entries = [(None, e) for e in _split(mk.get('INCDIR', op=':='))]
+    if mk.has('INCDIR', op='+='):
+        entries += [('INCDIR', e) for e in _split(mk.get('INCDIR', op='+='))]
+    for variable, entry in entries:
+        if entry.startswith('-I'):
+            directory = os.path.join(path, _expand(entry, sdk)[2:])
+            dirs.append(SearchDir(variable, entry, os.path.normpath(directory)))
+    dirs += sdk_dirs('LIB_SDK_INCDIR', mk.get('LIB_SDK_INCDIR', op='?='), sdk)
+    dirs += sdk_dirs('SDK_INCDIR', project_mk.get('SDK_INCDIR'), sdk)
+    return Target(name, sorted(glob(os.path.join(path, 'src', '*.c'))), dirs, makefile=filename)
+
+def _keep(target, variable, entries):
+    """Entries of a Makefile variable the target still needs, dropping only
+    directories proven unused"""
+    if not target.minimizable:
+        return entries
+    unused = set(d.entry for d in target.unused if d.variable == variable)
+    return [e for e in entries if e not in unused]
+
+def record_unused(target, filename):
+    """Remember the dropped entries in library.json, the flat build and
+    regenerated library Makefiles leave them out too. Returns True if the
+    file changed."""
+    with open(filename, 'r') as fp:
+        settings = json.load(fp)
+    unused = dict(settings.get('unused_includes', {}))
+    for variable in ('INCDIR', 'LIB_SDK_INCDIR'):
+        entries = set(unused.get(variable, [])) | set(d.entry for d in target.unused if d.variable == variable)
+        if len(entries) > 0:
+            unused[variable] = sorted(entries)
+    if len(unused) == 0 or unused == settings.get('unused_includes'):
+        return False
+    settings['unused_includes'] = unused
+    write_atomic(filename, json.dumps(settings, indent=4))
+    return True
+
+def rewrite(app, libraries, project_mk, complete=True):
+    """Write the minimal include settings, returns the list of changed files.
+    SDK_INCDIR is left alone unless all libraries were analyzed."""
+    changed = []
+    for target in libraries:
+        with edit_makefile(target.makefile) as mk:
+            if mk.has('INCDIR', op='+='):
+                mk.set('INCDIR', ' '.join(_keep(target, 'INCDIR', _split(mk.get('INCDIR', op='+=')))), op='+=')
+            mk.set('LIB_SDK_INCDIR', ' '.join(_keep(target, 'LIB_SDK_INCDIR', _split(mk.get('LIB_SDK_INCDIR', op='?=')))), op='?=')
+            if mk.changed:
+                changed.append(target.makefile)
+        settings = os.path.join(os.path.dirname(target.makefile), 'library.json')
+        if target.minimizable and os.path.isfile(settings) and record_unused(target, settings):
+            changed.append(settings)
+
+    # SDK_INCDIR is shared by the app and the libraries
+    if not complete:
+        return changed
+    entries = _split(project_mk.get('SDK_INCDIR'))
+    needed = set()
+    for target in [app] + libraries:
+        needed.update(_keep(target, 'SDK_INCDIR', entries))
+    with edit_makefile() as mk:
+        mk.set('SDK_INCDIR', ' '.join(e for e in entries if e in needed))
+        if mk.changed:
+            changed.append('Makefile')
+    return changed
+
+def _reduction(before, after):
+    return 100.0 * (before - after) / before if before > 0 else 0.0
+
+def print_target(target):
+    print('{}: {} of {} include directories needed, {} -> {} probes (-{:.0f}%)'.format(
+        target.name, len(target.needed), len(target.dirs) + len(target.missing) + len(target.duplicates),
+        target.probes, target.minimal_probes, _reduction(target.probes, target.minimal_probes)))
+    for d in target.unused:
+        note = ' (does not exist)' if d in target.missing else ' (duplicate)' if d in target.duplicates else ''
+        print('  unused: {}{}'.format(d.flag, note))
+    if not target.minimizable:
+        print('  kept everything, includes through macros in: {}'.format(', '.join(target.computed)))
+
+def analyze_includes(args):
+    if not os.path.exists('Makefile'):
+        print('ERROR: Not a project directory, enter the project directory first!')
+        exit(1)
+    sdk = sdk_path(args.sdk_path)
+    if sdk is None:
+        print('ERROR: Unknown SDK location, pass --sdk-path or run `esp8266-setup install-toolchain`')
+        exit(1)
+    with open('Makefile', 'r') as fp:
+        project_mk = Makefile(fp.read())
+
+    app = app_target(project_mk, sdk)
+    libraries = []
+    skipped = []
+    libdir = project_mk.get('SRC_LIBDIR')
+    for name in _split(project_mk.get('SRC_LIBS')):
+        target = library_target(name, os.path.join(libdir, name), project_mk, sdk)
+        if target is None:
+            print('WARNING: {} does not use the library Makefile template, skipped'.format(name))
+            skipped.append(name)
+            continue
+        libraries.append(target)
+
+    before, after = 0, 0
+    for target in [app] + libraries:
+        target.analyze()
+        print_target(target)
+        before += target.probes
+        after += target.minimal_probes if target.minimizable else target.probes
+    print('')
+    print('Total: {} -> {} preprocessor file probes with the minimal include paths (-{:.0f}%)'.format(before, after, _reduction(before, after)))
+
+    if args.write:
+        for filename in rewrite(app, libraries, project_mk, complete=len(skipped) == 0):
+            print('Updated {}'.format(filename))
+        if len(skipped) > 0:
+            print('SDK_INCDIR left unchanged, it is used by the skipped libraries too')
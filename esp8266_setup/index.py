@@ -0,0 +1,183 @@
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import threading
+from contextlib import contextmanager
+
+from esp8266_setup.lockfile import read_head
+from esp8266_setup.materialize import manifest_file
+
+# cache of what is installed in lib/, entries are invalidated by stat checks
+INDEX_FILE = os.path.join('.libs', 'index.json')
+
+# where `deferred_removal` moves the data of removed libraries
+REMOVED_DIR = os.path.join('.libs', '.removed')
+
+_removals = threading.local()
+
+
+def source_type(url):
+    if url.startswith('git+'):
+        return 'git'
+    elif url.startswith('http://') or url.startswith('https://'):
+        return 'archive download'
+    return 'local'
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+def signature(name):
+    """Everything that changes when a library is installed, converted,
+    updated or checked out at another commit"""
+    return [
+        _stat(os.path.join('lib', name, 'library.json')),
+        _stat(os.path.join('.libs', name, 'library.json')),
+        _stat(os.path.join('.libs', name, '.git', 'index')),
+        _stat(os.path.join('.libs', name, '.git', 'HEAD')),
+    ]
+
+
+class InstalledLibrary(object):
+    """An installed library as recorded in the index, creating one never
+    fetches, converts or links anything"""
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    @property
+    def name(self):
+        return self.entry['name']
+
+    @property
+    def version(self):
+        return self.library_info.get('version', '')
+
+    @property
+    def url(self):
+        return self.library_info.get('url', '')
+
+    @property
+    def source_type(self):
+        return source_type(self.url)
+
+    @property
+    def converted(self):
+        return not self.entry['native']
+
+    @property
+    def commit(self):
+        return self.entry['commit']
+
+    @property
+    def library_info(self):
+        return self.entry['library_info']
+
+    def load(self):
+        """The full `Library` object"""
+        from esp8266_setup.package import Library
+        return Library(self.name)
+
+    def remove_data(self):
+        remove_library_data(self.name)
+
+
+def remove_library_data(name):
+    """Delete checkout, installed files and manifest of a library, inside a
+    `deferred_removal` block they are only moved aside"""
+    print('Removing {}...'.format(name))
+    moved = getattr(_removals, 'moved', None)
+    for path in (os.path.join('lib', name), os.path.join('.libs', name), manifest_file(name)):
+        if not os.path.lexists(path):
+            continue
+        if moved is not None:
+            aside = os.path.join(REMOVED_DIR, str(len(moved)))
+            os.rename(path, aside)
+            moved.append((path, aside))
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+@contextmanager
+def deferred_removal():
+    """Removed libraries are deleted when the block ends without an error and
+    put back otherwise"""
+    if os.path.isdir(REMOVED_DIR):
+        shutil.rmtree(REMOVED_DIR)
+    os.makedirs(REMOVED_DIR)
+    _removals.moved = []
+    try:
+        yield
+    except BaseException:
+        for path, aside in reversed(_removals.moved):
+            # installed again after it was removed
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            os.rename(aside, path)
+        raise
+    finally:
+        _removals.moved = None
+        shutil.rmtree(REMOVED_DIR)
+
+def _entry(name, sig):
+    with open(os.path.join('lib', name, 'library.json'), 'r') as fp:
+        info = json.load(fp)
+    native = os.path.isfile(os.path.join('.libs', name, 'library.json'))
+    commit = None
+    if source_type(info.get('url', '')) == 'git':
+        commit = read_head(os.path.join('.libs', name))
+    return {
+        'name': info.get('name', name),
+        'library_info': info,
+        'native': native,
+        'commit': commit,
+        'signature': sig,
+    }
+
+def _load_index():
+    try:
+        with open(INDEX_FILE, 'r') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def installed_libraries():
+    """All libraries in lib/, served from the index where it is still valid"""
+    if not os.path.isdir('lib'):
+        return []
+    index = _load_index()
+    changed = False
+    result = []
+    names = sorted(d for d in os.listdir('lib') if os.path.isdir(os.path.join('lib', d)))
+    for name in names:
+        sig = signature(name)
+        entry = index.get(name)
+        if entry is None or entry['signature'] != sig:
+            try:
+                entry = _entry(name, sig)
+            except (IOError, OSError, ValueError) as e:
+                print('WARNING: Invalid library in {} !'.format(os.path.join('lib', name)))
+                print(e)
+                continue
+            index[name] = entry
+            changed = True
+        result.append(InstalledLibrary(entry))
+
+    for name in list(index.keys()):
+        if name not in names:
+            del index[name]
+            changed = True
+    if changed and os.path.isdir('.libs'):
+        tmp = INDEX_FILE + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(index, fp)
+        os.rename(tmp, INDEX_FILE)
+    return result
@@ -1,20 +1,117 @@
 from __future__ import print_function
 
 import os
-import re
 import json
+import argparse
 
-from esp8266_setup.tools import BASE_DIR, current_user, replace_placeholders
+from esp8266_setup.tools import BASE_DIR, current_user, replace_placeholders, write_if_changed
+from esp8266_setup.materialize import materialize
+from esp8266_setup.makefile import Makefile, edit_makefile, write_atomic
 
 
+class OrderedSet(list):
+    """Just enough of a set that keeps insertion order, so generated
+    Makefiles are stable between runs"""
+
+    def __init__(self, items=()):
+        list.__init__(self)
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self:
+            self.append(item)
+
+
+# dependency files used to be generated by a separate `$(CC) -M` pass
+DEPEND_MIGRATION = [
+    ("""$(BUILD_DIR)/%.o: %.c
+	$(vecho) "CC $<"
+	$(Q) $(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS) -c $< -o $@
+
+$(BUILD_DIR)/%.d: %.c $(BUILD_DIR)/src
+	$(vecho) "Depend $<"
+	$(Q) set -e; rm -f $@; \\
+	 $(CC) -M $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CPPFLAGS) $< > $@.$$$$; \\
+	 sed 's,\\(.*\\)\\.o[ :]*,$(BUILD_DIR)/$(dir $<)\\1.o $@: ,g' < $@.$$$$ > $@; \\
+	 rm -f $@.$$$$
+""", """$(BUILD_DIR)/%.o: %.c | $(BUILD_DIR)/src
+	$(vecho) "CC $<"
+	$(Q) $(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS) -MMD -MP -c $< -o $@
+"""),
+]
+
+# flags are tracked in a signature file so changing them rebuilds the library
+FLAGS_MIGRATION = [
+    ("""LIB_SDK_INCDIR  := $(addprefix -I$(SDK_PATH)/,$(LIB_SDK_INCDIR))
+
+V ?= $(VERBOSE)
+""", """LIB_SDK_INCDIR  := $(addprefix -I$(SDK_PATH)/,$(LIB_SDK_INCDIR))
+LIB_FLAGS       := $(BUILD_DIR)/lib.flags
+
+# signature of the effective flags, rewritten only when they change
+update-flags = $(shell mkdir -p $(dir $1) && printf '%s\\n' '$(subst ','\\'',$2)' | cmp -s - $1 || printf '%s\\n' '$(subst ','\\'',$2)' > $1)
+
+ifneq ($(MAKECMDGOALS),clean)
+$(call update-flags,$(LIB_FLAGS),$(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS))
+endif
+
+V ?= $(VERBOSE)
+"""),
+    ("""$(BUILD_DIR)/%.o: %.c | $(BUILD_DIR)/src
+""", """$(BUILD_DIR)/%.o: %.c $(LIB_FLAGS) | $(BUILD_DIR)/src
+"""),
+]
+
+# prebuilt archives are shared between projects through the user level cache
+ARCHIVE_MIGRATION = [
+    ("""$(call update-flags,$(LIB_FLAGS),$(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS))
+endif
+
+V ?= $(VERBOSE)
+""", """$(call update-flags,$(LIB_FLAGS),$(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS))
+endif
+
+# prebuilt archives come from the user level cache if available, set
+# LIB_CACHE to an empty value to always compile
+ifndef LIB_CACHE
+LIB_CACHE := $(shell command -v esp8266-setup)
+endif
+ifneq ($(LIB_CACHE),)
+ifneq ($(MAKECMDGOALS),clean)
+ifeq ($(wildcard $(TARGET)),)
+LIB_CACHED := $(shell $(LIB_CACHE) cache restore . $(BUILD_DIR) $(TARGET) $(LIB_FLAGS))
+endif
+endif
+endif
+
+V ?= $(VERBOSE)
+"""),
+    ("""	$(Q) $(AR) cru $@ $^
+
+checkdirs:""", """	$(Q) $(AR) cru $@ $^
+ifneq ($(LIB_CACHE),)
+	$(Q) $(LIB_CACHE) cache store . $(BUILD_DIR) $@ $(LIB_FLAGS) > /dev/null
+endif
+
+checkdirs:"""),
+]
+
+def migrate_makefile(mk):
+    """Bring a Makefile of an older library up to date with the
+    template, returns True if anything changed"""
+    migrated = False
+    for old, new in DEPEND_MIGRATION + FLAGS_MIGRATION + ARCHIVE_MIGRATION:
+        migrated = mk.replace(old, new) or migrated
+    return migrated
+
 def make_library_makefile(mk, args):
     # project name
-    m = re.search(r'^PROJECT[ \t]*:=[ \t]*[^\n]*$', mk, flags=re.MULTILINE)
-    mk = mk[:m.start()] + 'PROJECT     := ' + args.name + mk[m.end():]
+    if getattr(args, 'name', None) is not None:
+        mk.set('PROJECT', args.name, op=':=')
 
     # includes
-    m = re.search(r'^INCDIR[ \t]*\+=[ \t]*([^\n]*)$', mk, flags=re.MULTILINE)
-    includes = set(m.group(1).split(' '))
+    includes = OrderedSet(i for i in mk.get('INCDIR', op='+=').split(' ') if len(i) > 0)
 
     if args.sdk_dependencies is not None:
         deps = args.sdk_dependencies.split(',')
@@ -41,17 +138,23 @@ def make_library_makefile(mk, args):
     if args.include is not None:
         inc = args.include.split(' ')
         for i in inc:
-            includes.add(i)
-    mk = mk[:m.start()] + 'INCDIR      +=' + " ".join(includes) + mk[m.end():]
+            if len(i) > 0:
+                includes.add(i)
+
+    # directories `analyze-includes --write` found to be unused
+    unused = getattr(args, 'unused_includes', None) or {}
+    mk.set('INCDIR', " ".join(i for i in includes if i not in unused.get('INCDIR', [])), op='+=')
+    if len(unused.get('LIB_SDK_INCDIR', [])) > 0:
+        sdk_includes = [i for i in mk.get('LIB_SDK_INCDIR', op='?=').split(' ') if len(i) > 0]
+        mk.set('LIB_SDK_INCDIR', " ".join(i for i in sdk_includes if i not in unused['LIB_SDK_INCDIR']), op='?=')
 
     if args.cflags is not None:
-        m = re.search(r'^CFLAGS[ \t]*\+=[ \t]*[^\n]*$', mk, flags=re.MULTILINE)
-        mk = mk[:m.start()] + 'CFLAGS      += ' + args.cflags + mk[m.end():]
+        mk.set('CFLAGS', args.cflags, op='+=')
 
     return mk
 
 def make_library_json(obj, args):
-    if args.name is not None:
+    if getattr(args, 'name', None) is not None:
         obj['name'] = args.name
     if args.author is not None:
         obj['author'] = args.author
@@ -71,48 +174,89 @@ def make_library_json(obj, args):
         obj['extra_includes'] = args.include
     if args.version is not None:
         obj['version'] = args.version
+    if getattr(args, 'unused_includes', None):
+        obj['unused_includes'] = args.unused_includes
     return obj
 
 
-def start_library(args):
-    if os.path.exists(args.name):
-        print('ERROR: the path {} already exists, please use a different name or remove the file or directory!'.format(args.name))
-        exit(1)
-    os.mkdir(args.name)
-    os.mkdir(os.path.join(args.name, 'src'))
-    os.mkdir(os.path.join(args.name, 'include'))
-    with open(os.path.join(args.name, 'Makefile'), 'w') as fpo:
-        with open(os.path.join(BASE_DIR, "makefiles", "library.mk"), 'r') as fpi:
-            mk = make_library_makefile(fpi.read(), args)
-        fpo.write(mk)
-    with open(os.path.join(args.name, 'library.json'), 'w') as fp:
-        settings = make_library_json({}, args)
-        json.dump(settings, fp, indent=4)
-    with open(os.path.join(args.name, 'README.md'), 'w') as fpo:
+def write_library_files(directory, args):
+    """Generate Makefile and library.json of a library, files that would not
+    change are not touched to keep make from rebuilding. Returns True if
+    anything was written."""
+    with open(os.path.join(BASE_DIR, "makefiles", "library.mk"), 'r') as fpi:
+        mk = make_library_makefile(Makefile(fpi.read()), args)
+    changed = write_if_changed(os.path.join(directory, 'Makefile'), str(mk))
+    settings = json.dumps(make_library_json({}, args), indent=4)
+    changed = write_if_changed(os.path.join(directory, 'library.json'), settings) or changed
+    return changed
+
+
+def definition_args(definition, version='1.0.0'):
+    """Settings for a converted library from a library definition, in the
+    form `start-library` gets them from the command line"""
+    def flags(key):
+        value = definition.get(key, '')
+        return value + ' ' if value else ''
+
+    return argparse.Namespace(
+        name=definition['name'],
+        author=definition.get('author', current_user()),
+        license=definition.get('license', 'BSD-2-Clause'),
+        url=definition.get('url', ''),
+        version=version,
+        dependencies=",".join(definition.get('dependencies', [])),
+        sdk_dependencies=",".join(definition.get('sdk_dependencies', [])),
+        cflags=flags('extra_cflags'),
+        ldflags=flags('extra_ldflags'),
+        include=flags('extra_includes'),
+        unused_includes=definition.get('unused_includes'),
+    )
+
+def make_library(directory, args, skeleton=True):
+    """Create the directory structure, Makefile and library.json of a library
+    and, if skeleton is set, the template readme, license and source files"""
+    os.mkdir(directory)
+    os.mkdir(os.path.join(directory, 'src'))
+    os.mkdir(os.path.join(directory, 'include'))
+    write_library_files(directory, args)
+    if not skeleton:
+        return
+    with open(os.path.join(directory, 'README.md'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "skel", "library.md"), 'r') as fpi:
             url = args.url if args.url is not None and len(args.url) > 0 else "<unknown URL>"
             fpo.write(replace_placeholders(fpi.read(), project=args.name, url=url))
-    with open(os.path.join(args.name, 'LICENSE.txt'), 'w') as fpo:
+    with open(os.path.join(directory, 'LICENSE.txt'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "skel", "BSD.txt"), 'r') as fpi:
             fpo.write(replace_placeholders(fpi.read()))
-    with open(os.path.join(args.name, 'src', args.name + '.c'), 'w') as fpo:
+    with open(os.path.join(directory, 'src', args.name + '.c'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "skel", "library.c"), 'r') as fpi:
             fpo.write(replace_placeholders(fpi.read(), project=args.name))
-    with open(os.path.join(args.name, 'include', args.name + '.h'), 'w') as fpo:
+    with open(os.path.join(directory, 'include', args.name + '.h'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "skel", "library.h"), 'r') as fpi:
             fpo.write(replace_placeholders(fpi.read(), project=args.name))
 
+def convert_definition(definition, directory, files, version='1.0.0', manifest=None):
+    """Build a converted library in directory from a library definition in one
+    pass, files is a list of (original file, file in the library) pairs that
+    are materialized into the library and recorded in manifest"""
+    make_library(directory, definition_args(definition, version), skeleton=False)
+    materialize(files, manifest)
+
+
+def start_library(args):
+    if os.path.exists(args.name):
+        print('ERROR: the path {} already exists, please use a different name or remove the file or directory!'.format(args.name))
+        exit(1)
+    make_library(args.name, args)
+
 def modify_library(args):
     if not os.path.exists('library.json'):
         print('ERROR: Not a library directory, enter the library directory first!')
         exit(1)
-    with open('Makefile', 'r+') as fp:
-        mk = make_library_makefile(fp.read(), args)
-        fp.seek(0)
-        fp.truncate()
-        fp.write(mk)
-    with open('library.json', 'r+') as fp:
-        settings = make_library_json(json.load(fp), args)
-        fp.seek(0)
-        fp.truncate()
-        json.dump(settings, fp, indent=4)
+    with edit_makefile() as mk:
+        if migrate_makefile(mk):
+            print('Migrated Makefile to the current template')
+        make_library_makefile(mk, args)
+        with open('library.json', 'r') as fp:
+            settings = make_library_json(json.load(fp), args)
+        write_atomic('library.json', json.dumps(settings, indent=4))
@@ -0,0 +1,155 @@
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+LOCKFILE = 'esp8266-setup.lock'
+
+# what is actually installed in .libs and lib, written together with the lockfile
+STATE_FILE = os.path.join('.libs', 'installed.json')
+
+_deferred = threading.local()
+
+
+def definition_hash(definition):
+    if definition is None:
+        return None
+    return hashlib.sha256(json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_head(repo):
+    """Commit a git checkout is at, read directly from the repository so this
+    works without spawning git and without network access"""
+    git_dir = os.path.join(repo, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as fp:
+            head = fp.read().strip()
+    except (IOError, OSError):
+        return None
+    if not head.startswith('ref: '):
+        return head
+    ref = head[5:]
+    try:
+        with open(os.path.join(git_dir, ref), 'r') as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as fp:
+            for line in fp:
+                parts = line.strip().split(' ')
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+def _load(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as fp:
+        return json.load(fp).get('libraries', {})
+
+def _save(filename, libraries):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump({'version': 1, 'libraries': libraries}, fp, indent=4, sort_keys=True)
+    os.rename(tmp, filename)
+
+def load_lockfile():
+    pending = getattr(_deferred, 'files', None)
+    return pending[0] if pending is not None else _load(LOCKFILE)
+
+def load_state():
+    pending = getattr(_deferred, 'files', None)
+    return pending[1] if pending is not None else _load(STATE_FILE)
+
+def _write(lock, state):
+    _save(LOCKFILE, lock)
+    if os.path.isdir('.libs'):
+        _save(STATE_FILE, state)
+
+@contextmanager
+def deferred():
+    """Collect the changes to lockfile and install state, they are written
+    when the block ends without an error"""
+    _deferred.files = (_load(LOCKFILE), _load(STATE_FILE))
+    try:
+        yield
+        lock, state = _deferred.files
+    finally:
+        _deferred.files = None
+    _write(lock, state)
+
+def definition_source(lib):
+    """Where the definition of a library came from, recorded so it can be
+    found again in other checkouts of the project: the registry name or a
+    path relative to the project"""
+    if lib.registry_name is not None:
+        return {'registry': lib.registry_name}
+    if lib.definition_file is not None:
+        return {'path': os.path.relpath(lib.definition_file)}
+    return None
+
+def library_entry(lib):
+    """Lockfile entry for a freshly installed or updated library"""
+    checkout = os.path.join('.libs', lib.name)
+    definition = lib.library_info
+    if not lib.converted:
+        # native libraries bring their own definition
+        with open(os.path.join(checkout, 'library.json'), 'r') as fp:
+            definition = json.load(fp)
+    entry = {
+        'url': lib.url,
+        'source_type': lib.source_type,
+        'native': not lib.converted,
+        'definition': definition,
+        'definition_sha256': definition_hash(definition),
+        'definition_source': definition_source(lib),
+    }
+    if lib.source_type == 'git':
+        entry['commit'] = read_head(checkout)
+        entry['shallow'] = os.path.isfile(os.path.join(checkout, '.git', 'shallow'))
+    elif lib.source_type == 'archive download':
+        entry['archive_sha256'] = getattr(lib, 'archive_sha256', None)
+    return entry
+
+def record(libs, removed=()):
+    """Write lockfile and install state for the libraries that were just
+    installed or updated, entries of other libraries are kept. Inside a
+    `deferred` block nothing is written yet."""
+    lock = load_lockfile()
+    state = load_state()
+    for lib in libs:
+        if lib.converted and 'source' not in lib.library_info:
+            # loaded from the converted library, keep what we know
+            continue
+        entry = library_entry(lib)
+        lock[lib.name] = entry
+        state[lib.name] = entry
+    for name in removed:
+        lock.pop(name, None)
+        state.pop(name, None)
+    if getattr(_deferred, 'files', None) is None:
+        _write(lock, state)
+
+def check(name, entry, state):
+    """Returns a list of things that do not match between a lockfile entry and
+    what is on disk, empty if the library is up to date"""
+    reasons = []
+    installed = state.get(name)
+    if not os.path.isdir(os.path.join('lib', name)):
+        reasons.append('not installed')
+    if entry['source_type'] != 'local' and not os.path.isdir(os.path.join('.libs', name)):
+        reasons.append('source missing')
+    elif entry['source_type'] == 'git':
+        if read_head(os.path.join('.libs', name)) != entry['commit']:
+            reasons.append('commit changed')
+    elif entry['source_type'] == 'archive download':
+        if installed is None or installed.get('archive_sha256') != entry.get('archive_sha256'):
+            reasons.append('archive changed')
+    if installed is None or installed.get('definition_sha256') != entry['definition_sha256']:
+        reasons.append('definition changed')
+    return reasons
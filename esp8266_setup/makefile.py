@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+from esp8266_setup.cache import cache_dir, cache_key, locked
+
+
+class Makefile(object):
+    """Editable model of a generated Makefile. Variable assignments can be read
+    and replaced, everything else is kept verbatim."""
+
+    def __init__(self, text):
+        self.lines = text.split('\n')
+        self.original = text
+
+    def _find(self, name, op):
+        pattern = re.compile(r'^' + re.escape(name) + r'([ \t]*)' + re.escape(op) + r'([ \t]*)(.*)$')
+        for i, line in enumerate(self.lines):
+            m = pattern.match(line)
+            if m:
+                end = i
+                while self.lines[end].endswith('\\') and end + 1 < len(self.lines):
+                    end += 1
+                return i, end, m
+        return None, None, None
+
+    def has(self, name, op='='):
+        return self._find(name, op)[0] is not None
+
+    def get(self, name, op='='):
+        """Value of the first `name op value` assignment"""
+        start, end, m = self._find(name, op)
+        if start is None:
+            raise KeyError(name)
+        value = [m.group(3)] + [l.strip() for l in self.lines[start + 1:end + 1]]
+        return " ".join(v.rstrip('\\').strip() for v in value).strip()
+
+    def set(self, name, value, op='='):
+        """Replace the value of the first `name op value` assignment, the
+        alignment of the original line is kept"""
+        start, end, m = self._find(name, op)
+        if start is None:
+            raise KeyError(name)
+        self.lines[start:end + 1] = [name + m.group(1) + op + ' ' + value]
+
+    def insert_after(self, name, lines, op='='):
+        """Insert lines after the first `name op value` assignment"""
+        start, end, m = self._find(name, op)
+        if start is None:
+            raise KeyError(name)
+        self.lines[end + 1:end + 1] = lines
+
+    def replace(self, old, new):
+        """Replace a verbatim block of text, returns False if it was not found"""
+        text = str(self)
+        if old not in text:
+            return False
+        self.lines = text.replace(old, new, 1).split('\n')
+        return True
+
+    @property
+    def changed(self):
+        return str(self) != self.original
+
+    def __str__(self):
+        return '\n'.join(self.lines)
+
+
+_transactions = threading.local()
+
+def write_atomic(filename, content):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fp:
+        fp.write(content)
+    os.rename(tmp, filename)
+
+@contextmanager
+def edit_makefile(filename='Makefile'):
+    """Transaction on a Makefile: it is locked against concurrent invocations,
+    parsed once, all edits go to the yielded model and it is written back
+    atomically when the outermost transaction ends without an error. Nested
+    transactions on the same file share the model."""
+    filename = os.path.abspath(filename)
+    open_transactions = getattr(_transactions, 'open', None)
+    if open_transactions is None:
+        open_transactions = _transactions.open = {}
+    if filename in open_transactions:
+        yield open_transactions[filename]
+        return
+
+    # the lock lives in the user cache so no lock file is left in the project
+    lockfile = os.path.join(cache_dir('locks'), cache_key(filename))
+    with locked(lockfile):
+        with open(filename, 'r') as fp:
+            mk = Makefile(fp.read())
+        open_transactions[filename] = mk
+        try:
+            yield mk
+        finally:
+            del open_transactions[filename]
+        if mk.changed:
+            write_atomic(filename, str(mk))
@@ -0,0 +1,188 @@
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import errno
+import threading
+
+from esp8266_setup.tools import parallel_map
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl that clones a file on copy-on-write file systems (btrfs, xfs) on Linux
+FICLONE = 0x40049409
+
+# strategies, cheapest first
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY = 'copy'
+STRATEGIES = [HARDLINK, REFLINK, COPY]
+
+# trees with fewer files are not worth starting threads for
+PARALLEL_THRESHOLD = 32
+JOBS = 8
+
+# strategies that failed between two devices are not tried again
+_failed = {}
+
+# errors that mean a strategy does not work between two file systems, other
+# errors (e.g. too many links to one file) only affect the file at hand
+UNSUPPORTED = set(getattr(errno, e) for e in ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOTTY', 'ENOSYS') if hasattr(errno, e))
+_lock = threading.Lock()
+
+
+def manifest_file(name):
+    """Where the files materialized into lib/<name> are recorded"""
+    return os.path.join('.libs', name + '.files.json')
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _reflink(source, destination):
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (IOError, OSError):
+            dst.close()
+            os.remove(destination)
+            raise
+    shutil.copymode(source, destination)
+
+def _kernel_copy(src, dst, size):
+    """Copy with copy_file_range or sendfile, returns False if neither is
+    available or works for these files"""
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if name == 'copy_file_range':
+                    n = func(src, dst, size - copied, copied, copied)
+                else:
+                    n = func(dst, src, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            continue
+        if copied == size:
+            return True
+    return False
+
+def _copy(source, destination):
+    """Copy in the kernel where possible, in user space otherwise"""
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if not _kernel_copy(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size):
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst)
+    shutil.copymode(source, destination)
+
+_OPERATIONS = {
+    HARDLINK: os.link,
+    REFLINK: _reflink,
+    COPY: _copy,
+}
+
+def place(source, destination):
+    """Make destination have the content of source with the cheapest strategy
+    that works, replacing destination atomically. Returns the strategy."""
+    _makedirs(os.path.dirname(destination))
+    tmp = destination + '.tmp'
+    devices = (os.stat(source).st_dev, os.stat(os.path.dirname(destination)).st_dev)
+    for strategy in STRATEGIES:
+        if strategy != COPY and strategy in _failed.get(devices, ()):
+            continue
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            _OPERATIONS[strategy](source, tmp)
+        except (IOError, OSError) as e:
+            if strategy == COPY:
+                raise
+            if e.errno in UNSUPPORTED:
+                with _lock:
+                    _failed.setdefault(devices, set()).add(strategy)
+            continue
+        os.rename(tmp, destination)
+        return strategy
+
+def load_manifest(filename):
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def materialize(pairs, manifest=None):
+    """Place every (source, destination) pair, in parallel for large trees.
+    Files that did not change since they were recorded in the manifest are
+    skipped, destinations that are recorded but no longer wanted are removed.
+    Returns a dict of counts per strategy plus `unchanged` and `removed`."""
+    recorded = load_manifest(manifest) if manifest else {}
+
+    def run(pair):
+        source, destination = pair
+        source_sig = _signature(source)
+        if source_sig is None:
+            raise IOError(errno.ENOENT, 'No such file', source)
+        entry = recorded.get(destination)
+        destination_sig = _signature(destination)
+        if entry is not None and entry[0] == source_sig and entry[1] == destination_sig:
+            return destination, 'unchanged', entry
+        if entry is None and destination_sig is not None and os.path.samefile(source, destination):
+            return destination, 'unchanged', [source_sig, destination_sig]
+        strategy = place(source, destination)
+        return destination, strategy, [source_sig, _signature(destination)]
+
+    jobs = JOBS if len(pairs) >= PARALLEL_THRESHOLD else 1
+    results = parallel_map(run, pairs, jobs=jobs)
+
+    counts = dict((s, 0) for s in STRATEGIES + ['unchanged', 'removed'])
+    wanted = {}
+    for destination, strategy, entry in results:
+        counts[strategy] += 1
+        wanted[destination] = entry
+    for destination in recorded:
+        if destination not in wanted and os.path.isfile(destination):
+            os.remove(destination)
+            counts['removed'] += 1
+
+    if manifest:
+        tmp = manifest + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(wanted, fp)
+        os.rename(tmp, manifest)
+    return counts
+
+def tree(source_dir, destination_dir, exclude=('.git',)):
+    """(source, destination) pairs mirroring all files of a directory"""
+    pairs = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if d not in exclude)
+        relative = os.path.relpath(root, source_dir)
+        for f in sorted(files):
+            pairs.append((
+                os.path.join(root, f),
+                os.path.normpath(os.path.join(destination_dir, relative, f)),
+            ))
+    return pairs
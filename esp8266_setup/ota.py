@@ -0,0 +1,183 @@
+from __future__ import print_function
+
+import zlib
+import struct
+import hashlib
+
+from esp8266_setup.flash import SECTOR_SIZE
+
+# header: magic, format version, zlib window bits, old size, new size,
+# sha1 of the old and of the new image
+DELTA_MAGIC = b'ESPD'
+DELTA_VERSION = 1
+HEADER = struct.Struct('<4sBBII20s20s')
+
+# operations in the compressed stream:
+# add: new bytes are old bytes at an offset plus a (mostly zero) difference
+# insert: new bytes that are not in the old image
+OP_ADD = 1
+OP_INSERT = 2
+OP = struct.Struct('<BII')
+
+# length of the byte sequences the old image is indexed by, only every
+# STEP-th position is indexed to keep the index small
+BLOCK = 8
+STEP = 4
+
+# an add operation ends after this many bytes without a better match
+FUZZ = 64
+
+# zlib needs about 7 KB for the inflate state besides its window
+INFLATE_STATE = 7 * 1024
+
+
+class DeltaError(Exception):
+    pass
+
+
+def _index(old):
+    index = {}
+    for i in range((len(old) - BLOCK) // STEP * STEP, -1, -STEP):
+        index[old[i:i + BLOCK]] = i
+    return index
+
+def _extend(old, new, old_pos, new_pos):
+    """Length of the approximate match starting at old_pos and new_pos,
+    bytes that differ are fine as long as most of them are equal"""
+    limit = min(len(old) - old_pos, len(new) - new_pos)
+    score = best_score = best = 0
+    i = 0
+    while i < limit and i - best <= FUZZ:
+        if old[old_pos + i] == new[new_pos + i]:
+            score += 1
+            if score > best_score:
+                best_score, best = score, i + 1
+        else:
+            score -= 1
+        i += 1
+    return best
+
+def diff(old, new):
+    """Operations turning `old` into `new` as a list of (op, old offset, data)"""
+    old = bytearray(old)
+    new = bytearray(new)
+    index = _index(bytes(old))
+    ops = []
+    literal = bytearray()
+    i = 0
+    while i < len(new):
+        pos = index.get(bytes(new[i:i + BLOCK])) if i + BLOCK <= len(new) else None
+        if pos is None:
+            literal.append(new[i])
+            i += 1
+            continue
+        length = _extend(old, new, pos, i)
+        if len(literal) > 0:
+            ops.append((OP_INSERT, 0, bytes(literal)))
+            literal = bytearray()
+        ops.append((OP_ADD, pos, bytes(bytearray((new[i + k] - old[pos + k]) & 0xff for k in range(length)))))
+        i += length
+    if len(literal) > 0:
+        ops.append((OP_INSERT, 0, bytes(literal)))
+    return ops
+
+def make(old, new, window=15):
+    """Compressed delta image from `old` to `new`"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, window)
+    body = []
+    for op, offset, data in diff(old, new):
+        body.append(compressor.compress(OP.pack(op, offset, len(data))))
+        body.append(compressor.compress(data))
+    body.append(compressor.flush())
+    header = HEADER.pack(DELTA_MAGIC, DELTA_VERSION, window, len(old), len(new),
+                         hashlib.sha1(old).digest(), hashlib.sha1(new).digest())
+    return header + b''.join(body)
+
+def apply(old, delta):
+    """The new image, raises DeltaError if `old` is not the image the delta
+    was made for or the result does not match"""
+    if len(delta) < HEADER.size:
+        raise DeltaError('delta is truncated')
+    magic, version, window, old_size, new_size, old_hash, new_hash = HEADER.unpack(delta[:HEADER.size])
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+        raise DeltaError('not a delta image')
+    if len(old) != old_size or hashlib.sha1(old).digest() != old_hash:
+        raise DeltaError('delta was made for another firmware image')
+    try:
+        decompressor = zlib.decompressobj(window)
+        stream = decompressor.decompress(delta[HEADER.size:])
+    except (zlib.error, ValueError) as e:
+        raise DeltaError('delta is corrupt: {}'.format(e))
+    if not getattr(decompressor, 'eof', True):
+        raise DeltaError('delta is truncated')
+    if len(decompressor.unused_data) > 0:
+        raise DeltaError('delta is corrupt: data after the end of the stream')
+
+    old = bytearray(old)
+    new = bytearray()
+    pos = 0
+    while pos < len(stream):
+        if pos + OP.size > len(stream):
+            raise DeltaError('delta is corrupt: truncated operation at {}'.format(pos))
+        op, offset, length = OP.unpack(stream[pos:pos + OP.size])
+        pos += OP.size
+        if pos + length > len(stream) or len(new) + length > new_size:
+            raise DeltaError('delta is corrupt: operation at {} is too long'.format(pos - OP.size))
+        data = bytearray(stream[pos:pos + length])
+        pos += length
+        if op == OP_ADD:
+            if offset + length > len(old):
+                raise DeltaError('delta is corrupt: copy from 0x{:x} is outside of the old image'.format(offset))
+            new.extend((old[offset + k] + data[k]) & 0xff for k in range(length))
+        elif op == OP_INSERT:
+            new.extend(data)
+        else:
+            raise DeltaError('delta is corrupt: unknown operation {}'.format(op))
+    new = bytes(new)
+    if len(new) != new_size or hashlib.sha1(new).digest() != new_hash:
+        raise DeltaError('result does not match the new firmware image')
+    return new
+
+def apply_memory(window):
+    """RAM a device needs to apply a delta: the inflate window and state and
+    one sector to collect output in, old data is read from the flash"""
+    return (1 << window) + INFLATE_STATE + SECTOR_SIZE
+
+
+def _read(filename):
+    try:
+        with open(filename, 'rb') as fp:
+            return fp.read()
+    except (IOError, OSError) as e:
+        print('ERROR: Could not read {}: {}'.format(filename, e))
+        exit(1)
+
+def make_delta(args):
+    old = _read(args.old)
+    new = _read(args.new)
+    delta = make(old, new, args.window)
+    with open(args.output, 'wb') as fp:
+        fp.write(delta)
+    print('Delta written to {}'.format(args.output))
+    print('  new image     {:>8} bytes'.format(len(new)))
+    print('  full, zlib    {:>8} bytes'.format(len(zlib.compress(new, 9))))
+    print('  delta         {:>8} bytes ({:.1f}% of the new image)'.format(len(delta), 100.0 * len(delta) / max(1, len(new))))
+    print('  RAM to apply  {:>8} bytes ({} bytes zlib window)'.format(apply_memory(args.window), 1 << args.window))
+
+def apply_delta(args):
+    old = _read(args.old)
+    delta = _read(args.delta)
+    try:
+        new = apply(old, delta)
+    except DeltaError as e:
+        print('ERROR: {}'.format(e))
+        exit(1)
+    if args.verify is not None and _read(args.verify) != new:
+        print('ERROR: Result differs from {}'.format(args.verify))
+        exit(1)
+    if args.output is not None:
+        with open(args.output, 'wb') as fp:
+            fp.write(new)
+        print('New image written to {}'.format(args.output))
+    else:
+        print('Delta applies cleanly, result matches the new firmware image')
@@ -3,15 +3,46 @@ from __future__ import print_function
 import os
 import json
 import shutil
-import re
-
-from esp8266_setup.tools import BASE_DIR    
+from functools import partial
+
+from esp8266_setup.tools import parallel_map, Progress, timed
+from esp8266_setup.materialize import materialize, manifest_file, tree, STRATEGIES
+from esp8266_setup.dependencies import resolve, link_order, spec_name, read_definition, DependencyError
+from esp8266_setup.git import git_clone_cached, git_checkout_existing, git_update_cached, git_clone_sparse, git_update_shallow, is_shallow, git_checkout_commit
+from esp8266_setup.download import cached_download, unpack, sha256_file, DownloadError
+from esp8266_setup.library import write_library_files, definition_args, convert_definition
+from esp8266_setup.index import installed_libraries, remove_library_data, source_type
+from esp8266_setup.registry import find_definition
+from esp8266_setup.makefile import edit_makefile
+from esp8266_setup.build import write_build_file
+from esp8266_setup.runner import run, library_context
+from esp8266_setup import lockfile
+
+# documents that are taken over from the original source when converting
+DOCUMENT_CANDIDATES = [
+    'LICENSE-BSD.txt',
+    'LICENSE-MIT.txt',
+    'LICENSE-Apache.txt',
+    'LICENSE-GPL.txt',
+    'LICENSE.txt',
+    'LICENSE',
+    'COPYING',
+    'README.txt',
+    'README.md',
+    'README.markdown',
+    'README.rst',
+    'README',
+]
 
 class Library(object):
 
-    def __init__(self, name):
+    def __init__(self, name, shallow=False):
         self.library_info = None
         self.definition_location = None
+        self.definition_file = None
+        self.registry_name = None
+        self.archive_sha256 = None
+        self.shallow = shallow
         ok = self.parse_url(name)
 
         if not ok:
@@ -19,51 +50,104 @@ class Library(object):
                 # if it ends in json, assume local file
                 print('Importing local library definition for {}'.format(name))
                 self.definition_location = os.path.dirname(name)
+                self.definition_file = os.path.abspath(name)
                 self.load_definition(name)
             else:
-                # try to find in repo that comes with the distribution
-                lib_file = os.path.join(BASE_DIR, 'libs', name + '.json')
-                if os.path.isfile(lib_file):
-                    print('Using distributed library definition for {}'.format(name))
+                # try to find in the registry (distributed definitions and ESP8266_SETUP_REGISTRY)
+                found = find_definition(name)
+                if found is not None:
+                    definition, lib_file, index = found
+                    print('Using registry library definition for {}'.format(name))
+                    self.registry_name = name
                     self.definition_location = os.path.dirname(lib_file)
-                    self.load_definition(lib_file)
+                    # definitions in index files can not be reloaded on their own
+                    self.definition_file = None if index else lib_file
+                    self.use_definition(definition)
                 else:
                     raise AttributeError('Unable to find library with name {}'.format(name))
+
+    @classmethod
+    def from_definition(cls, definition, location=None, shallow=False, filename=None, registry_name=None):
+        """Install a library from an already loaded definition (e.g. the one
+        recorded in the lockfile)"""
+        lib = cls.__new__(cls)
+        lib.library_info = None
+        lib.definition_location = location
+        lib.definition_file = filename
+        lib.registry_name = registry_name
+        lib.archive_sha256 = None
+        lib.shallow = shallow
+        lib.use_definition(definition)
+        return lib
     
     def update(self):
         print('Updating {}...'.format(self.name))
         if self.converted:
-            shutil.rmtree(os.path.join('lib', self.name))
+            old_plan = self.conversion_plan()
             self._update()
-            self.convert_library()
+            self.reload_definition()
+            if os.path.isfile(os.path.join('lib', self.name, 'library.json')):
+                self.update_converted(old_plan)
+            else:
+                self.convert_library()
         else:
             self._update()
-        # TODO: reload library definition file
+            self.link_library()
+
+    def reload_definition(self):
+        """Pick up changes to the definition file without installing anything"""
+        if self.definition_file and os.path.isfile(self.definition_file):
+            with open(self.definition_file, 'r') as fp:
+                self.library_info = json.load(fp)
+
+    def update_converted(self, old_plan):
+        """Bring an already converted library in line with the updated source,
+        only files that were added, removed or changed are touched"""
+        if self.conversion_script:
+            self.run_conversion_script()
+
+        new_plan = self.conversion_plan()
+        targets = set(d for _, d in new_plan)
+        removed = 0
+        if not os.path.isfile(manifest_file(self.name)):
+            # converted before manifests were recorded
+            for _, d in old_plan:
+                if d not in targets and os.path.isfile(d):
+                    os.remove(d)
+                    removed += 1
+        added = sum(1 for d in targets if not os.path.isfile(d))
+        counts = materialize(new_plan, manifest_file(self.name))
+        changed = sum(counts[s] for s in STRATEGIES) - added
+        removed += counts['removed']
+
+        if write_library_files(os.path.join('lib', self.name), definition_args(self.library_info, self.conversion_version)):
+            print('{}: library settings changed'.format(self.name))
+        print('{}: {} files changed, {} added, {} removed'.format(self.name, changed, added, removed))
         
     def _update(self):
         if self.url.startswith('git+'):
-            os.system('cd .libs/{}; git reset --hard ; git pull origin'.format(self.name))
+            url, branch = self.url[4:].rsplit('@', 1)
+            destination = os.path.join('.libs', self.name)
+            if is_shallow(destination):
+                git_update_shallow(branch, destination)
+            else:
+                git_update_cached(url, branch, destination)
         elif self.url.startswith('http://') or self.url.startswith('https://'):
-            # TODO: ask server if a newer version is available
-            pass
+            try:
+                archive, changed = cached_download(self.url, sha256=self.library_info.get('sha256'), revalidate=True)
+                if changed or not os.path.isdir(os.path.join('.libs', self.name)):
+                    unpack(archive, os.path.join('.libs', self.name))
+                self.archive_sha256 = sha256_file(archive)
+            except DownloadError as e:
+                print('ERROR: {}'.format(e))
+                exit(1)
     
     def remove_data(self):
-        print('Removing {}...'.format(self.name))
-        dirs = [
-            os.path.join('lib', self.name),
-            os.path.join('.libs', self.name),
-        ]
-        for d in dirs:
-            if os.path.isdir(d):
-                shutil.rmtree(d)
+        remove_library_data(self.name)
     
     @property
     def source_type(self):
-        if self.url.startswith('git+'):
-            return 'git'
-        elif self.url.startswith('http://') or self.url.startswith('https://'):
-            return 'archive download'
-        return 'local'
+        return source_type(self.url)
 
     @property
     def converted(self):
@@ -90,8 +174,19 @@ class Library(object):
         else:
             name = self.name
 
-        os.system('cd .libs; git clone {} {}'.format(url, name))
-        os.system('cd .libs/{}; git checkout {}'.format(name, branch))
+        destination = os.path.join('.libs', name)
+        if os.path.isdir(os.path.join(destination, '.git')):
+            git_checkout_existing(url, branch, destination)
+        elif self.shallow and self.library_info is not None:
+            # we know which files we need, so fetch only those
+            paths = self.source + self.include
+            if self.library_info.get('run_script'):
+                paths.append(self.run_script)
+            if not git_clone_sparse(url, branch, destination, paths):
+                print('WARNING: Can not fetch {} of {} directly, falling back to a full clone'.format(branch, url))
+                git_clone_cached(url, branch, destination)
+        else:
+            git_clone_cached(url, branch, destination)
 
         definition_file = os.path.join('.libs', name, 'library.json')
         if os.path.isfile(definition_file):
@@ -101,13 +196,22 @@ class Library(object):
             exit(1)
 
     def download(self, url):
-        _, name = url.rsplit('/', 1)
-        name, ext = os.path.splitext(name)
+        if self.library_info is None:
+            name = spec_name(url)
+            sha256 = None
+        else:
+            name = self.name
+            sha256 = self.library_info.get('sha256')
 
-        # TODO: download
-        # TODO: unpack
+        try:
+            archive, _ = cached_download(url, sha256=sha256)
+            unpack(archive, os.path.join('.libs', name))
+            self.archive_sha256 = sha256_file(archive)
+        except DownloadError as e:
+            print('ERROR: {}'.format(e))
+            exit(1)
 
-        definition_file = os.path.join('lib', name, 'library.json')
+        definition_file = os.path.join('.libs', name, 'library.json')
         if os.path.isfile(definition_file):
             self.load_definition(definition_file)
         elif self.library_info is None:
@@ -115,11 +219,15 @@ class Library(object):
             exit(1)
 
     def link_library(self):
-        os.link(os.path.join('.libs', self.name), os.path.join('lib', self.name))
+        """Mirror a native library from .libs into lib"""
+        materialize(tree(os.path.join('.libs', self.name), os.path.join('lib', self.name)), manifest_file(self.name))
 
     def load_definition(self, filename):
         with open(filename, 'r') as fp:
-            self.library_info = json.load(fp)
+            self.use_definition(json.load(fp))
+
+    def use_definition(self, definition):
+        self.library_info = definition
 
         # already downloaded?
         if not self.data_available():
@@ -151,91 +259,48 @@ class Library(object):
             return False
         return True
 
-    def convert_library(self):
-        # run conversion script
-        if self.conversion_script:
-            cmd = 'cd .libs/{}; chmod a+x {}; {}'.format(self.name, self.conversion_script, self.conversion_script)
-            os.system(cmd)
-
-        version = '1.0.0'
-        if self.source_type == 'git':
-            version = 'git'
-        
-        # create new library
-        cmd = 'cd lib; esp8266-setup start-library --author "{author}" --license "{license}" --url "{url}" --version "{ver}"'.format(
-            author=self.author,
-            license=self.license,
-            url=self.url,
-            ver=version
-        )
+    def run_conversion_script(self):
+        script = self.conversion_script
+        os.chmod(script, os.stat(script).st_mode | 0o111)
+        result = run([script], cwd=os.path.join('.libs', self.name), capture=False)
+        if not result.ok:
+            print('ERROR: Conversion script of {} failed with exit code {}'.format(self.name, result.returncode))
+            exit(1)
 
-        if len(self.dependencies) > 0:
-            cmd += ' --dependencies "{}"'.format(",".join(self.dependencies))
-        if len(self.sdk_dependencies) > 0:
-            cmd += ' --sdk-dependencies "{}"'.format(",".join(self.sdk_dependencies))
-        if self.extra_cflags:
-            cmd += ' --cflags "{} "'.format(self.extra_cflags)
-        if self.extra_ldflags:
-            cmd += ' --ldflags "{} "'.format(self.extra_ldflags)
-        if self.extra_includes:
-            cmd += ' --include "{} "'.format(self.extra_includes)
-
-        cmd += ' ' + self.name
-
-        print(cmd)
-        os.system(cmd)
-
-        # remove the default crap
-        crap = [
-            os.path.join('lib', self.name, 'README.md'),
-            os.path.join('lib', self.name, 'LICENSE.txt'),
-            os.path.join('lib', self.name, 'src', self.name + '.c'),
-            os.path.join('lib', self.name, 'include', self.name + '.h'),
-        ]
-        for c in crap:
-            os.remove(c)
-        
-        # link readme and license documents from original
-        candidates = [
-            os.path.join('.libs', self.name, 'LICENSE-BSD.txt'),
-            os.path.join('.libs', self.name, 'LICENSE-MIT.txt'),
-            os.path.join('.libs', self.name, 'LICENSE-Apache.txt'),
-            os.path.join('.libs', self.name, 'LICENSE-GPL.txt'),
-            os.path.join('.libs', self.name, 'LICENSE.txt'),
-            os.path.join('.libs', self.name, 'LICENSE'),
-            os.path.join('.libs', self.name, 'COPYING'),
-            os.path.join('.libs', self.name, 'README.txt'),
-            os.path.join('.libs', self.name, 'README.md'),
-            os.path.join('.libs', self.name, 'README.markdown'),
-            os.path.join('.libs', self.name, 'README.rst'),
-            os.path.join('.libs', self.name, 'README'),
-        ]
-        for c in candidates:
-            if os.path.isfile(c):
-                d = os.path.join('lib', self.name, os.path.basename(c))
-                os.link(c, d)
-
-        # link source
+    @property
+    def conversion_version(self):
+        return 'git' if self.source_type == 'git' else '1.0.0'
+
+    def conversion_plan(self):
+        """List of (file in .libs, file in lib) pairs for a converted library"""
+        source_dir = os.path.join('.libs', self.name)
+        target_dir = os.path.join('lib', self.name)
+        plan = []
+        for c in DOCUMENT_CANDIDATES:
+            if os.path.isfile(os.path.join(source_dir, c)):
+                plan.append((os.path.join(source_dir, c), os.path.join(target_dir, c)))
         for src in self.source:
-            s = os.path.join('.libs', self.name, src)
-            d = os.path.join('lib', self.name, 'src', os.path.basename(src))
-            os.link(s, d)
-        
-        # link includes
+            plan.append((os.path.join(source_dir, src), os.path.join(target_dir, 'src', os.path.basename(src))))
         for inc in self.include:
-            s = os.path.join('.libs', self.name, inc)
+            s = os.path.join(source_dir, inc)
             if inc.startswith('include/') or inc.startswith('include\\'):
                 inc = inc[8:]
-            try:
-                os.makedirs(os.path.join('lib', self.name, 'include', os.path.dirname(inc)))
-            except OSError as e:
-                if e.errno == 17:
-                    pass
-                else:
-                    print('ERROR: Could not create directory')
-                    exit(1)
-            d = os.path.join('lib', self.name, 'include', inc)
-            os.link(s, d)
+            plan.append((s, os.path.join(target_dir, 'include', inc)))
+        return plan
+
+    def convert_library(self):
+        # run conversion script
+        if self.conversion_script:
+            self.run_conversion_script()
+
+        print('Converting {}...'.format(self.name))
+        convert_definition(
+            self.library_info,
+            os.path.join('lib', self.name),
+            self.conversion_plan(),
+            version=self.conversion_version,
+            manifest=manifest_file(self.name)
+        )
 
     def data_available(self):
         return os.path.isdir(os.path.join('.libs', self.library_info['name']))
@@ -247,48 +312,164 @@ class Library(object):
 
 
 def load_installed_libs():
-    libs = [d for d in os.listdir('lib') if os.path.isdir(os.path.join('lib', d))]
-
-    result = []
-    for lib in libs:
-        try:
-            l = Library(lib)
-            result.append(l)
-        except AttributeError as e:
-            print('WARNING: Invalid library in {} !'.format(os.path.join('lib', lib)))
-            print(e)
-
-    return result
+    """Installed libraries from the index, use `.load()` on an entry to get the
+    full `Library` object"""
+    return installed_libraries()
 
 def rewrite_makefile(mk, libs):
-    # update src libs
-    libs = " ".join([l.name for l in libs])
-    m = re.search(r'^SRC_LIBS[ \t]*=[ \t]*[^\n]*$', mk, flags=re.MULTILINE)
-    mk = mk[:m.start()] + 'SRC_LIBS     = ' + libs + mk[m.end():]
+    # update src libs, in link order
+    libs = " ".join([l.name for l in link_order(libs)])
+    mk.set('SRC_LIBS', libs)
+    if mk.has('LIB_BUILD') and mk.get('LIB_BUILD') == 'flat':
+        write_build_file()
     
     return mk
 
+def read_library_list(filename):
+    """Read a project level library list, one library name, definition file
+    or URL per line, `#` starts a comment"""
+    result = []
+    with open(filename, 'r') as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if len(line) > 0:
+                result.append(line)
+    return result
+
+def installed_names():
+    if not os.path.isdir('lib'):
+        return set()
+    return set(d for d in os.listdir('lib') if os.path.isdir(os.path.join('lib', d)))
+
+def remove_new_libraries(before):
+    """Take back the libraries installed since `installed_names` returned
+    before, used when a batch fails"""
+    for name in sorted(installed_names() - before):
+        print('Removing {} again...'.format(name))
+        for d in (os.path.join('lib', name), os.path.join('.libs', name)):
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+        if os.path.isfile(manifest_file(name)):
+            os.remove(manifest_file(name))
+
+def check_batch(operations):
+    """Names that remove-library or update-library operations of a batch
+    refer to, which are neither installed nor added earlier in the batch"""
+    known = installed_names()
+    unknown = []
+    for args in operations:
+        if args.operation == 'add-library':
+            pending = list(args.library)
+            if args.file is not None and os.path.isfile(args.file):
+                pending.extend(read_library_list(args.file))
+            while len(pending) > 0:
+                spec = pending.pop()
+                name = spec_name(spec)
+                if name in known:
+                    continue
+                known.add(name)
+                definition = read_definition(spec)
+                if definition is not None:
+                    pending.extend(definition.get('dependencies', []))
+        elif args.operation in ('remove-library', 'update-library'):
+            if args.library not in known:
+                unknown.append(args.library)
+            elif args.operation == 'remove-library':
+                known.discard(args.library)
+    return unknown
+
+def load_library(spec, shallow=False):
+    with library_context(spec_name(spec)):
+        return Library(spec, shallow=shallow)
+
+def install_libraries(names, jobs=1, shallow=False):
+    """Install multiple libraries concurrently, returns a tuple of the list of
+    installed libraries and the list of names that failed"""
+    progress = Progress(len(names))
+
+    def install(name):
+        try:
+            with library_context(spec_name(name)):
+                lib, duration = timed(Library, name, shallow=shallow)
+        except SystemExit:
+            progress.step('{} failed'.format(name))
+            return name, None
+        except Exception as e:
+            progress.step('{} failed: {}'.format(name, e))
+            return name, None
+        progress.step('{} installed in {:.2f}s'.format(lib.name, duration))
+        return name, lib
+
+    results = parallel_map(install, names, jobs)
+    installed = [lib for _, lib in results if lib is not None]
+    failed = [name for name, lib in results if lib is None]
+    return installed, failed
+
+def install_with_dependencies(names, jobs=1, shallow=False):
+    """Resolve the dependencies of the libraries and install everything in
+    topological order, independent libraries are installed in parallel"""
+    try:
+        graph = resolve(names, partial(load_library, shallow=shallow), jobs=jobs)
+        levels = graph.levels()
+    except DependencyError as e:
+        print('ERROR: {}'.format(e))
+        exit(1)
+    print('Resolved {} libraries: {}'.format(
+        len(graph.nodes),
+        ", ".join(n.name for level in levels for n in level)
+    ))
+
+    installed = []
+    failed = []
+    for level in levels:
+        ready = []
+        for node in level:
+            missing = [d for d in node.dependencies if d in failed]
+            if len(missing) > 0:
+                print('ERROR: Not installing {}, dependencies failed: {}'.format(node.name, ", ".join(missing)))
+                failed.append(node.name)
+            elif node.library is not None:
+                installed.append(node.library)
+            else:
+                ready.append(node)
+        libs, failed_specs = install_libraries([n.spec for n in ready], jobs=jobs, shallow=shallow)
+        installed.extend(libs)
+        failed.extend(n.name for n in ready if n.spec in failed_specs)
+    return installed, failed
+
 def add_library(args):
     if not os.path.isfile('Makefile'):
         print("Not a project directory, please enter project first!")
         exit(1)
 
-    with open('Makefile', 'r+') as fp:
-        mk = fp.read()
+    names = list(args.library)
+    if args.file is not None:
+        names.extend(read_library_list(args.file))
+    if len(names) == 0:
+        print('ERROR: No libraries to add, supply a library or a library list with --file!')
+        exit(1)
+
+    # drop duplicates but keep the order
+    names = [n for i, n in enumerate(names) if n not in names[:i]]
+
+    with edit_makefile() as mk:
         libs = load_installed_libs()
-        libs.append(Library(args.library))
-        mk = rewrite_makefile(mk, libs)
-        fp.seek(0)
-        fp.truncate()
-        fp.write(mk)
+        installed, failed = install_with_dependencies(names, jobs=args.jobs, shallow=args.shallow)
+        names = [l.name for l in installed]
+        libs = [l for l in libs if l.name not in names] + installed
+        rewrite_makefile(mk, libs)
+    lockfile.record(installed)
+
+    if len(failed) > 0:
+        print('ERROR: Could not install {}'.format(", ".join(failed)))
+        exit(1)
 
 def remove_library(args):
     if not os.path.isfile('Makefile'):
         print("Not a project directory, please enter project first!")
         exit(1)
 
-    with open('Makefile', 'r+') as fp:
-        mk = fp.read()
+    with edit_makefile() as mk:
         libs = load_installed_libs()
         
         lib_to_remove = None
@@ -303,30 +484,144 @@ def remove_library(args):
         lib_to_remove.remove_data()
         libs = [l for l in libs if l != lib_to_remove]
 
-        mk = rewrite_makefile(mk, libs)
-        fp.seek(0)
-        fp.truncate()
-        fp.write(mk)
+        rewrite_makefile(mk, libs)
+    lockfile.record([], removed=[args.library])
+
+def definition_paths(entry):
+    """Tuple of directory, file and registry name of the definition a
+    lockfile entry was installed from, found again on this machine"""
+    name = entry['definition']['name']
+    source = entry.get('definition_source')
+    if source is None:
+        # lockfiles written before sources were recorded have absolute paths
+        found = find_definition(name)
+        if found is not None and os.path.dirname(found[1]) == entry.get('definition_location'):
+            source = {'registry': name}
+        else:
+            return entry.get('definition_location'), entry.get('definition_file'), None
+    if 'registry' in source:
+        found = find_definition(source['registry'])
+        if found is None:
+            return None, None, source['registry']
+        _, filename, index = found
+        return os.path.dirname(filename), None if index else filename, source['registry']
+    filename = os.path.abspath(source['path'])
+    return os.path.dirname(filename), filename, None
+
+def library_from_lock(entry):
+    location, filename, registry_name = definition_paths(entry)
+    if location is None and 'run_script' in entry['definition']:
+        print('ERROR: Can not find the definition of {} to run its conversion script'.format(entry['definition']['name']))
+        exit(1)
+    lib = Library.from_definition(
+        entry['definition'],
+        location,
+        shallow=entry.get('shallow', False),
+        filename=filename,
+        registry_name=registry_name
+    )
+    if lib.archive_sha256 is None:
+        lib.archive_sha256 = entry.get('archive_sha256')
+    return lib
+
+def sync_library(name, entry):
+    """Bring one library to the state recorded in the lockfile"""
+    checkout = os.path.join('.libs', name)
+    if entry['source_type'] == 'git':
+        if lockfile.read_head(checkout) != entry['commit']:
+            url, ref = entry['url'][4:].rsplit('@', 1)
+            paths = None
+            if entry.get('shallow'):
+                definition = entry['definition']
+                paths = definition['source'] + definition['include']
+                if definition.get('run_script'):
+                    paths.append(definition['run_script'])
+            git_checkout_commit(url, ref, entry['commit'], checkout, paths)
+    elif entry['source_type'] == 'archive download':
+        try:
+            archive, _ = cached_download(entry['url'], sha256=entry['archive_sha256'])
+            unpack(archive, checkout)
+        except DownloadError as e:
+            print('ERROR: {}'.format(e))
+            exit(1)
+
+    # re-create the library from the checkout
+    target = os.path.join('lib', name)
+    if os.path.islink(target) or os.path.isfile(target):
+        os.remove(target)
+    elif os.path.isdir(target):
+        shutil.rmtree(target)
+    return library_from_lock(entry)
+
+def sync(args):
+    if not os.path.isfile('Makefile'):
+        print("Not a project directory, please enter project first!")
+        exit(1)
+
+    lock = lockfile.load_lockfile()
+    if len(lock) == 0:
+        print('ERROR: No {} found, add some libraries first!'.format(lockfile.LOCKFILE))
+        exit(1)
+    state = lockfile.load_state()
+
+    outdated = []
+    for name in sorted(lock.keys()):
+        reasons = lockfile.check(name, lock[name], state)
+        if len(reasons) > 0:
+            print('{}: {}'.format(name, ", ".join(reasons)))
+            outdated.append(name)
+    if os.path.isdir('lib'):
+        for name in sorted(os.listdir('lib')):
+            if name not in lock and os.path.isdir(os.path.join('lib', name)):
+                print('WARNING: {} is installed but not in {}'.format(name, lockfile.LOCKFILE))
+
+    if len(outdated) == 0:
+        print('All libraries up to date')
+        return
+
+    progress = Progress(len(outdated))
+
+    def sync_one(name):
+        try:
+            with library_context(name):
+                lib, duration = timed(sync_library, name, lock[name])
+        except SystemExit:
+            progress.step('{} failed'.format(name))
+            return None
+        except Exception as e:
+            progress.step('{} failed: {}'.format(name, e))
+            return None
+        progress.step('{} synced in {:.2f}s'.format(name, duration))
+        return lib
+
+    synced = [l for l in parallel_map(sync_one, outdated, args.jobs) if l is not None]
+    with edit_makefile() as mk:
+        rewrite_makefile(mk, load_installed_libs())
+    lockfile.record(synced)
+
+    if len(synced) != len(outdated):
+        exit(1)
 
 def update_library(args):
     if not os.path.isfile('Makefile'):
         print("Not a project directory, please enter project first!")
         exit(1)
 
-    with open('Makefile', 'r+') as fp:
-        mk = fp.read()
+    with edit_makefile() as mk, library_context(args.library):
         libs = load_installed_libs()
 
-        # update
-        lib_to_update = Library(args.library)
+        # update, the lockfile knows the original definition of imported libraries
+        entry = lockfile.load_lockfile().get(args.library)
+        if entry is not None and not entry['native']:
+            lib_to_update = library_from_lock(entry)
+        else:
+            lib_to_update = Library(args.library)
         lib_to_update.update()
         libs = [l for l in libs if l.name != args.library]
         libs.append(lib_to_update)
         
-        mk = rewrite_makefile(mk, libs)
-        fp.seek(0)
-        fp.truncate()
-        fp.write(mk)
+        rewrite_makefile(mk, libs)
+    lockfile.record([lib_to_update])
 
 def show_libraries(args):
     if not os.path.isfile('Makefile'):
@@ -343,4 +638,7 @@ def show_libraries(args):
         typ = 'native'
         if lib.converted:
             typ = 'imported'
-        print('{} -> {} ({}, {})'.format(lib.name, lib.version, typ, lib.source_type))
\ No newline at end of file
+        if lib.commit:
+            print('{} -> {} ({}, {} {})'.format(lib.name, lib.version, typ, lib.source_type, lib.commit[:10]))
+        else:
+            print('{} -> {} ({}, {})'.format(lib.name, lib.version, typ, lib.source_type))
\ No newline at end of file
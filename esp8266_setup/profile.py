@@ -0,0 +1,222 @@
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+from multiprocessing import cpu_count
+
+from esp8266_setup.runner import run
+
+# make runs every recipe line through this script when profiling, it times
+# the line and appends an event to the file in ESP8266_SETUP_PROFILE. It runs
+# once per recipe line, so it only uses what python can load without site.
+SHELL_WRAPPER = """#!{python} -S
+import os, sys, time, json, subprocess
+
+# called as `shell --target=<target> -c <recipe line>`
+target = sys.argv[1][len('--target='):]
+command = sys.argv[-1].strip()
+if len(target) == 0 or command.startswith({setup_commands!r}):
+    os.execv('/bin/sh', ['/bin/sh'] + sys.argv[2:])
+
+start = time.time()
+# keep the jobserver file descriptors open for sub-makes
+result = subprocess.call(['/bin/sh'] + sys.argv[2:], close_fds=False)
+end = time.time()
+event = json.dumps({{'target': target, 'command': command, 'cwd': os.getcwd(), 'start': start, 'end': end}})
+# one short write with O_APPEND, concurrent jobs do not interleave
+with open(os.environ['ESP8266_SETUP_PROFILE'], 'a') as fp:
+    fp.write(event + '\\n')
+sys.exit(result)
+"""
+
+# recipe lines that only print or prepare something
+SETUP_COMMANDS = ('echo ', 'mkdir ', 'true', 'if [', 'rm ', 'touch ')
+
+STEP_KINDS = ['compile', 'archive', 'link', 'elf2image']
+
+
+def step_kind(event):
+    target = event['target']
+    command = event['command']
+    if 'elf2image' in command:
+        return 'elf2image'
+    if os.path.basename(command.split(' ', 1)[0]) == 'make':
+        return 'make'
+    if target.endswith('.o'):
+        return 'compile'
+    if target.endswith('.a'):
+        return 'archive'
+    if target.endswith('.elf'):
+        return 'link'
+    return 'other'
+
+def step_owner(event, libs):
+    """The library a build step belongs to, or `app`"""
+    lib_dir = os.path.abspath('lib') + os.sep
+    if event['cwd'].startswith(lib_dir):
+        # recursive library build
+        return event['cwd'][len(lib_dir):].split(os.sep)[0]
+    target = os.path.relpath(os.path.join(event['cwd'], event['target']))
+    name = os.path.basename(target)
+    if name.startswith('lib') and name.endswith('.a') and name[3:-2] in libs:
+        return name[3:-2]
+    parts = target.split(os.sep)
+    for i, part in enumerate(parts[:-1]):
+        if part == 'lib' and parts[i + 1] in libs:
+            return parts[i + 1]
+    return 'app'
+
+def load_events(log, libs):
+    events = []
+    with open(log, 'r') as fp:
+        for line in fp:
+            event = json.loads(line)
+            event['kind'] = step_kind(event)
+            event['owner'] = step_owner(event, libs)
+            event['duration'] = event['end'] - event['start']
+            events.append(event)
+    events.sort(key=lambda e: e['start'])
+    return events
+
+
+def write_trace(events, filename):
+    """Chrome trace/Perfetto JSON, steps are spread over lanes so parallel
+    steps show up side by side"""
+    origin = min(e['start'] for e in events)
+    lanes = {1: [], 2: []}
+    trace = []
+    for e in events:
+        pid = 2 if e['kind'] == 'make' else 1
+        for lane, busy_until in enumerate(lanes[pid]):
+            if busy_until <= e['start']:
+                break
+        else:
+            lanes[pid].append(0)
+            lane = len(lanes[pid]) - 1
+        lanes[pid][lane] = e['end']
+        trace.append({
+            'name': '{} {}'.format(e['kind'], os.path.basename(e['target'])),
+            'cat': e['owner'],
+            'ph': 'X',
+            'ts': int((e['start'] - origin) * 1000000),
+            'dur': int(e['duration'] * 1000000),
+            'pid': pid,
+            'tid': lane,
+            'args': {'target': e['target'], 'library': e['owner']},
+        })
+    trace.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'build steps'}})
+    trace.append({'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'library sub-makes'}})
+    directory = os.path.dirname(filename)
+    if len(directory) > 0 and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as fp:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fp)
+
+def serial_steps(steps):
+    """Steps nothing else ran in parallel with"""
+    result = []
+    for e in steps:
+        if not any(o is not e and o['start'] < e['end'] and o['end'] > e['start'] for o in steps):
+            result.append(e)
+    return result
+
+def print_summary(events, wall):
+    steps = [e for e in events if e['kind'] in STEP_KINDS]
+    busy = sum(e['duration'] for e in steps)
+    print('Build took {:.2f}s, {:.2f}s spent in {} steps (parallelism {:.1f})'.format(
+        wall, busy, len(steps), busy / wall if wall > 0 else 0))
+    if len(steps) == 0:
+        return
+
+    owners = sorted(set(e['owner'] for e in steps), key=lambda o: (o != 'app', o))
+    print('')
+    print('{:<20}'.format('') + ''.join('{:>11}'.format(k) for k in STEP_KINDS + ['total']))
+    for owner in owners:
+        own = [e for e in steps if e['owner'] == owner]
+        times = [sum(e['duration'] for e in own if e['kind'] == k) for k in STEP_KINDS]
+        print('{:<20}'.format(owner) + ''.join('{:>10.2f}s'.format(t) for t in times + [sum(times)]))
+
+    print('')
+    print('Slowest translation units:')
+    compiles = sorted((e for e in steps if e['kind'] == 'compile'), key=lambda e: -e['duration'])
+    for e in compiles[:10]:
+        print('  {:>8.2f}s  {} ({})'.format(e['duration'], os.path.relpath(os.path.join(e['cwd'], e['target'])), e['owner']))
+
+    serial = serial_steps(steps)
+    if len(serial) > 0:
+        print('')
+        print('Steps that ran alone ({:.2f}s total):'.format(sum(e['duration'] for e in serial)))
+        for e in sorted(serial, key=lambda e: -e['duration'])[:10]:
+            print('  {:>8.2f}s  {} {} ({})'.format(e['duration'], e['kind'], os.path.basename(e['target']), e['owner']))
+
+
+def make_version(make):
+    """(major, minor) of GNU make, None if it is not GNU make"""
+    try:
+        result = run([make, '--version'])
+    except OSError:
+        return None
+    m = re.search(r'GNU Make (\d+)\.(\d+)', result.output)
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+def run_make(jobs, make_args, profile_log=None):
+    command = [os.environ.get('MAKE', 'make'), '-j{}'.format(jobs or cpu_count())]
+    env = os.environ.copy()
+    wrapper_dir = None
+    if profile_log is not None:
+        wrapper_dir = tempfile.mkdtemp(prefix='esp8266-setup-profile')
+        wrapper = os.path.join(wrapper_dir, 'shell')
+        with open(wrapper, 'w') as fp:
+            fp.write(SHELL_WRAPPER.format(python=sys.executable, setup_commands=SETUP_COMMANDS))
+        os.chmod(wrapper, 0o755)
+        command += ['SHELL=' + wrapper, '.SHELLFLAGS=--target=$@ -c']
+        env['ESP8266_SETUP_PROFILE'] = profile_log
+    try:
+        return run(command + make_args, capture=False, timeout=None, env=env).returncode
+    finally:
+        if wrapper_dir is not None:
+            shutil.rmtree(wrapper_dir)
+
+def build(args):
+    if not os.path.exists('Makefile'):
+        print('ERROR: Not a project directory, enter the project directory first!')
+        exit(1)
+    if not args.profile:
+        result = run_make(args.jobs, args.make_args)
+        if result != 0:
+            exit(result)
+        return
+
+    # the recipes only reach the profiling shell through .SHELLFLAGS, older
+    # make ignores it and the build would report no steps at all
+    make = os.environ.get('MAKE', 'make')
+    version = make_version(make)
+    if version is None or version < (3, 82):
+        print('ERROR: build --profile needs GNU make 3.82 or newer, {} is {}'.format(
+            make, 'not GNU make' if version is None else '{}.{}'.format(*version)))
+        exit(1)
+
+    libs = set(d for d in os.listdir('lib') if os.path.isdir(os.path.join('lib', d))) if os.path.isdir('lib') else set()
+    fd, log = tempfile.mkstemp(prefix='esp8266-setup-profile', suffix='.jsonl')
+    os.close(fd)
+    try:
+        start = time.time()
+        result = run_make(args.jobs, args.make_args, profile_log=log)
+        wall = time.time() - start
+        events = load_events(log, libs)
+    finally:
+        os.remove(log)
+
+    print('')
+    print_summary(events, wall)
+    if len(events) > 0:
+        write_trace(events, args.trace)
+        print('')
+        print('Trace written to {}, open it in chrome://tracing or ui.perfetto.dev'.format(args.trace))
+    if result != 0:
+        exit(result)
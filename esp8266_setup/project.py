@@ -1,21 +1,171 @@
 from __future__ import print_function
 
 import os
-import re
+import argparse
 
 from esp8266_setup.tools import BASE_DIR, current_user, replace_placeholders
+from esp8266_setup.makefile import Makefile, edit_makefile
+from esp8266_setup.build import write_build_file
+from esp8266_setup.library import migrate_makefile as migrate_library_makefile
+from esp8266_setup.package import add_library
+
+# every new project starts with this library
+DEFAULT_LIBRARY = 'git+https://github.com/esp8266-setup/minic.git@master'
+
+# library rules of Makefiles generated before LIB_BUILD existed
+RECURSIVE_LIB_RULES = """libdirs: $(LIB_SRC_DIRS) 
+
+$(LIB_SRC_DIRS):
+	$(MAKE) -C $@ BUILD_DIR="$(BUILD_BASE)/$@"
+"""
+
+LIB_BUILD_RULES = """ifeq ($(LIB_BUILD),flat)
+include build.mk
+
+build.mk: $(wildcard $(SRC_LIBDIR)/*/library.json)
+	$(vecho) "GEN $@"
+	$(Q) esp8266-setup generate-build
+	$(Q) touch $@
+
+libdirs: $(FLAT_LIB_ARCHIVES)
+
+$(TARGET1) $(TARGET2): $(FLAT_LIB_ARCHIVES)
+else
+""" + RECURSIVE_LIB_RULES + """endif
+"""
+
+# dependency files used to be generated by a separate `$(CC) -M` pass
+DEPEND_MIGRATION = [
+    ("""$1/%.o: %.c
+	$(vecho) "CC $$<"
+	$(Q) $(CC) $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CFLAGS) -c $$< -o $$@
+""", """$1/%.o: %.c | $1
+	$(vecho) "CC $$<"
+	$(Q) $(CC) $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CFLAGS) -MMD -MP -c $$< -o $$@
+"""),
+    ("""define make-depend
+$1/%.d: %.c checkdirs
+	$(vecho) "Depend $$<"
+	$(Q) set -e; rm -f $$@; \\
+	 $(CC) -M $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CPPFLAGS) $$< > $$@.$$$$$$$$; \\
+	 sed 's,\\(.*\\)\\.o[ :]*,$(BUILD_BASE)/$$(dir $$<)\\1.o $$@: ,g' < $$@.$$$$$$$$ > $$@; \\
+	 rm -f $$@.$$$$$$$$
+endef
+
+""", ""),
+    ("""$(foreach bdir,$(BUILD_DIR),$(eval $(call make-depend,$(bdir))))
+include $(DEP)
+""", """-include $(DEP)
+"""),
+]
+
+# flags are tracked in signature files so changing them rebuilds what they affect
+FLAGS_MIGRATION = [
+    ("""vpath %.c $(SRC_DIR)
+
+define compile-objects
+$1/%.o: %.c | $1
+""", """vpath %.c $(SRC_DIR)
+
+# signature of the effective flags of a build step, rewritten only when they
+# change so everything that depends on it is rebuilt exactly then
+update-flags = $(shell mkdir -p $(dir $1) && printf '%s\\n' '$(subst ','\\'',$2)' | cmp -s - $1 || printf '%s\\n' '$(subst ','\\'',$2)' > $1)
+
+APP_FLAGS   := $(BUILD_BASE)/app.flags
+LINK_FLAGS  := $(BUILD_BASE)/link.flags
+ifneq ($(MAKECMDGOALS),clean)
+$(call update-flags,$(APP_FLAGS),$(CC) $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CFLAGS))
+$(call update-flags,$(LINK_FLAGS),$(LD) $(SDK_LIBDIR) $(LD_SCRIPTS) $(LDFLAGS) $(LIBS) $(SRC_LD_LIBS))
+endif
+
+define compile-objects
+$1/%.o: %.c $(APP_FLAGS) | $1
+"""),
+    ("""$(TARGET1): $(APP_AR)
+""", """$(TARGET1): $(APP_AR) $(LINK_FLAGS)
+"""),
+    ("""$(TARGET2): $(APP_AR)
+""", """$(TARGET2): $(APP_AR) $(LINK_FLAGS)
+"""),
+]
+
+# flashing used to write every image completely
+FLASH_MIGRATION = [
+    (""".PHONY: all checkdirs flash clean libdirs $(LIB_SRC_DIRS)
+""", """.PHONY: all checkdirs flash flash-full clean libdirs $(LIB_SRC_DIRS)
+"""),
+    ("""flash: $(TARGET1) $(TARGET2)
+	$(ESPTOOL) --port $(SERIALPORT) write_flash $(WRITE_FLASH)
+""", """# only writes the flash sectors that changed since the last flash of the port,
+# flash-full always writes everything
+flash: $(TARGET1) $(TARGET2)
+	esp8266-setup flash --port $(SERIALPORT) --esptool $(ESPTOOL) $(WRITE_FLASH)
+
+flash-full: $(TARGET1) $(TARGET2)
+	$(ESPTOOL) --port $(SERIALPORT) write_flash $(WRITE_FLASH)
+"""),
+]
+
+# flash-full goes through esp8266-setup too, so what it writes is recorded
+FLASH_FULL_MIGRATION = [
+    ("""flash-full: $(TARGET1) $(TARGET2)
+	$(ESPTOOL) --port $(SERIALPORT) write_flash $(WRITE_FLASH)
+""", """flash-full: $(TARGET1) $(TARGET2)
+	esp8266-setup flash --full --port $(SERIALPORT) --esptool $(ESPTOOL) $(WRITE_FLASH)
+"""),
+]
+
+# projects pick up the toolchain from `install-toolchain`
+TOOLCHAIN_MIGRATION = [
+    ("""endif
+
+# base directory for the compiler
+""", """endif
+
+# toolchain and SDK installed by `esp8266-setup install-toolchain`, the
+# defaults below are used if it was not run for this project
+-include toolchain.mk
+
+# base directory for the compiler
+"""),
+]
+
+def migrate_makefile(mk):
+    """Bring a Makefile of an older project up to date with the
+    template, returns True if anything changed"""
+    migrated = False
+    for old, new in DEPEND_MIGRATION + FLAGS_MIGRATION + FLASH_MIGRATION + FLASH_FULL_MIGRATION + TOOLCHAIN_MIGRATION:
+        migrated = mk.replace(old, new) or migrated
+    return migrated
+
+def migrate_lib_build(mk):
+    """Add the LIB_BUILD setting to a Makefile of an older project"""
+    if mk.has('LIB_BUILD'):
+        return
+    if not mk.replace(RECURSIVE_LIB_RULES, LIB_BUILD_RULES):
+        print('ERROR: Could not find the library rules in the Makefile, was it modified manually?')
+        exit(1)
+    mk.insert_after('SRC_LIBS', [
+        '',
+        '# how to build the libraries: recursive (one make per library) or flat (all',
+        '# libraries in one build graph, generated by `esp8266-setup generate-build`)',
+        'LIB_BUILD    = recursive',
+    ])
 
 def make_project_makefile(mk, args):
     # Add the SDK libs as requested
     if args.sdk_libs is not None:
         libs = " ".join(args.sdk_libs.split(","))
-        m = re.search(r'^LIBS[ \t]*\+=[ \t]*[^\n]*$', mk, flags=re.MULTILINE)
-        mk = mk[:m.start()] + 'LIBS        += ' + libs + mk[m.end():]
+        mk.set('LIBS', libs, op='+=')
 
     # Flash layout
     if args.flash_size is not None:        
-        m = re.search(r'^FLASH_SIZE[ \t]*=[ \t]*[^\n]*$', mk, flags=re.MULTILINE)
-        mk = mk[:m.start()] + 'FLASH_SIZE   = ' + str(args.flash_size) + mk[m.end():]
+        mk.set('FLASH_SIZE', str(args.flash_size))
+
+    # Library build
+    if args.lib_build is not None:
+        migrate_lib_build(mk)
+        mk.set('LIB_BUILD', args.lib_build)
 
     return mk
 
@@ -30,8 +180,8 @@ def start_project(args):
     os.mkdir(os.path.join(args.name, 'src'))
     with open(os.path.join(args.name, 'Makefile'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "makefiles", "project.mk"), 'r') as fpi:
-            mk = make_project_makefile(fpi.read(), args)
-        fpo.write(mk)
+            mk = make_project_makefile(Makefile(fpi.read()), args)
+        fpo.write(str(mk))
     with open(os.path.join(args.name, 'src', 'main.c'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "skel", "main.c"), 'r') as fpi:
             fpo.write(replace_placeholders(fpi.read()))
@@ -41,15 +191,32 @@ def start_project(args):
     with open(os.path.join(args.name, 'LICENSE.txt'), 'w') as fpo:
         with open(os.path.join(BASE_DIR, "skel", "BSD.txt"), 'r') as fpi:
             fpo.write(replace_placeholders(fpi.read()))
-    cmd = 'cd {} ; esp8266-setup add-library git+https://github.com/esp8266-setup/minic.git@master'.format(args.name)
-    os.system(cmd)
+
+    # in this process, starting another interpreter costs more than the work
+    cwd = os.getcwd()
+    os.chdir(args.name)
+    try:
+        add_library(argparse.Namespace(library=[DEFAULT_LIBRARY], file=None, jobs=1, shallow=False))
+    except SystemExit:
+        pass
+    except Exception as e:
+        print('ERROR: Could not add {}: {}'.format(DEFAULT_LIBRARY, e))
+    finally:
+        os.chdir(cwd)
 
 def modify_settings(args):
     if not os.path.exists('Makefile'):
         print('ERROR: Not a project directory, enter the project directory first!')
         exit(1)
-    with open('Makefile', 'r+') as fp:
-        mk = make_project_makefile(fp.read(), args)
-        fp.seek(0)
-        fp.truncate()
-        fp.write(mk)
\ No newline at end of file
+    for name in sorted(os.listdir('lib')) if os.path.isdir('lib') else []:
+        filename = os.path.join('lib', name, 'Makefile')
+        if os.path.isfile(filename):
+            with edit_makefile(filename) as lib_mk:
+                if migrate_library_makefile(lib_mk):
+                    print('Migrated {} to the current template'.format(filename))
+    with edit_makefile() as mk:
+        if migrate_makefile(mk):
+            print('Migrated Makefile to the current template')
+        make_project_makefile(mk, args)
+        if mk.has('LIB_BUILD') and mk.get('LIB_BUILD') == 'flat':
+            write_build_file()
\ No newline at end of file
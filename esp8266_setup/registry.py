@@ -0,0 +1,206 @@
+from __future__ import print_function
+
+import os
+import json
+import threading
+
+from esp8266_setup.cache import cache_dir, cache_key, locked
+from esp8266_setup.tools import BASE_DIR
+
+# additional definition directories or index files, separated like PATH.
+# They are searched in order before the definitions of the distribution.
+REGISTRY_ENV = 'ESP8266_SETUP_REGISTRY'
+
+# bump when the layout of the compiled index changes
+REGISTRY_VERSION = 1
+
+# loaded and stat checked once per process
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def registry_sources():
+    sources = [os.path.abspath(p) for p in os.environ.get(REGISTRY_ENV, '').split(os.pathsep) if len(p) > 0]
+    return sources + [os.path.join(BASE_DIR, 'libs')]
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+def _read_definitions(filename):
+    """Definitions in a file and whether it is an index file, a file is
+    either a single definition or an index file with a list of them
+    (optionally under a `libraries` key)"""
+    try:
+        with open(filename, 'r') as fp:
+            data = json.load(fp)
+    except (IOError, OSError, ValueError) as e:
+        print('WARNING: Invalid library definition {}: {}'.format(filename, e))
+        return [], False
+    if isinstance(data, dict) and 'libraries' in data:
+        data = data['libraries']
+    if isinstance(data, dict):
+        return ([data] if 'name' in data else []), False
+    return [d for d in data if isinstance(d, dict) and 'name' in d], True
+
+def _refresh_file(files, filename):
+    """Re-read a definition file if it changed, returns True if it did"""
+    sig = _stat(filename)
+    entry = files.get(filename)
+    if entry is not None and entry['signature'] == sig:
+        return False
+    if sig is None:
+        files.pop(filename, None)
+    else:
+        definitions, index = _read_definitions(filename)
+        files[filename] = {'signature': sig, 'definitions': definitions, 'index': index}
+    return True
+
+def _refresh_source(source):
+    """Bring the compiled state of one source up to date. Every known file is
+    stat checked, as files are edited in place. Adding, removing or renaming
+    files changes the directory, so only directories that changed are listed
+    again. Returns True if anything changed."""
+    path = source['path']
+    sig = _stat(path)
+    files = source['files']
+    changed = False
+    if os.path.isdir(path):
+        if sig != source['signature']:
+            names = set(os.path.join(path, n) for n in os.listdir(path) if n.endswith('.json'))
+            for filename in list(files.keys()):
+                if filename not in names:
+                    del files[filename]
+                    changed = True
+        else:
+            names = list(files.keys())
+        for filename in sorted(names):
+            changed = _refresh_file(files, filename) or changed
+    else:
+        changed = _refresh_file(files, path)
+    changed = changed or sig != source['signature']
+    source['signature'] = sig
+    return changed
+
+
+class Registry(object):
+    """Library definitions of all registry sources, compiled into one index
+    in the user level cache. The index is brought up to date incrementally,
+    only definition files that changed are parsed again."""
+
+    def __init__(self):
+        self.sources = registry_sources()
+        self.filename = os.path.join(cache_dir('registry'), cache_key(os.pathsep.join(self.sources)) + '.json')
+        with locked(self.filename):
+            self.index = self._load()
+            changed = False
+            for source in self.index['sources']:
+                changed = _refresh_source(source) or changed
+            if changed:
+                self._compile()
+                self._save()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'r') as fp:
+                index = json.load(fp)
+            if index.get('version') == REGISTRY_VERSION:
+                return index
+        except (IOError, OSError, ValueError):
+            pass
+        return {
+            'version': REGISTRY_VERSION,
+            'sources': [{'path': p, 'signature': False, 'files': {}} for p in self.sources],
+            'libraries': {},
+        }
+
+    def _compile(self):
+        """Name -> (source, file) map, the first definition of a name wins"""
+        libraries = {}
+        for i, source in enumerate(self.index['sources']):
+            for filename in sorted(source['files'].keys()):
+                for definition in source['files'][filename]['definitions']:
+                    libraries.setdefault(definition['name'], [i, filename])
+        self.index['libraries'] = libraries
+
+    def _save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.index, fp)
+        os.rename(tmp, self.filename)
+
+    def lookup(self, name):
+        """Tuple of (definition, definition file, whether that file is an
+        index file) for a library name, None if no source has the library"""
+        location = self.index['libraries'].get(name)
+        if location is None:
+            return None
+        source, filename = location
+        files = self.index['sources'][source]['files']
+        for definition in files[filename]['definitions']:
+            if definition['name'] == name:
+                return definition, filename, files[filename]['index']
+        return None
+
+    def libraries(self):
+        """(definition, definition file) of every library, sorted by name"""
+        result = []
+        for name in sorted(self.index['libraries'].keys()):
+            source, filename = self.index['libraries'][name]
+            for definition in self.index['sources'][source]['files'][filename]['definitions']:
+                if definition['name'] == name:
+                    result.append((definition, filename))
+                    break
+        return result
+
+
+def registry():
+    """The registry of this process, brought up to date on first use"""
+    global _registry
+    with _registry_lock:
+        if _registry is None or _registry.sources != registry_sources():
+            _registry = Registry()
+        return _registry
+
+def find_definition(name):
+    """(definition, definition file, index file flag) for a library name from
+    the registry, None if it is unknown"""
+    return registry().lookup(name)
+
+def matches(definition, args):
+    if args.query and args.query.lower() not in definition['name'].lower():
+        return False
+    if args.sdk_dependency and args.sdk_dependency not in definition.get('sdk_dependencies', []):
+        return False
+    if args.license and args.license.lower() != definition.get('license', '').lower():
+        return False
+    return True
+
+def search(args):
+    found = [d for d, _ in registry().libraries() if matches(d, args)]
+    if len(found) == 0:
+        print('No library found')
+        return
+    width = max(len(d['name']) for d in found)
+    for d in found:
+        print('{:<{width}}  {:<8} {:<14} {}'.format(
+            d['name'], d.get('version', ''), d.get('license', ''), d.get('url', ''), width=width))
+
+def info(args):
+    found = registry().lookup(args.library)
+    if found is None:
+        print('ERROR: Unknown library {}'.format(args.library))
+        exit(1)
+    definition, filename, _ = found
+    print('Name:             {}'.format(definition['name']))
+    print('Version:          {}'.format(definition.get('version', '')))
+    print('Author:           {}'.format(definition.get('author', '')))
+    print('License:          {}'.format(definition.get('license', '')))
+    print('URL:              {}'.format(definition.get('url', '')))
+    print('Dependencies:     {}'.format(', '.join(definition.get('dependencies', [])) or '-'))
+    print('SDK dependencies: {}'.format(', '.join(definition.get('sdk_dependencies', [])) or '-'))
+    print('Source files:     {}'.format(len(definition.get('source', []))))
+    print('Definition:       {}'.format(filename))
@@ -0,0 +1,161 @@
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+import subprocess
+from contextlib import contextmanager
+
+# append one JSON line per external command (and download) to this file
+EVENT_LOG_ENV = 'ESP8266_SETUP_EVENT_LOG'
+
+# seconds after which an external command is killed, 0 disables the timeout
+TIMEOUT_ENV = 'ESP8266_SETUP_TIMEOUT'
+DEFAULT_TIMEOUT = 600
+
+# last progress line of a git clone or fetch that went over the network
+GIT_RECEIVED = re.compile(r'Receiving objects: 100% \(\d+/\d+\), ([0-9.]+) (bytes|KiB|MiB|GiB)')
+UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+_context = threading.local()
+_lock = threading.Lock()
+_running = set()
+_cancelled = threading.Event()
+
+
+class CommandError(Exception):
+    pass
+
+
+class Result(object):
+
+    def __init__(self, command, returncode, output, duration, timed_out=False):
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+@contextmanager
+def library_context(name):
+    """Attribute the commands this thread runs to a library in the event log"""
+    previous = getattr(_context, 'library', None)
+    _context.library = name
+    try:
+        yield
+    finally:
+        _context.library = previous
+
+def default_timeout():
+    timeout = float(os.environ.get(TIMEOUT_ENV, DEFAULT_TIMEOUT))
+    return timeout if timeout > 0 else None
+
+def log_event(event):
+    """Append an event to the event log, if one is configured"""
+    filename = os.environ.get(EVENT_LOG_ENV)
+    if not filename:
+        return
+    event.setdefault('library', getattr(_context, 'library', None))
+    event['time'] = time.time()
+    event['host'] = socket.gethostname()
+    event['pid'] = os.getpid()
+    with _lock:
+        with open(filename, 'a') as fp:
+            fp.write(json.dumps(event, sort_keys=True) + '\n')
+
+def _kill(process):
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        pass
+
+def cancel():
+    """Kill all running commands, commands started afterwards fail"""
+    _cancelled.set()
+    with _lock:
+        for process in list(_running):
+            _kill(process)
+
+def _received_bytes(output):
+    match = None
+    for match in GIT_RECEIVED.finditer(output):
+        pass
+    if match is None:
+        return None
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+def run(command, cwd=None, timeout=-1, capture=True, env=None):
+    """Run an external command (a list of arguments) and return a Result.
+    Output is captured unless capture is False, the command is killed with
+    everything it started after timeout seconds (default: ESP8266_SETUP_TIMEOUT,
+    None for no limit)"""
+    if _cancelled.is_set():
+        raise CommandError('Cancelled, not running {}'.format(' '.join(command)))
+    if timeout == -1:
+        timeout = default_timeout()
+
+    # own process group, so a timeout also kills what the command started
+    kwargs = {}
+    if sys.version_info[0] >= 3:
+        kwargs['start_new_session'] = True
+    elif hasattr(os, 'setsid'):
+        kwargs['preexec_fn'] = os.setsid
+    start = time.time()
+    process = subprocess.Popen(
+        command,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE if capture else None,
+        stderr=subprocess.STDOUT if capture else None,
+        **kwargs
+    )
+    with _lock:
+        _running.add(process)
+        if _cancelled.is_set():
+            _kill(process)
+
+    expired = []
+    def expire():
+        expired.append(True)
+        _kill(process)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+        with _lock:
+            _running.discard(process)
+    duration = time.time() - start
+
+    output = output.decode('utf-8', 'replace') if output is not None else ''
+    result = Result(command, process.returncode, output, duration, timed_out=len(expired) > 0)
+    log_event({
+        'kind': 'command',
+        'command': command,
+        'cwd': os.path.abspath(cwd or '.'),
+        'duration': duration,
+        'exit_status': process.returncode,
+        'timed_out': result.timed_out,
+        'bytes': _received_bytes(output),
+    })
+    if result.timed_out:
+        print('ERROR: {} did not finish within {:g}s'.format(' '.join(command), timeout))
+    return result
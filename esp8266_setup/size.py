@@ -0,0 +1,201 @@
+from __future__ import print_function
+
+import os
+import json
+from glob import glob
+
+from esp8266_setup.elf import read_elf, read_archive, Elf, ElfError, SHN_COMMON, SHN_LORESERVE
+
+# where the ESP8266 linker scripts put things, .rodata lives in DRAM too
+REGIONS = ['iram', 'dram', 'rodata', 'flash']
+RAM_REGIONS = ['iram', 'dram', 'rodata']
+
+# available memory, DRAM is shared by data, bss and rodata
+LIMITS = {'iram': 0x8000, 'dram': 0x14000}
+
+# linked firmware, in the order the project Makefile may produce it
+DEFAULT_ELF_FILES = [os.path.join('build', 'user.app1.elf'), os.path.join('build', 'user.elf')]
+
+
+def region(section_name):
+    """Memory region of an input or output section"""
+    if section_name.startswith(('.irom0.', '.irom.')):
+        return 'flash'
+    if section_name.startswith(('.text', '.literal', '.iram')):
+        return 'iram'
+    if section_name.startswith('.rodata'):
+        return 'rodata'
+    if section_name.startswith(('.data', '.sdata', '.bss', '.sbss')) or section_name == 'COMMON':
+        return 'dram'
+    return None
+
+def _add(totals, name, size):
+    totals[name] = totals.get(name, 0) + size
+
+
+def object_usage(obj, linked_symbols=None):
+    """Bytes per region an object file contributes, if the symbols of the
+    linked firmware are known sections dropped by --gc-sections are left out"""
+    symbols = {}
+    for sym in obj.symbols:
+        if sym.defined and len(sym.name) > 0:
+            symbols.setdefault(sym.shndx, []).append(sym.name)
+
+    kept = []
+    for section in obj.sections:
+        if not section.alloc or section.size == 0 or region(section.name) is None:
+            continue
+        if linked_symbols is not None:
+            names = symbols.get(section.index, [])
+            if len(names) > 0 and not any(n in linked_symbols for n in names):
+                continue
+        kept.append(section)
+
+    # sections without symbols (literals, merged strings) only count when
+    # something else of the object made it into the firmware
+    if linked_symbols is not None and not any(len(symbols.get(s.index, [])) > 0 for s in kept):
+        return {}
+
+    usage = {}
+    for section in kept:
+        _add(usage, region(section.name), section.size)
+    for sym in obj.symbols:
+        if sym.shndx == SHN_COMMON and (linked_symbols is None or sym.name in linked_symbols):
+            _add(usage, 'dram', sym.size)
+    return usage
+
+def archives():
+    """(owner, archive) of everything the project builds itself"""
+    result = []
+    if os.path.isfile(os.path.join('build', 'libuser.a')):
+        result.append(('app', os.path.join('build', 'libuser.a')))
+    for archive in sorted(glob(os.path.join('build', 'lib', 'lib*.a'))):
+        result.append((os.path.basename(archive)[3:-2], archive))
+    return result
+
+def analyze(elf_file):
+    elf = read_elf(elf_file)
+    report = {
+        'elf': elf_file,
+        'sections': {},
+        'regions': dict((r, 0) for r in REGIONS),
+        'libraries': {},
+        'objects': {},
+        'gc': not elf.stripped,
+    }
+    for section in elf.sections:
+        r = region(section.name)
+        if section.alloc and section.size > 0 and r is not None:
+            report['sections'][section.name] = {'region': r, 'address': section.addr, 'size': section.size}
+            report['regions'][r] += section.size
+
+    linked_symbols = None
+    if not elf.stripped:
+        linked_symbols = set(s.name for s in elf.symbols if s.defined and s.shndx < SHN_LORESERVE)
+
+    attributed = {}
+    for owner, archive in archives():
+        library = report['libraries'].setdefault(owner, {})
+        for name, data in read_archive(archive):
+            try:
+                usage = object_usage(Elf(data), linked_symbols)
+            except ElfError:
+                continue
+            if len(usage) == 0:
+                continue
+            report['objects']['{}:{}'.format(owner, name)] = usage
+            for r, size in usage.items():
+                _add(library, r, size)
+                _add(attributed, r, size)
+
+    # SDK libraries and libc
+    report['libraries']['other'] = dict((r, max(0, report['regions'][r] - attributed.get(r, 0))) for r in REGIONS)
+    return report
+
+
+def _row(label, usage, width=24):
+    return '{:<{}}'.format(label, width) + ''.join('{:>10}'.format(usage.get(r, 0)) for r in REGIONS)
+
+def _header(label, width=24):
+    return '{:<{}}'.format(label, width) + ''.join('{:>10}'.format(r) for r in REGIONS)
+
+def print_report(report, objects=10):
+    print('Memory usage of {}:'.format(report['elf']))
+    regions = report['regions']
+    print('  IRAM   {:>8} of {:>6} bytes ({:.1f}%)'.format(regions['iram'], LIMITS['iram'], 100.0 * regions['iram'] / LIMITS['iram']))
+    dram = regions['dram'] + regions['rodata']
+    print('  DRAM   {:>8} of {:>6} bytes ({:.1f}%, {} rodata)'.format(dram, LIMITS['dram'], 100.0 * dram / LIMITS['dram'], regions['rodata']))
+    print('  flash  {:>8} bytes'.format(regions['flash']))
+
+    print('')
+    print('{:<24}{:>12}{:>10}{:>10}'.format('section', 'address', 'size', 'region'))
+    for name, section in sorted(report['sections'].items(), key=lambda s: s[1]['address']):
+        print('{:<24}{:>12}{:>10}{:>10}'.format(name, '0x{:08x}'.format(section['address']), section['size'], section['region']))
+
+    print('')
+    print(_header('library'))
+    for name, usage in sorted(report['libraries'].items(), key=lambda l: (l[0] == 'other', l[0] != 'app', l[0])):
+        print(_row(name, usage))
+
+    if objects > 0 and len(report['objects']) > 0:
+        print('')
+        print(_header('largest objects (RAM)'))
+        ram = lambda o: sum(o[1].get(r, 0) for r in RAM_REGIONS)
+        for name, usage in sorted(report['objects'].items(), key=lambda o: -ram(o))[:objects]:
+            print(_row(name, usage))
+
+    if not report['gc']:
+        print('')
+        print('The firmware is stripped, library and object sizes include code removed by')
+        print('--gc-sections. Remove -Wl,-s from LDFLAGS for exact numbers.')
+
+def print_diff(report, baseline, baseline_file):
+    print('')
+    print('Compared to {}:'.format(baseline_file))
+    delta = dict((r, report['regions'][r] - baseline['regions'].get(r, 0)) for r in REGIONS)
+    print(_header(''))
+    print(_row('total', delta))
+    for name in sorted(set(report['libraries']) | set(baseline['libraries'])):
+        now = report['libraries'].get(name, {})
+        before = baseline['libraries'].get(name, {})
+        change = dict((r, now.get(r, 0) - before.get(r, 0)) for r in REGIONS)
+        if any(v != 0 for v in change.values()):
+            print(_row(name, change))
+    return sum(delta[r] for r in RAM_REGIONS)
+
+
+def analyze_size(args):
+    elf_file = args.elf
+    if elf_file is None:
+        existing = [f for f in DEFAULT_ELF_FILES if os.path.isfile(f)]
+        if len(existing) == 0:
+            print('ERROR: No firmware found, build the project first or pass the ELF file!')
+            exit(1)
+        elf_file = existing[0]
+    try:
+        report = analyze(elf_file)
+    except (IOError, ElfError) as e:
+        print('ERROR: Could not read {}: {}'.format(elf_file, e))
+        exit(1)
+    print_report(report, args.objects)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as fp:
+            json.dump(report, fp, indent=4, sort_keys=True)
+        print('')
+        print('Baseline saved to {}'.format(args.save_baseline))
+
+    if args.baseline is not None:
+        try:
+            with open(args.baseline, 'r') as fp:
+                baseline = json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            print('ERROR: Could not read baseline {}: {}'.format(args.baseline, e))
+            exit(1)
+        if not isinstance(baseline, dict) or 'regions' not in baseline or 'libraries' not in baseline:
+            print('ERROR: {} is not a size baseline, save one with --save-baseline'.format(args.baseline))
+            exit(1)
+        growth = print_diff(report, baseline, args.baseline)
+        if args.max_ram_growth is not None and growth > args.max_ram_growth:
+            print('ERROR: RAM usage grew by {} bytes, more than the allowed {} bytes'.format(growth, args.max_ram_growth))
+            exit(1)
@@ -1,2 +1,172 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import platform
+
+from esp8266_setup.cache import cache_dir, locked
+from esp8266_setup.download import DownloadError, cached_download, sha256_file, unpack
+from esp8266_setup.makefile import edit_makefile
+from esp8266_setup.tools import parallel_map, write_if_changed
+
+# what `install-toolchain` installs unless a manifest is given. Archives are
+# keyed by platform, `any` is used on all of them. Archives are only verified
+# if the entry has a sha256, pin them with a manifest of your own for CI.
+DEFAULT_MANIFEST = {
+    'toolchain': {
+        'name': 'xtensa-lx106-elf',
+        'version': '1.22.0-100-ge567ec7-5.2.0',
+        'bin': 'bin',
+        'archives': {
+            'linux64': {'url': 'https://dl.espressif.com/dl/xtensa-lx106-elf-linux64-1.22.0-100-ge567ec7-5.2.0.tar.gz'},
+            'linux32': {'url': 'https://dl.espressif.com/dl/xtensa-lx106-elf-linux32-1.22.0-100-ge567ec7-5.2.0.tar.gz'},
+            'macos': {'url': 'https://dl.espressif.com/dl/xtensa-lx106-elf-macos-1.22.0-100-ge567ec7-5.2.0.tar.gz'},
+            'win32': {'url': 'https://dl.espressif.com/dl/xtensa-lx106-elf-win32-1.22.0-100-ge567ec7-5.2.0.zip'},
+        },
+    },
+    'sdk': {
+        'name': 'ESP8266_RTOS_SDK',
+        'version': '2.0.0',
+        'archives': {
+            'any': {'url': 'https://github.com/espressif/ESP8266_RTOS_SDK/archive/v2.0.0.tar.gz'},
+        },
+    },
+}
+
+# written into the project, the Makefile includes it
+TOOLCHAIN_MAKEFILE = 'toolchain.mk'
+
+# describes an installed component inside its directory in the store
+INSTALL_RECORD = '.install.json'
+
+
+def host_platform():
+    if sys.platform.startswith('win') or sys.platform == 'cygwin':
+        return 'win32'
+    if sys.platform == 'darwin':
+        return 'macos'
+    return 'linux64' if platform.machine().endswith('64') else 'linux32'
+
+def load_manifest(filename):
+    if filename is None:
+        return DEFAULT_MANIFEST
+    try:
+        with open(filename, 'r') as fp:
+            manifest = json.load(fp)
+    except (IOError, OSError, ValueError) as e:
+        print('ERROR: Could not read toolchain manifest {}: {}'.format(filename, e))
+        exit(1)
+    for kind in ('toolchain', 'sdk'):
+        if kind not in manifest:
+            print('ERROR: Toolchain manifest {} has no {} entry'.format(filename, kind))
+            exit(1)
+    return manifest
+
+
+class Component(object):
+    """A toolchain or SDK release for one platform from the manifest"""
+
+    def __init__(self, kind, entry, host):
+        self.kind = kind
+        self.name = entry['name']
+        self.version = entry['version']
+        self.bin = entry.get('bin')
+        archive = entry['archives'].get(host) or entry['archives'].get('any')
+        if archive is None:
+            raise KeyError('{} {} is not available for {}'.format(self.name, self.version, host))
+        self.url = archive['url']
+        self.sha256 = archive.get('sha256')
+        suffix = '' if host not in entry['archives'] else '-' + host
+        self.path = os.path.join(cache_dir('toolchains'), '{}-{}{}'.format(self.name, self.version, suffix))
+
+    @property
+    def record(self):
+        try:
+            with open(os.path.join(self.path, INSTALL_RECORD), 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @property
+    def installed(self):
+        record = self.record
+        return record is not None and (self.sha256 is None or record['sha256'] == self.sha256)
+
+    def install(self, jobs):
+        """Download, verify and unpack into the store, returns False if it
+        was installed already"""
+        with locked(self.path):
+            if self.installed:
+                return False
+            try:
+                archive, _ = cached_download(self.url, sha256=self.sha256, jobs=jobs)
+            except DownloadError as e:
+                print('ERROR: {}'.format(e))
+                exit(1)
+            digest = self.sha256 or sha256_file(archive)
+
+            # unpack next to the final location, so a crash never leaves a
+            # half unpacked component behind that looks installed
+            tmp = self.path + '.tmp'
+            try:
+                unpack(archive, tmp)
+            except (DownloadError, IOError, OSError) as e:
+                print('ERROR: Could not unpack {}: {}'.format(archive, e))
+                exit(1)
+            with open(os.path.join(tmp, INSTALL_RECORD), 'w') as fp:
+                json.dump({'name': self.name, 'version': self.version, 'url': self.url, 'sha256': digest}, fp, indent=4)
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            os.rename(tmp, self.path)
+            return True
+
+
+def toolchain_makefile(toolchain, sdk):
+    bin_dir = os.path.join(toolchain.path, toolchain.bin) if toolchain.bin else toolchain.path
+    return '\n'.join([
+        '# generated by `esp8266-setup install-toolchain`, do not commit',
+        'XTENSA_TOOLS_ROOT ?= {}'.format(bin_dir),
+        'SDK_PATH          ?= {}'.format(sdk.path),
+        '',
+    ])
+
 def install_toolchain(args):
-    pass
\ No newline at end of file
+    manifest = load_manifest(args.manifest)
+    host = args.platform or host_platform()
+    try:
+        components = [Component(kind, manifest[kind], host) for kind in ('toolchain', 'sdk')]
+    except KeyError as e:
+        print('ERROR: {}'.format(e.args[0]))
+        exit(1)
+
+    def install(component):
+        try:
+            if component.install(args.jobs):
+                print('Installed {} {} into {}'.format(component.name, component.version, component.path))
+            else:
+                print('{} {} is already installed'.format(component.name, component.version))
+        except SystemExit:
+            return False
+        except Exception as e:
+            print('ERROR: Could not install {} {}: {}'.format(component.name, component.version, e))
+            return False
+        return True
+
+    # toolchain and SDK are fetched at the same time
+    if not all(parallel_map(install, components, jobs=len(components))):
+        exit(1)
+
+    toolchain, sdk = components
+    content = toolchain_makefile(toolchain, sdk)
+    if not os.path.exists('Makefile'):
+        print('Not in a project directory, use these settings:')
+        print(content.split('\n', 1)[1].rstrip())
+        return
+
+    from esp8266_setup.project import migrate_makefile
+    with edit_makefile() as mk:
+        migrate_makefile(mk)
+    if write_if_changed(TOOLCHAIN_MAKEFILE, content):
+        print('Project now uses {} {} and {} {}'.format(toolchain.name, toolchain.version, sdk.name, sdk.version))
@@ -1,4 +1,7 @@
+from __future__ import print_function
 import os
+import time
+import threading
 from datetime import datetime
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -20,4 +23,49 @@ def replace_placeholders(template, **kwargs):
     template = template.replace('%user%', current_user())
     for key, value in kwargs.items():
         template = template.replace('%' + key + '%', value)
-    return template
\ No newline at end of file
+    return template
+
+def parallel_map(func, items, jobs=1):
+    """Run func over items using a pool of at most jobs threads, results are
+    returned in the order of items"""
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    # imported here, it is only needed for parallel work and slow to import
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+class Progress(object):
+    """Thread safe `[n/total] message` progress printer"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def step(self, message):
+        with self.lock:
+            self.done += 1
+            print('[{}/{}] {}'.format(self.done, self.total, message))
+
+def timed(func, *args, **kwargs):
+    """Call func and return a tuple of (result, seconds)"""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+def write_if_changed(filename, content):
+    """Write content to filename unless it already contains exactly that,
+    returns True if the file was written"""
+    if os.path.isfile(filename):
+        with open(filename, 'r') as fp:
+            if fp.read() == content:
+                return False
+    with open(filename, 'w') as fp:
+        fp.write(content)
+    return True
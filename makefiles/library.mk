@@ -87,6 +87,27 @@ LD := $(XTENSA_TOOLS_ROOT)/xtensa-lx106-elf-gcc
 TARGET          := $(addprefix $(BUILD_DIR)/../,$(TARGET))
 DEP             := $(patsubst %.c,$(BUILD_DIR)/%.d,$(SRC))
 LIB_SDK_INCDIR  := $(addprefix -I$(SDK_PATH)/,$(LIB_SDK_INCDIR))
+LIB_FLAGS       := $(BUILD_DIR)/lib.flags
+
+# signature of the effective flags, rewritten only when they change
+update-flags = $(shell mkdir -p $(dir $1) && printf '%s\n' '$(subst ','\'',$2)' | cmp -s - $1 || printf '%s\n' '$(subst ','\'',$2)' > $1)
+
+ifneq ($(MAKECMDGOALS),clean)
+$(call update-flags,$(LIB_FLAGS),$(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS))
+endif
+
+# prebuilt archives come from the user level cache if available, set
+# LIB_CACHE to an empty value to always compile
+ifndef LIB_CACHE
+LIB_CACHE := $(shell command -v esp8266-setup)
+endif
+ifneq ($(LIB_CACHE),)
+ifneq ($(MAKECMDGOALS),clean)
+ifeq ($(wildcard $(TARGET)),)
+LIB_CACHED := $(shell $(LIB_CACHE) cache restore . $(BUILD_DIR) $(TARGET) $(LIB_FLAGS))
+endif
+endif
+endif
 
 V ?= $(VERBOSE)
 ifeq ("$(V)","1")
@@ -106,6 +127,9 @@ all: checkdirs $(TARGET)
 $(TARGET): $(OBJ)
 	$(vecho) "AR $@"
 	$(Q) $(AR) cru $@ $^
+ifneq ($(LIB_CACHE),)
+	$(Q) $(LIB_CACHE) cache store . $(BUILD_DIR) $@ $(LIB_FLAGS) > /dev/null
+endif
 
 checkdirs: $(BUILD_DIR) $(BUILD_DIR)/src
 
@@ -121,15 +145,8 @@ clean:
 	$(vecho) "Clean $(BUILD_DIR)"
 	$(Q) rm -rf $(BUILD_DIR)
 
-$(BUILD_DIR)/%.o: %.c
+$(BUILD_DIR)/%.o: %.c $(LIB_FLAGS) | $(BUILD_DIR)/src
 	$(vecho) "CC $<"
-	$(Q) $(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS) -c $< -o $@
-
-$(BUILD_DIR)/%.d: %.c $(BUILD_DIR)/src
-	$(vecho) "Depend $<"
-	$(Q) set -e; rm -f $@; \
-	 $(CC) -M $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CPPFLAGS) $< > $@.$$$$; \
-	 sed 's,\(.*\)\.o[ :]*,$(BUILD_DIR)/$(dir $<)\1.o $@: ,g' < $@.$$$$ > $@; \
-	 rm -f $@.$$$$
+	$(Q) $(CC) $(INCDIR) $(LIB_SDK_INCDIR) $(SDK_INCDIR) $(CFLAGS) -MMD -MP -c $< -o $@
 
 -include $(DEP)
\ No newline at end of file
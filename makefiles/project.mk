@@ -38,6 +38,10 @@ else
     endif
 endif
 
+# toolchain and SDK installed by `esp8266-setup install-toolchain`, the
+# defaults below are used if it was not run for this project
+-include toolchain.mk
+
 # base directory for the compiler
 # base directory of the ESP8266 SDK package, absolute
 # serial port to use for flashing
@@ -73,6 +77,10 @@ SRC_DIR	     = src
 SRC_LIBDIR   = lib
 SRC_LIBS     =
 
+# how to build the libraries: recursive (one make per library) or flat (all
+# libraries in one build graph, generated by `esp8266-setup generate-build`)
+LIB_BUILD    = recursive
+
 # SDK libraries to link
 LIBS         = gcc hal pp phy net80211 lwip wpa main crypto freertos 
 LIBS        += 
@@ -196,31 +204,46 @@ endif
 
 vpath %.c $(SRC_DIR)
 
+# signature of the effective flags of a build step, rewritten only when they
+# change so everything that depends on it is rebuilt exactly then
+update-flags = $(shell mkdir -p $(dir $1) && printf '%s\n' '$(subst ','\'',$2)' | cmp -s - $1 || printf '%s\n' '$(subst ','\'',$2)' > $1)
+
+APP_FLAGS   := $(BUILD_BASE)/app.flags
+LINK_FLAGS  := $(BUILD_BASE)/link.flags
+ifneq ($(MAKECMDGOALS),clean)
+$(call update-flags,$(APP_FLAGS),$(CC) $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CFLAGS))
+$(call update-flags,$(LINK_FLAGS),$(LD) $(SDK_LIBDIR) $(LD_SCRIPTS) $(LDFLAGS) $(LIBS) $(SRC_LD_LIBS))
+endif
+
 define compile-objects
-$1/%.o: %.c
+$1/%.o: %.c $(APP_FLAGS) | $1
 	$(vecho) "CC $$<"
-	$(Q) $(CC) $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CFLAGS) -c $$< -o $$@
-endef
-
-define make-depend
-$1/%.d: %.c checkdirs
-	$(vecho) "Depend $$<"
-	$(Q) set -e; rm -f $$@; \
-	 $(CC) -M $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CPPFLAGS) $$< > $$@.$$$$$$$$; \
-	 sed 's,\(.*\)\.o[ :]*,$(BUILD_BASE)/$$(dir $$<)\1.o $$@: ,g' < $$@.$$$$$$$$ > $$@; \
-	 rm -f $$@.$$$$$$$$
+	$(Q) $(CC) $(INCDIR) $(LIB_INC_DIRS) $(SDK_INCDIR) $(CFLAGS) -MMD -MP -c $$< -o $$@
 endef
 
-.PHONY: all checkdirs flash clean libdirs $(LIB_SRC_DIRS)
+.PHONY: all checkdirs flash flash-full clean libdirs $(LIB_SRC_DIRS)
 
 all: checkdirs libdirs $(TARGET1) $(TARGET2)
 
+ifeq ($(LIB_BUILD),flat)
+include build.mk
+
+build.mk: $(wildcard $(SRC_LIBDIR)/*/library.json)
+	$(vecho) "GEN $@"
+	$(Q) esp8266-setup generate-build
+	$(Q) touch $@
+
+libdirs: $(FLAT_LIB_ARCHIVES)
+
+$(TARGET1) $(TARGET2): $(FLAT_LIB_ARCHIVES)
+else
 libdirs: $(LIB_SRC_DIRS) 
 
 $(LIB_SRC_DIRS):
 	$(MAKE) -C $@ BUILD_DIR="$(BUILD_BASE)/$@"
+endif
 
-$(TARGET1): $(APP_AR)
+$(TARGET1): $(APP_AR) $(LINK_FLAGS)
 	$(vecho) "LD $@"
 	$(Q) if [ $(FLASH_SIZE) -eq 512 ] ; then \
 		echo "ATTENTION: This firmware will not be updateable over the air," ; \
@@ -229,7 +252,7 @@ $(TARGET1): $(APP_AR)
 	$(Q) $(LD) -L$(SDK_LIBDIR) -T$(SDK_PATH)/$(SDK_LDDIR)/$(word 1, $(LD_SCRIPTS)) $(LDFLAGS) -Wl,--start-group $(LIBS) $(SRC_LD_LIBS) $< -Wl,--end-group -o $@
 	$(Q) $(ESPTOOL) elf2image --version=$(ELF2IMAGE_VERSION) -o firmware/$(patsubst %.elf,%$(ESPTOOL_EXT),$(notdir $@)) $@
 
-$(TARGET2): $(APP_AR)
+$(TARGET2): $(APP_AR) $(LINK_FLAGS)
 	$(vecho) "LD $@"
 	$(Q) $(LD) -L$(SDK_LIBDIR) -T$(SDK_PATH)/$(SDK_LDDIR)/$(word 2, $(LD_SCRIPTS)) $(LDFLAGS) -Wl,--start-group $(LIBS) $(SRC_LD_LIBS) $< -Wl,--end-group -o $@
 	$(Q) $(ESPTOOL) elf2image --version=$(ELF2IMAGE_VERSION) -o firmware/$(patsubst %.elf,%$(ESPTOOL_EXT),$(notdir $@)) $@
@@ -246,15 +269,19 @@ $(BUILD_DIR):
 firmware:
 	$(Q) mkdir -p $@
 
+# only writes the flash sectors that changed since the last flash of the port,
+# flash-full always writes everything
 flash: $(TARGET1) $(TARGET2)
-	$(ESPTOOL) --port $(SERIALPORT) write_flash $(WRITE_FLASH)
+	esp8266-setup flash --port $(SERIALPORT) --esptool $(ESPTOOL) $(WRITE_FLASH)
+
+flash-full: $(TARGET1) $(TARGET2)
+	esp8266-setup flash --full --port $(SERIALPORT) --esptool $(ESPTOOL) $(WRITE_FLASH)
 
 clean:
 	$(Q) rm -rf firmware/ $(BUILD_BASE)
 
 $(foreach bdir,$(BUILD_DIR),$(eval $(call compile-objects,$(bdir))))
-$(foreach bdir,$(BUILD_DIR),$(eval $(call make-depend,$(bdir))))
-include $(DEP)
+-include $(DEP)
 
 export CFLAGS
 export LDFLAGS
@@ -0,0 +1,75 @@
+import random
+import struct
+import unittest
+import zlib
+
+from esp8266_setup import ota
+
+
+def images():
+    rng = random.Random(8266)
+    old = bytes(bytearray(rng.getrandbits(8) for _ in range(6000)))
+    new = bytearray(old)
+    for i in range(100, 6000, 500):
+        new[i] ^= 0x5a
+    new = bytes(new[:3000]) + b'inserted literal bytes' + bytes(new[3000:])
+    return old, new
+
+
+def with_stream(old, new, stream):
+    """A delta for old and new with a hand made operation stream"""
+    header = ota.HEADER.pack(ota.DELTA_MAGIC, ota.DELTA_VERSION, 15, len(old), len(new),
+                             ota.hashlib.sha1(old).digest(), ota.hashlib.sha1(new).digest())
+    return header + zlib.compress(stream)
+
+
+class ApplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old, self.new = images()
+        self.delta = ota.make(self.old, self.new)
+
+    def test_roundtrip(self):
+        self.assertEqual(ota.apply(self.old, self.delta), self.new)
+
+    def test_truncated(self):
+        for length in range(len(self.delta)):
+            with self.assertRaises(ota.DeltaError):
+                ota.apply(self.old, self.delta[:length])
+
+    def test_bit_flipped(self):
+        # some bits of a deflate stream do not change what it decodes to, so
+        # a flip either is detected or still gives exactly the new image
+        detected = 0
+        for pos in range(len(self.delta)):
+            for bit in (0, 7):
+                delta = bytearray(self.delta)
+                delta[pos] ^= 1 << bit
+                try:
+                    self.assertEqual(ota.apply(self.old, bytes(delta)), self.new)
+                except ota.DeltaError:
+                    detected += 1
+        self.assertGreater(detected, len(self.delta))
+
+    def test_trailing_data(self):
+        with self.assertRaises(ota.DeltaError):
+            ota.apply(self.old, self.delta + b'\0')
+
+    def test_truncated_operation(self):
+        stream = ota.OP.pack(ota.OP_INSERT, 0, 4)[:5]
+        with self.assertRaises(ota.DeltaError):
+            ota.apply(self.old, with_stream(self.old, self.new, stream))
+
+    def test_copy_outside_old_image(self):
+        stream = ota.OP.pack(ota.OP_ADD, len(self.old) - 2, 4) + b'\0' * 4
+        with self.assertRaises(ota.DeltaError):
+            ota.apply(self.old, with_stream(self.old, self.new, stream))
+
+    def test_length_past_stream(self):
+        stream = ota.OP.pack(ota.OP_INSERT, 0, 1000) + b'x' * 10
+        with self.assertRaises(ota.DeltaError):
+            ota.apply(self.old, with_stream(self.old, self.new, stream))
+
+
+if __name__ == '__main__':
+    unittest.main()